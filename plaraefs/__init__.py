@@ -1,16 +1,65 @@
 """
 Usage:
-    plaraefs mount <fname> <path> [<accesscontroller>] [--debug] [--fuse-debug]
-    plaraefs check <fname> [--fix-unreferenced] [--fix-unused-data] [--remove-corrupted] [--list-found] [--fix-nonexistent-entry]
+    plaraefs mount <fname> <path> [<accesscontroller>] [--snapshot=<name>] [options] [--debug] [--fuse-debug]
+    plaraefs check <fname> [options]
     plaraefs prune <fname>
+    plaraefs compact <fname>
+    plaraefs import <fname> <source> [--workers=<n>]
+    plaraefs export <fname> <destination> [--workers=<n>]
+    plaraefs rekey <fname> [--workers=<n>] [--rate=<MiB/s>]
+    plaraefs snapshot <fname> [<name>] [--delete]
+    plaraefs stats <metrics> [<previous>]
+    plaraefs bench [--output=<path>] [--filter=<pattern>] [--repeat=<n>]
+    plaraefs bench compare <old> <new> [--threshold=<percent>]
+
+Mount options:
+    --lowlevel              Use libfuse's inode based API
+    --kernel-cache          Keep file contents cached by the kernel across opens
+    --auto-cache            Keep file contents cached across opens while the size is unchanged
+    --writeback-cache       Let the kernel buffer writes and send them in larger requests
+    --max-read=<bytes>      Largest read request
+    --max-write=<bytes>     Largest write request
+    --attr-timeout=<s>      Seconds the kernel caches attributes for
+    --entry-timeout=<s>     Seconds the kernel caches names for
+    --negative-timeout=<s>  Seconds the kernel caches missing names for
+    --metrics               Record per operation counts and latencies, shown in /.plaraefs-metrics
+    --metrics-file=<path>   Also write the metrics here on SIGUSR1 and unmount
+    --profile-interval=<s>  Sample which layer each thread is in this often, added to the metrics
+
+Check options:
+    --fix-unreferenced       Free blocks marked as used which nothing points to
+    --fix-unused-data        Wipe unused blocks which contain data
+    --remove-corrupted       Remove files whose header can't be read
+    --list-found             List every file found
+    --fix-nonexistent-entry  Remove directory entries pointing to unused blocks
+    --verify                 Also decrypt every data block to check it is intact
+    --workers=<n>            Threads reading and decrypting blocks, one per CPU by default, also used by import,
+                             export and rekey
+
+Rekey options:
+    --rate=<MiB/s>           Re-encrypt at most this fast, to leave disk bandwidth for others
+
+Benchmark options:
+    --output=<path>          Write the results here as JSON instead of to stdout
+    --filter=<pattern>       Only run benchmarks whose names match this glob
+    --repeat=<n>             Times to run each benchmark [default: 5]
+    --threshold=<percent>    Slowdown reported as a regression [default: 10]
 """
 
+import fnmatch
+import json
 import logging
 import itertools
 import pathlib
 
-from .fusefilesystem import FUSEFilesystem
+from .fusefilesystem import FUSEFilesystem, MountOptions
+from .lowlevelfusefilesystem import LowLevelFUSEFilesystem
 from .accesscontroller.dummy import DummyAccessController
+from .check import Checker
+from .compact import Compactor
+from .transfer import Importer, Exporter
+from .stats import parse_prometheus, diff
+from . import bench
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +79,35 @@ def main(args=None):
     if iridescence:
         iridescence.quick_setup(level=logging.DEBUG if args.get("--debug", True) else logging.INFO)
 
+    if args["stats"]:
+        # Copies of a mount's metrics file, compared to show what happened in between
+        values = parse_prometheus(pathlib.Path(args["<metrics>"]).read_text())
+        if args["<previous>"] is not None:
+            values = diff(parse_prometheus(pathlib.Path(args["<previous>"]).read_text()), values)
+        for series, value in sorted(values.items()):
+            if "_bucket{" not in series:
+                print(series, f"{value:g}")
+        return
+
+    if args["bench"] and args["compare"]:
+        old = json.loads(pathlib.Path(args["<old>"]).read_text())
+        new = json.loads(pathlib.Path(args["<new>"]).read_text())
+        changes = bench.compare(old, new, float(args["--threshold"]) / 100)
+        for name, (change, regression) in sorted(changes.items()):
+            print(f"{name}: {change:+.1%}{' REGRESSION' if regression else ''}")
+        if any(regression for _, regression in changes.values()):
+            sys.exit(1)
+        return
+
+    if args["bench"]:
+        names = [name for name in bench.BENCHMARKS if fnmatch.fnmatchcase(name, args["--filter"] or "*")]
+        text = json.dumps(bench.run_benchmarks(names, int(args["--repeat"])), indent=4, sort_keys=True)
+        if args["--output"]:
+            pathlib.Path(args["--output"]).write_text(text + "\n")
+        else:
+            print(text)
+        return
+
     if args["mount"]:
         if args["<accesscontroller>"] is None:
             accesscontroller = "mark1.Mark1AccessController"
@@ -41,135 +119,34 @@ def main(args=None):
     else:
         cls = DummyAccessController
 
-    fs = FUSEFilesystem(pathlib.Path(args["<fname>"]).absolute(), cls(), debug=args.get("--fuse-debug", False))
+    try:
+        options = mount_options(args)
+    except ValueError as e:
+        sys.exit(f"Invalid mount option: {e}")
+
+    snapshot = args.get("--snapshot")
+    fs_cls = LowLevelFUSEFilesystem if args.get("--lowlevel") else FUSEFilesystem
+    fs = fs_cls(pathlib.Path(args["<fname>"]).absolute(), cls(), debug=args.get("--fuse-debug", False),
+                snapshot=snapshot.encode() if snapshot else None, options=options)
 
     if args["mount"]:
         fs.mount(pathlib.Path(args["<path>"]).resolve())
 
     if args["check"]:
-        fs.init(object(), object())
-
-        with fs.blockfs.lock_file(write=True):
-            files_found = {fs.pathfs.ROOT_FILE_ID: ((), fs.pathfs.ROOT_FILE_ID)}
-            files_unchecked = {fs.pathfs.ROOT_FILE_ID}
-            used_blocks = {}
-            unused_blocks = set()
-
-            for i in itertools.count():
-                if i * fs.filefs.SUPERBLOCK_INTERVAL >= fs.blockfs.total_blocks():
-                    superblocks = i
-                    break
-                bitmap = fs.filefs.read_superblock(i)
-                for bid, used in enumerate(bitmap):
-                    block_id = bid + i * fs.filefs.SUPERBLOCK_INTERVAL
-                    if used:
-                        used_blocks[block_id] = None if bid else f"super {i}"
-                        if block_id >= fs.blockfs.total_blocks():
-                            print(f"Block {block_id} is marked as used but does not exist")
-                    elif not bid:
-                        print(f"Superblock {i} is not marked as used")
-                    else:
-                        if block_id < fs.blockfs.total_blocks():
-                            data = fs.blockfs.read_block(block_id)
-                            if data is not None:
-                                print(f"Block {block_id} is unused but contains data")
-                                if args["--fix-unused-data"]:
-                                    fs.blockfs.wipe_block(block_id)
-                                else:
-                                    print("Use --fix-unused-data")
-                            unused_blocks.add(block_id)
-
-            if fs.blockfs.total_blocks() != len(used_blocks) + len(unused_blocks):
-                print("Total blocks does not equal found blocks:",
-                      f"{fs.blockfs.total_blocks()} != {len(used_blocks)} + {len(unused_blocks)}")
-
-            while files_unchecked:
-                file_id = files_unchecked.pop()
-                try:
-                    _, header = fs.filefs.get_file_header(file_id, 0)
-                except:
-                    print("Corrupted file header for ", files_found[file_id][0],
-                          "file id", file_id)
-                    if args["--remove-corrupted"]:
-                        fs.pathfs.remove_directory_entry(files_found[file_id][1], files_found[file_id][0][-1])
-                        fs.filefs.deallocate_blocks([file_id])
-                    else:
-                        print("Use --remove-corrupted")
-                    continue
-                if args["--list-found"]:
-                    print("Found", files_found[file_id][0],
-                          "file id", file_id,
-                          "size", header.size,
-                          "blocks", fs.filefs.num_file_blocks(file_id))
-                if header.file_type == 1:
-                    for entry in fs.pathfs.directory_entries(file_id):
-                        files_found[entry.file_id] = files_found[file_id][0] + (entry.name,), file_id
-                        files_unchecked.add(entry.file_id)
-                        if entry.file_id not in used_blocks:
-                            print("Directory entry", files_found[entry.file_id][0], "does not point to a used block")
-                            if args["--fix-nonexistent-entry"]:
-                                fs.pathfs.remove_directory_entry(file_id, entry.name)
-                            else:
-                                print("Use --fix-nonexistent-entry")
-
-                header_num = 0
-                header_block_id = file_id
-                total_file_blocks = 0
-
-                while header_block_id:
-                    header = fs.filefs.read_file_header(file_id, header_num, header_block_id)
-                    total_file_blocks += len(header.block_ids) + 1
-                    for block_id in header.block_ids + [header_block_id]:
-                        if block_id not in used_blocks:
-                            if block_id > fs.blockfs.total_blocks():
-                                print("File", files_found[file_id][0], "points to block", block_id,
-                                      "but block does not exist")
-                            else:
-                                print("File", files_found[file_id][0], "points to block", block_id,
-                                      "but block is not marked as used")
-                                data = fs.blockfs.read_block(block_id)
-                                if data is None:
-                                    print("Block is empty")
-                                else:
-                                    print("Block data:", data[:100])
-                        else:
-                            data = fs.blockfs.read_block(block_id)
-                            if data is None:
-                                print("File", files_found[file_id][0], "points to block", block_id,
-                                      "but block is empty")
-                            used_blocks[block_id] = file_id
-
-                    header_num += 1
-                    header_block_id = header.next_header
-
-                if fs.filefs.num_file_blocks(file_id) != total_file_blocks:
-                    print("File blocks mismatch, has", total_file_blocks, "should be",
-                          fs.filefs.num_file_blocks(file_id))
-
-            for block_id, file_id in used_blocks.items():
-                if file_id is None:
-                    print("Block", block_id, "is marked as used but no file points to it")
-                    if args["--fix-unreferenced"]:
-                        bitmap = fs.filefs.read_superblock(block_id // fs.filefs.SUPERBLOCK_INTERVAL)
-                        bitmap[block_id % fs.filefs.SUPERBLOCK_INTERVAL] = False
-                        fs.filefs.write_superblock(block_id // fs.filefs.SUPERBLOCK_INTERVAL, bitmap)
-                        fs.blockfs.wipe_block(block_id)
-                    else:
-                        print("Use --fix-unreferenced")
-
-            print(f"Found {len(used_blocks)} used blocks")
-            print(f"Found {len(unused_blocks)} unused blocks")
-            print(f"Found {len(files_found)} files")
-            print(f"Found {superblocks} super blocks")
+        fs.open_filesystem()
+        workers = args["--workers"]
+        Checker(fs.pathfs, workers=int(workers) if workers else None, verify=args["--verify"],
+                fix_unreferenced=args["--fix-unreferenced"], fix_unused_data=args["--fix-unused-data"],
+                remove_corrupted=args["--remove-corrupted"], list_found=args["--list-found"],
+                fix_nonexistent_entry=args["--fix-nonexistent-entry"]).run()
 
     if args["prune"]:
-        fs.init(object(), object())
+        fs.open_filesystem()
 
         with fs.blockfs.lock_file(write=True) as f:
             last_used = 0
             for i in itertools.count():
                 if i * fs.filefs.SUPERBLOCK_INTERVAL >= fs.blockfs.total_blocks():
-                    superblocks = i
                     break
                 free = 0
                 bitmap = fs.filefs.read_superblock(i)
@@ -183,3 +160,68 @@ def main(args=None):
                 print(f"Superblock {i}: {free} free blocks")
             print(f"Last used block is {last_used}, pruning {fs.blockfs.total_blocks() - last_used + 1} blocks")
             f.truncate((last_used + 1) * fs.blockfs.PHYSICAL_BLOCK_SIZE + fs.blockfs.offset)
+
+    if args["import"]:
+        fs.open_filesystem()
+        workers = args["--workers"]
+        importer = Importer(fs.pathfs, workers=int(workers) if workers else None)
+        if args["<source>"] == "-":
+            importer.import_tar(sys.stdin.buffer)
+        else:
+            importer.import_tree(args["<source>"])
+
+    if args["export"]:
+        fs.open_filesystem()
+        workers = args["--workers"]
+        exporter = Exporter(fs.pathfs, workers=int(workers) if workers else None)
+        if args["<destination>"] == "-":
+            exporter.export_tar(sys.stdout.buffer)
+        else:
+            exporter.export_tree(args["<destination>"])
+
+    if args["rekey"]:
+        workers, rate = args["--workers"], args["--rate"]
+        fs.rekey(workers=int(workers) if workers else None, rate=float(rate) * 2 ** 20 if rate else None)
+
+    if args["compact"]:
+        fs.open_filesystem()
+        Compactor(fs.pathfs).run()
+
+    if args["snapshot"]:
+        fs.open_filesystem()
+
+        if args["<name>"] is None:
+            for name in fs.snapshots.names():
+                print(name.decode())
+        elif args["--delete"]:
+            try:
+                fs.snapshots.delete(args["<name>"].encode())
+            except FileNotFoundError:
+                print("Snapshot", args["<name>"], "does not exist")
+                return
+            print("Deleted snapshot", args["<name>"])
+        else:
+            try:
+                fs.snapshots.create(args["<name>"].encode())
+            except FileExistsError:
+                print("Snapshot", args["<name>"], "already exists")
+                return
+            print("Created snapshot", args["<name>"])
+
+
+def mount_options(args):
+    def optional(name, convert):
+        value = args.get(name)
+        return None if value is None else convert(value)
+
+    return MountOptions(kernel_cache=bool(args.get("--kernel-cache")),
+                        auto_cache=bool(args.get("--auto-cache")),
+                        writeback_cache=bool(args.get("--writeback-cache")),
+                        max_read=optional("--max-read", int),
+                        max_write=optional("--max-write", int),
+                        attr_timeout=optional("--attr-timeout", float),
+                        entry_timeout=optional("--entry-timeout", float),
+                        negative_timeout=optional("--negative-timeout", float),
+                        metrics=bool(args.get("--metrics")),
+                        metrics_file=args.get("--metrics-file"),
+                        profile_interval=optional("--profile-interval", float))
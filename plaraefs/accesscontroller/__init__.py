@@ -1,9 +1,98 @@
 import abc
+import attr
+import functools
+import os
+import time
+
+from ..utils import LRUDict
+
+
+@attr.s(slots=True)
+class Process:
+    pid = attr.ib()
+    # Clock ticks after boot, which tells a process apart from a later one given the same pid
+    start_time = attr.ib()
+    exe = attr.ib()
+    checked = attr.ib()
+
+
+def process_start_time(pid):
+    with open(f"/proc/{pid}/stat", "rb") as f:
+        data = f.read()
+    # The command name may contain spaces and parentheses, the fields after it don't
+    return int(data[data.rindex(b")") + 2:].split()[19])
+
+
+def cached_decision(func):
+    """
+    Caches a check's verdict for the calling process, so repeated checks (e.g. one per entry when listing a
+    directory) only run the check once. Decisions are forgotten after DECISION_TTL seconds, and whenever the
+    filesystem changes names or xattrs.
+    """
+    @functools.wraps(func)
+    def cd_wrapper(self, **kwargs):
+        uid, gid, _ = self.fs.process_info()
+        process = self.process()
+        if process.start_time is None:
+            return func(self, **kwargs)
+        key = process.pid, process.start_time, uid, gid, func.__name__, tuple(sorted(kwargs.items()))
+        now = time.monotonic()
+        decision = self.decisions.get(key)
+        if decision is not None and now - decision[1] < self.DECISION_TTL:
+            return decision[0]
+        verdict = func(self, **kwargs)
+        self.decisions[key] = verdict, now
+        return verdict
+    return cd_wrapper
 
 
 class AccessController(abc.ABC):
+    # Seconds a process' identity is trusted for before checking its pid hasn't been reused
+    IDENTITY_TTL = 0.5
+    DECISION_TTL = 1
+    IDENTITY_CACHE_SIZE = 256
+    DECISION_CACHE_SIZE = 4096
+
     def __init__(self):
         self.fs = None
+        self.processes = LRUDict(self.IDENTITY_CACHE_SIZE)
+        self.decisions = LRUDict(self.DECISION_CACHE_SIZE)
+
+    def process(self):
+        """
+        The process making the current request. Its executable is only looked up again if its pid now belongs to a
+        different process.
+        """
+        pid = self.fs.process_info()[2]
+        now = time.monotonic()
+        process = self.processes.get(pid)
+        if process is not None and now - process.checked < self.IDENTITY_TTL:
+            return process
+        try:
+            start_time = process_start_time(pid)
+            if process is not None and process.start_time == start_time:
+                process.checked = now
+                return process
+            process = Process(pid, start_time, os.readlink(f"/proc/{pid}/exe"), now)
+        except OSError:
+            # Already exited, or not visible to us
+            self.processes.pop(pid, None)
+            return Process(pid, None, None, now)
+        self.processes[pid] = process
+        return process
+
+    def forget_decisions(self):
+        self.decisions.clear()
+
+    def dir_lookup_many(self, dir, entries):
+        """
+        The entries (with name and file_id) of a directory being listed which may be looked up. Controllers which
+        can decide for a whole listing at once should override this and xattr_lookup_many.
+        """
+        return [entry for entry in entries if self.dir_lookup(dir=dir, name=entry.name, file=entry.file_id)]
+
+    def xattr_lookup_many(self, file, names):
+        return [name for name in names if self.xattr_lookup(file=file, name=name)]
 
     @abc.abstractmethod
     def file_read(self, file):
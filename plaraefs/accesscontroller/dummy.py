@@ -1,15 +1,16 @@
+import functools
 import logging
-import os
 
-from . import AccessController
+from . import AccessController, cached_decision
 
 logger = logging.getLogger(__name__)
 
 
 def wrapper(func):
+    @cached_decision
+    @functools.wraps(func)
     def w(self, **kwargs):
-        proc = os.readlink('/proc/{}/exe'.format(self.fs.process_info()[2]))
-        logger.debug(f"Access request from {proc}: {func.__name__}{kwargs}")
+        logger.debug(f"Access request from {self.process().exe}: {func.__name__}{kwargs}")
         ret = func(self, **kwargs)
         if not ret:
             logger.debug(f"Access denied")
@@ -18,6 +19,14 @@ def wrapper(func):
 
 
 class DummyAccessController(AccessController):
+    def dir_lookup_many(self, dir, entries):
+        logger.debug(f"Access request from {self.process().exe}: dir_lookup_many(dir={dir})")
+        return list(entries)
+
+    def xattr_lookup_many(self, file, names):
+        logger.debug(f"Access request from {self.process().exe}: xattr_lookup_many(file={file})")
+        return list(names)
+
     @wrapper
     def file_read(self, file):
         return True
@@ -0,0 +1,243 @@
+import contextlib
+import functools
+import pathlib
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from .blocklevelfilesystem import BlockLevelFilesystem
+from .filelevelfilesystem import FileLevelFilesystem
+from .pathlevelfilesystem import PathLevelFilesystem, DirectoryEntry, FileType
+
+# Each benchmark gets a new filesystem with the same key and random data, so runs can be compared
+KEY = bytes(range(32))
+SEED = 0
+# Operations timed per repetition, and entries in the directory benchmarks' directories
+OPS = 256
+DIRECTORY_SIZES = [10, 1000, 100000]
+
+BENCHMARKS = {}
+
+
+def benchmark(*params):
+    """
+    Registers a benchmark, once for each parameter. It is called with a new filesystem, a random number generator (and
+    the parameter), and returns the number of operations and a function doing them, which is what gets timed.
+    """
+    def register(func):
+        for param in params or [None]:
+            if param is None:
+                BENCHMARKS[func.__name__] = func
+            else:
+                BENCHMARKS[f"{func.__name__}[{param}]"] = functools.partial(func, param=param)
+        return func
+    return register
+
+
+@contextlib.contextmanager
+def filesystem():
+    with tempfile.TemporaryDirectory() as directory:
+        location = pathlib.Path(directory) / "bench.plaraefs"
+        BlockLevelFilesystem.initialise(location, KEY)
+        blockfs = BlockLevelFilesystem(location, KEY)
+        try:
+            FileLevelFilesystem.initialise(blockfs)
+            filefs = FileLevelFilesystem(blockfs)
+            PathLevelFilesystem.initialise(filefs)
+            yield PathLevelFilesystem(filefs)
+        finally:
+            blockfs.close()
+
+
+def random_bytes(rng, size):
+    return rng.getrandbits(size * 8).to_bytes(size, "little")
+
+
+@benchmark()
+def block_encrypt(fs, rng):
+    data = random_bytes(rng, fs.filefs.blockfs.LOGICAL_BLOCK_SIZE)
+
+    def run():
+        for _ in range(OPS):
+            fs.filefs.blockfs.encrypt_block(data)
+    return OPS, run
+
+
+@benchmark()
+def block_decrypt(fs, rng):
+    data = fs.filefs.blockfs.encrypt_block(random_bytes(rng, fs.filefs.blockfs.LOGICAL_BLOCK_SIZE))
+
+    def run():
+        for _ in range(OPS):
+            fs.filefs.blockfs.decrypt_block(data)
+    return OPS, run
+
+
+@benchmark()
+def block_write(fs, rng):
+    blockfs = fs.filefs.blockfs
+    block_ids = blockfs.new_blocks(OPS)
+    data = random_bytes(rng, blockfs.LOGICAL_BLOCK_SIZE)
+
+    def run():
+        for block_id in block_ids:
+            blockfs.write_block(block_id, 0, data)
+        blockfs.flush_writes()
+    return OPS, run
+
+
+@benchmark()
+def block_read(fs, rng):
+    blockfs = fs.filefs.blockfs
+    block_ids = blockfs.new_blocks(OPS)
+    for block_id in block_ids:
+        blockfs.write_block(block_id, 0, random_bytes(rng, blockfs.LOGICAL_BLOCK_SIZE))
+    blockfs.flush_writes()
+
+    def run():
+        # Cached blocks are only revalidated, which the file benchmarks cover
+        blockfs.block_cache.clear()
+        for block_id in block_ids:
+            blockfs.read_block(block_id)
+    return OPS, run
+
+
+@benchmark()
+def file_allocate_blocks(fs, rng):
+    def run():
+        for _ in range(OPS):
+            fs.filefs.allocate_blocks(1)
+    return OPS, run
+
+
+def file_offsets(fs, rng, sequential):
+    size = fs.filefs.blockfs.LOGICAL_BLOCK_SIZE
+    if sequential:
+        return [i * size for i in range(OPS)]
+    return [rng.randrange(OPS) * size for _ in range(OPS)]
+
+
+@benchmark("sequential", "random")
+def file_write(fs, rng, param):
+    size = fs.filefs.blockfs.LOGICAL_BLOCK_SIZE
+    file_id = fs.filefs.create_new_file(FileType.file.value)
+    # Writes overwrite existing data, as appending is mostly allocation
+    fs.filefs.write(file_id, random_bytes(rng, OPS * size))
+    data = random_bytes(rng, size)
+    offsets = file_offsets(fs, rng, param == "sequential")
+
+    def run():
+        for offset in offsets:
+            fs.filefs.write(file_id, data, offset)
+        fs.filefs.blockfs.flush_writes()
+    return OPS, run
+
+
+@benchmark("sequential", "random")
+def file_read(fs, rng, param):
+    size = fs.filefs.blockfs.LOGICAL_BLOCK_SIZE
+    file_id = fs.filefs.create_new_file(FileType.file.value)
+    fs.filefs.write(file_id, random_bytes(rng, OPS * size))
+    fs.filefs.blockfs.flush_writes()
+    offsets = file_offsets(fs, rng, param == "sequential")
+
+    def run():
+        fs.filefs.blockfs.block_cache.clear()
+        for offset in offsets:
+            fs.filefs.read(file_id, size, offset)
+    return OPS, run
+
+
+def directory(fs, entries):
+    dir_id = fs.filefs.create_new_file(FileType.dir.value)
+    for i in range(entries):
+        fs.add_directory_entry(dir_id, DirectoryEntry(b"%08d" % i, fs.ROOT_FILE_ID))
+    return dir_id
+
+
+@benchmark(*DIRECTORY_SIZES)
+def path_add_directory_entry(fs, rng, param):
+    dir_id = directory(fs, param)
+    names = (b"new%08d" % i for i in range(sys.maxsize))
+
+    def run():
+        for _ in range(OPS):
+            fs.add_directory_entry(dir_id, DirectoryEntry(next(names), fs.ROOT_FILE_ID))
+    return OPS, run
+
+
+@benchmark(*DIRECTORY_SIZES)
+def path_search_directory(fs, rng, param):
+    dir_id = directory(fs, param)
+    names = [b"%08d" % rng.randrange(param) for _ in range(OPS)]
+
+    def run():
+        # Starts with nothing cached, so includes decoding the nodes on the way to each leaf once
+        fs.node_cache.clear()
+        for name in names:
+            fs.search_directory(dir_id, name)
+    return OPS, run
+
+
+@benchmark()
+def xattr_set(fs, rng):
+    file_id = fs.filefs.create_new_file(FileType.file.value)
+    values = [random_bytes(rng, rng.randrange(1, 200)) for _ in range(OPS)]
+
+    def run():
+        for i, value in enumerate(values):
+            fs.filefs.set_xattr(file_id, b"user.%d" % (i % 32), value)
+    return OPS, run
+
+
+@benchmark()
+def xattr_read(fs, rng):
+    file_id = fs.filefs.create_new_file(FileType.file.value)
+    for i in range(32):
+        fs.filefs.set_xattr(file_id, b"user.%d" % i, random_bytes(rng, 100))
+
+    def run():
+        for _ in range(OPS):
+            fs.filefs.xattr_cache.clear()
+            fs.filefs.read_xattrs(file_id)
+    return OPS, run
+
+
+def run_benchmarks(names, repeat, progress=sys.stderr):
+    """
+    Runs the named benchmarks, returning the best and median seconds per operation of each, along with what they ran
+    on.
+    """
+    results = {}
+    for name in names:
+        with filesystem() as fs:
+            ops, run = BENCHMARKS[name](fs, random.Random(SEED))
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run()
+                times.append((time.perf_counter() - start) / ops)
+        results[name] = {"ops": ops, "repeat": repeat, "best": min(times), "median": statistics.median(times)}
+        if progress is not None:
+            print(f"{name}: {min(times) * 1e6:.1f}us per operation", file=progress)
+    return {
+        "python": f"{platform.python_implementation()} {platform.python_version()}",
+        "machine": platform.machine(),
+        "benchmarks": results,
+    }
+
+
+def compare(old, new, threshold):
+    """
+    The change in the best time of each benchmark in both runs, and whether it is slower by more than threshold (a
+    fraction).
+    """
+    changes = {}
+    for name, result in new["benchmarks"].items():
+        if name in old["benchmarks"]:
+            change = result["best"] / old["benchmarks"][name]["best"] - 1
+            changes[name] = change, change > threshold
+    return changes
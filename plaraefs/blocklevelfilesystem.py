@@ -2,12 +2,15 @@ import contextlib
 import os
 import pathlib
 import threading
+import time
 
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 from . import locking
-from .utils import check_types, LRUDict
+from .stats import Stats
+from .utils import check_types, LRUDict, RWLock
 
 
 class BlockLevelFilesystem:
@@ -22,14 +25,19 @@ class BlockLevelFilesystem:
     FS_EXT = ".plaraefs"
     BLOCK_ID_SIZE = 8
 
-    __slots__ = ["lock", "key", "offset", "fname", "_file", "backend", "block_reads",
-                 "block_writes", "lock_file_locked", "lock_file_locked_write", "block_cache",
-                 "unflushed_writes", "locked_tokens"]
+    __slots__ = ["rwlock", "state_lock", "key", "old_key", "offset", "fname", "_file", "backend", "stats",
+                 "lock_file_locked", "lock_file_locked_write", "lock_generation", "block_cache", "unflushed_writes",
+                 "locked_tokens", "before_write"]
 
     @check_types
-    def __init__(self, fname, key: bytes, offset: int=0):
-        self.lock = threading.RLock()
+    def __init__(self, fname, key: bytes, offset: int=0, old_key=None):
+        # Operations which only read run concurrently and writes are exclusive, both within the process and,
+        # through fcntl locks, with other processes. state_lock guards what concurrent readers update.
+        self.rwlock = RWLock(self.acquire_file_lock, self.release_file_lock)
+        self.state_lock = threading.Lock()
         self.key = key
+        # While changing keys, blocks which haven't been re-encrypted yet are still readable with the old key
+        self.old_key = old_key
         self.offset = offset
         assert len(self.key) == self.KEY_SIZE
 
@@ -39,13 +47,18 @@ class BlockLevelFilesystem:
         self._file = open(str(self.fname), "r+b", 0)
 
         self.backend = default_backend()
-        self.block_reads = self.block_writes = 0
+        # Shared with the layers above, which report their caches into it too
+        self.stats = Stats()
         self.lock_file_locked = False
         self.lock_file_locked_write = False
+        # Changes each time the file lock is taken, so what other processes may change can be checked once per lock
+        self.lock_generation = 0
 
         self.block_cache = LRUDict(2048)
         self.unflushed_writes = {}
         self.locked_tokens = set()
+        # Called with a block id before the block is written or wiped, with the write lock held, for snapshots
+        self.before_write = None
 
     @classmethod
     @check_types
@@ -56,27 +69,53 @@ class BlockLevelFilesystem:
         with open(str(fname), "xb") as f:
             f.write(b"\0" * offset)
 
+    @property
+    def block_reads(self):
+        return self.stats["block_reads"]
+
+    @property
+    def block_writes(self):
+        return self.stats["block_writes"]
+
     @contextlib.contextmanager
     def lock_file(self, write):
-        with self.lock:
-            if self.lock_file_locked_write or not write and self.lock_file_locked:
-                yield self._file
-                return
-            if self.lock_file_locked:
-                raise RuntimeError("File locked in wrong mode, locked for read and need lock for write")
-            try:
-                locking.lock_file(self._file, write)
-                self.lock_file_locked = True
-                self.lock_file_locked_write = write
-                yield self._file
-            finally:
-                if write:
-                    self.flush_writes()
-                    self._file.flush()
-                locking.unlock_file(self._file)
-                self.lock_file_locked = False
-                self.lock_file_locked_write = False
-                self.locked_tokens.clear()
+        with self.rwlock.write() if write else self.rwlock.read():
+            yield self._file
+
+    def acquire_file_lock(self, write):
+        t = time.perf_counter()
+        locking.lock_file(self._file, write)
+        self.stats.add("fcntl_lock_wait_seconds", time.perf_counter() - t)
+        self.stats.add("fcntl_locks")
+        self.lock_file_locked = True
+        self.lock_file_locked_write = write
+        self.lock_generation += 1
+
+    def release_file_lock(self, write):
+        try:
+            if write:
+                self.flush_writes()
+                self._file.flush()
+        finally:
+            locking.unlock_file(self._file)
+            self.lock_file_locked = False
+            self.lock_file_locked_write = False
+            self.locked_tokens.clear()
+
+    def claim(self, exclusive):
+        # Mounts share a claim on the file, and what can't run alongside one takes it exclusively, False if it can't
+        return locking.claim_file(self._file, exclusive)
+
+    def unclaim(self):
+        locking.unclaim_file(self._file)
+
+    def read_at(self, start, size):
+        # Readers share the file, so they can't rely on its position
+        if hasattr(os, "pread"):
+            return os.pread(self._file.fileno(), size, start)
+        with self.state_lock:  # pragma: no cover
+            self._file.seek(start)
+            return self._file.read(size)
 
     def new_token(self):
         iv = self.UNINITALISED_IV
@@ -90,10 +129,13 @@ class BlockLevelFilesystem:
 
         if iv is None:
             iv = self.new_token()
+        t = time.perf_counter()
         cipher = Cipher(algorithms.AES(self.key), modes.GCM(iv), backend=self.backend)
         encryptor = cipher.encryptor()
         ciphertext = encryptor.update(plaintext) + encryptor.finalize()
         ciphertext = b"".join((iv, ciphertext, encryptor.tag))
+        self.stats.add("encrypt_seconds", time.perf_counter() - t)
+        self.stats.add("bytes_encrypted", len(plaintext))
 
         assert len(ciphertext) == self.PHYSICAL_BLOCK_SIZE
         return ciphertext
@@ -106,13 +148,32 @@ class BlockLevelFilesystem:
                                ciphertext[self.IV_SIZE:-self.TAG_SIZE],
                                ciphertext[-self.TAG_SIZE:])
 
-        cipher = Cipher(algorithms.AES(self.key), modes.GCM(iv, tag), backend=self.backend)
-        decryptor = cipher.decryptor()
-        plaintext = decryptor.update(ciphertext) + decryptor.finalize()
+        t = time.perf_counter()
+        try:
+            plaintext = self.decrypt_with(self.key, iv, ciphertext, tag)
+        except InvalidTag:
+            if self.old_key is None:
+                raise
+            plaintext = self.decrypt_with(self.old_key, iv, ciphertext, tag)
+            self.stats.add("old_key_decrypts")
+        self.stats.add("decrypt_seconds", time.perf_counter() - t)
+        self.stats.add("bytes_decrypted", len(plaintext))
 
         assert len(plaintext) == self.LOGICAL_BLOCK_SIZE
         return plaintext
 
+    def decrypt_with(self, key, iv, ciphertext, tag):
+        decryptor = Cipher(algorithms.AES(key), modes.GCM(iv, tag), backend=self.backend).decryptor()
+        return decryptor.update(ciphertext) + decryptor.finalize()
+
+    @check_types
+    def reencrypt_block(self, ciphertext: bytes):
+        # Encrypted with the current key, keeping the IV so the block's token doesn't change. Reusing an IV is safe as
+        # it was used with another key, or, if the block already uses this key, gives the same ciphertext again.
+        if ciphertext[:self.IV_SIZE] == self.UNINITALISED_IV:
+            return ciphertext
+        return self.encrypt_block(self.decrypt_block(ciphertext), iv=ciphertext[:self.IV_SIZE])
+
     @check_types
     def block_start(self, block_id: int):
         return block_id * self.PHYSICAL_BLOCK_SIZE + self.offset
@@ -127,23 +188,23 @@ class BlockLevelFilesystem:
     def new_blocks(self, number):
         if not number:
             return []
-        total_blocks = self.total_blocks()
-        new_block_ids = list(range(total_blocks, total_blocks + number))
         with self.lock_file(write=True) as f:
+            total_blocks = self.total_blocks()
+            new_block_ids = list(range(total_blocks, total_blocks + number))
             f.seek(self.block_start(total_blocks))
             written = f.write(b"\0" * (self.PHYSICAL_BLOCK_SIZE * number))
+            self.stats.add("block_writes", number)
 
         assert written == self.PHYSICAL_BLOCK_SIZE * number
-        self.block_writes += number
         return new_block_ids
 
     @check_types
     def remove_blocks(self, number):
-        total_blocks = self.total_blocks()
-        assert number <= total_blocks
-
-        new_total_blocks = total_blocks - number
         with self.lock_file(write=True) as f:
+            total_blocks = self.total_blocks()
+            assert number <= total_blocks
+
+            new_total_blocks = total_blocks - number
             for block_id in range(new_total_blocks, total_blocks):
                 self.unflushed_writes.pop(block_id, None)
             f.truncate(self.block_start(new_total_blocks))
@@ -152,32 +213,31 @@ class BlockLevelFilesystem:
     def read_block(self, block_id: int, with_token: bool=False):
         # return None if the block is not initialised
         cache_data, cache_token = self.unflushed_writes.get(block_id, self.block_cache.get(block_id, (None, None)))
-        if self.lock_file_locked and cache_token in self.locked_tokens:
-            if cache_data is None:
-                print("A")
+        if self.rwlock.held() and cache_token in self.locked_tokens:
+            self.stats.cache("block_cache", True)
             return (cache_data, cache_token) if with_token else cache_data
 
         assert block_id < self.total_blocks()
-        with self.lock:
-            with self.lock_file(write=False) as f:
-                f.seek(self.block_start(block_id))
-                token = f.read(self.IV_SIZE)
-                if token == self.UNINITALISED_IV:
-                    return None
-                elif token == cache_token:
-                    if cache_data is None:
-                        print("B")
-                    return (cache_data, cache_token) if with_token else cache_data
-                cipher_data = token + f.read(self.PHYSICAL_BLOCK_SIZE - self.IV_SIZE)
+        with self.lock_file(write=False):
+            start = self.block_start(block_id)
+            token = self.read_at(start, self.IV_SIZE)
+            self.stats.add("iv_reads")
+            if token == self.UNINITALISED_IV:
+                return None
+            elif token == cache_token:
+                # Still valid, but it cost a read to find out
+                self.stats.cache("block_cache", True)
+                self.stats.add("block_cache_revalidations")
+                return (cache_data, cache_token) if with_token else cache_data
+            self.stats.cache("block_cache", False)
+            cipher_data = token + self.read_at(start + self.IV_SIZE, self.PHYSICAL_BLOCK_SIZE - self.IV_SIZE)
 
             plain_data = self.decrypt_block(cipher_data)
 
             self.block_cache[block_id] = plain_data, token
-            if self.lock_file_locked:
+            with self.state_lock:
                 self.locked_tokens.add(token)
-        self.block_reads += 1
-        if plain_data is None:
-            print("A")
+            self.stats.add("block_reads")
         return (plain_data, token) if with_token else plain_data
 
     def flush_writes(self, only=None):
@@ -189,10 +249,13 @@ class BlockLevelFilesystem:
                 cipher_data = self.encrypt_block(data, iv=token)
                 f.seek(self.block_start(block_id))
                 f.write(cipher_data)
-                self.block_writes += 1
                 rms.append(block_id)
             for r in rms:
                 del self.unflushed_writes[r]
+            if rms:
+                self.stats.add("block_writes", len(rms))
+                self.stats.add("flushes")
+                self.stats.add("flushed_blocks", len(rms))
 
     @check_types
     def write_block(self, block_id: int, offset: int, data: bytes, with_token: bool=False):
@@ -202,7 +265,8 @@ class BlockLevelFilesystem:
         if len(data) != self.LOGICAL_BLOCK_SIZE:
             new_token = self.new_token()
             data_from_end = self.LOGICAL_BLOCK_SIZE - offset - len(data)
-            with self.lock_file(write=True) as f:
+            with self.lock_file(write=True):
+                self.preserve(block_id)
                 old_data = self.read_block(block_id)
                 if old_data is None:
                     data_to_write = b"".join((b"\0" * offset, data, b"\0" * data_from_end))
@@ -216,21 +280,43 @@ class BlockLevelFilesystem:
                     return new_token
                 return
 
-        cipher_data = self.encrypt_block(data)
+        token = self.write_encrypted_block(block_id, data, self.encrypt_block(data))
+        if with_token:
+            return token
 
-        with self.lock:
-            with self.lock_file(write=True) as f:
-                f.seek(self.block_start(block_id))
-                f.write(cipher_data)
+    @check_types
+    def write_encrypted_block(self, block_id: int, data: bytes, cipher_data: bytes):
+        # A whole block encrypted ahead of time, for example by another thread
+        assert block_id < self.total_blocks()
+        with self.lock_file(write=True) as f:
+            self.preserve(block_id)
+            # Replaces any partial write still waiting to be flushed
+            self.unflushed_writes.pop(block_id, None)
+            f.seek(self.block_start(block_id))
+            f.write(cipher_data)
 
             token = cipher_data[:self.IV_SIZE]
             self.block_cache[block_id] = data, token
             self.locked_tokens.add(token)
+            self.stats.add("block_writes")
+        return token
 
-        self.block_writes += 1
+    @check_types
+    def write_raw_block(self, block_id: int, cipher_data: bytes):
+        # Ciphertext as read from another block, so it keeps that block's token
+        assert block_id < self.total_blocks()
+        assert len(cipher_data) == self.PHYSICAL_BLOCK_SIZE
+        with self.lock_file(write=True) as f:
+            self.preserve(block_id)
+            self.unflushed_writes.pop(block_id, None)
+            f.seek(self.block_start(block_id))
+            f.write(cipher_data)
+            self.block_cache.pop(block_id, None)
+            self.stats.add("block_writes")
 
-        if with_token:
-            return token
+    def preserve(self, block_id):
+        if self.before_write is not None:
+            self.before_write(block_id)
 
     @check_types
     def swap_blocks(self, block_id1: int, block_id2: int):
@@ -240,52 +326,60 @@ class BlockLevelFilesystem:
         if block_id1 == block_id2:
             return
 
-        with self.lock:
+        with self.lock_file(write=True) as f:
+            self.preserve(block_id1)
+            self.preserve(block_id2)
             self.flush_writes([block_id1, block_id2])
-            with self.lock_file(write=True) as f:
-                f.seek(self.block_start(block_id1))
-                block_1_data = f.read(self.PHYSICAL_BLOCK_SIZE)
-                f.seek(self.block_start(block_id2))
-                block_2_data = f.read(self.PHYSICAL_BLOCK_SIZE)
-
-                f.seek(self.block_start(block_id1))
-                f.write(block_2_data)
-                f.seek(self.block_start(block_id2))
-                f.write(block_1_data)
-
-            (self.block_cache[block_id1],
-             self.block_cache[block_id2]) = (self.block_cache[block_id2],
-                                             self.block_cache[block_id1])
-        self.block_writes += 2
+            f.seek(self.block_start(block_id1))
+            block_1_data = f.read(self.PHYSICAL_BLOCK_SIZE)
+            f.seek(self.block_start(block_id2))
+            block_2_data = f.read(self.PHYSICAL_BLOCK_SIZE)
+
+            f.seek(self.block_start(block_id1))
+            f.write(block_2_data)
+            f.seek(self.block_start(block_id2))
+            f.write(block_1_data)
+
+            # Either block may not be cached, in which case the other isn't afterwards
+            cache1 = self.block_cache.pop(block_id1, None)
+            cache2 = self.block_cache.pop(block_id2, None)
+            if cache2 is not None:
+                self.block_cache[block_id1] = cache2
+            if cache1 is not None:
+                self.block_cache[block_id2] = cache1
+            self.stats.add("block_writes", 2)
 
     @check_types
     def wipe_block(self, block_id: int):
         assert block_id < self.total_blocks()
-        with self.lock:
+        with self.lock_file(write=True) as f:
+            self.preserve(block_id)
             self.unflushed_writes.pop(block_id, None)
-            with self.lock_file(write=True) as f:
-                f.seek(self.block_start(block_id))
-                f.write(b"\0" * self.PHYSICAL_BLOCK_SIZE)
+            f.seek(self.block_start(block_id))
+            f.write(b"\0" * self.PHYSICAL_BLOCK_SIZE)
 
             self.block_cache[block_id] = None, self.UNINITALISED_IV
-        self.block_writes += 1
+            self.stats.add("block_writes")
 
     @check_types
     def block_version(self, block_id: int, old_version: bytes=b""):
-        if self.lock_file_locked and old_version in self.locked_tokens:
+        if self.rwlock.held() and old_version in self.locked_tokens:
             return False, old_version
 
         assert block_id < self.total_blocks()
 
-        with self.lock:
-            with self.lock_file(False) as f:
-                f.seek(self.block_start(block_id))
-                iv = f.read(self.IV_SIZE)
-
-            if self.lock_file_locked:
+        with self.lock_file(False):
+            iv = self.read_at(self.block_start(block_id), self.IV_SIZE)
+            self.stats.add("iv_reads")
+            with self.state_lock:
                 self.locked_tokens.add(iv)
 
-            return old_version != iv, iv
+        return old_version != iv, iv
+
+    def sync(self):
+        with self.lock_file(write=True) as f:
+            self.flush_writes()
+            os.fsync(f.fileno())
 
     def close(self):
         self._file.flush()
@@ -0,0 +1,345 @@
+import collections
+import concurrent.futures
+import functools
+import os
+import sys
+import time
+
+from .pathlevelfilesystem import PathLevelFilesystem, FileType
+from .snapshot import Snapshots
+from .utils import BitArray, Bitmap
+
+
+class Checker:
+    """
+    Checks that the superblocks, files and reference counts of a filesystem agree, optionally fixing what it can.
+
+    Block maps are bitmaps, so memory grows with the size of the filesystem by a couple of bits per block. Unused
+    blocks are checked by reading just their IVs. With verify, every data block is also decrypted to check its tag, in
+    a pool of worker threads which is fed a bounded number of tasks at a time.
+    """
+
+    # Blocks handled per task, tasks queued per worker, and seconds between progress reports
+    CHUNK_BLOCKS = 256
+    QUEUED_PER_WORKER = 4
+    PROGRESS_INTERVAL = 5
+
+    def __init__(self, pathfs: PathLevelFilesystem, workers=None, verify=False, fix_unreferenced=False,
+                 fix_unused_data=False, remove_corrupted=False, list_found=False, fix_nonexistent_entry=False,
+                 progress=sys.stderr):
+        self.pathfs = pathfs
+        self.filefs = pathfs.filefs
+        self.blockfs = pathfs.filefs.blockfs
+        self.workers = workers or os.cpu_count() or 1
+        self.verify = verify
+        self.fix_unreferenced = fix_unreferenced
+        self.fix_unused_data = fix_unused_data
+        self.remove_corrupted = remove_corrupted
+        self.list_found = list_found
+        self.fix_nonexistent_entry = fix_nonexistent_entry
+        self.progress = progress
+
+        self.pool = None
+        self.pending = collections.deque()
+        # Blocks marked as used in the superblocks, and those something points to
+        self.marked = Bitmap()
+        self.referenced = Bitmap()
+        # References to data blocks seen more than once, which should have a reference count
+        self.shared = collections.Counter()
+        # Parent and name of each directory, for naming files in messages
+        self.directories = {}
+        self.total_blocks = self.superblocks = self.files = self.problems = 0
+        self.bytes_read = 0
+        self.started = self.last_progress = 0
+
+    def run(self):
+        self.started = self.last_progress = time.monotonic()
+        block_reads = self.blockfs.stats["block_reads"]
+        with self.blockfs.lock_file(write=True):
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as self.pool:
+                self.check_superblocks()
+                self.check_files()
+                self.drain()
+            self.check_references()
+            self.check_snapshots()
+            self.check_unreferenced()
+
+        elapsed = time.monotonic() - self.started
+        self.bytes_read += (self.blockfs.stats["block_reads"] - block_reads) * self.blockfs.PHYSICAL_BLOCK_SIZE
+        print(f"Found {self.marked.count()} used blocks")
+        print(f"Found {self.total_blocks - self.marked.count(self.total_blocks)} unused blocks")
+        print(f"Found {self.files} files")
+        print(f"Found {self.superblocks} super blocks")
+        print(f"Checked in {elapsed:.1f} seconds, reading {self.bytes_read / 2 ** 20:.1f}MiB "
+              f"({self.bytes_read / 2 ** 20 / max(elapsed, 1e-9):.1f}MiB/s)")
+        return self.problems
+
+    def problem(self, *message):
+        self.problems += 1
+        print(*message)
+
+    def report_progress(self, phase, done, total=None):
+        now = time.monotonic()
+        if self.progress is None or now - self.last_progress < self.PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        rate = self.bytes_read / 2 ** 20 / (now - self.started)
+        print(f"{phase}: {done}{'' if total is None else f'/{total}'} ({rate:.1f}MiB/s)", file=self.progress)
+
+    def submit(self, handle, func, *args):
+        # Results are handled on this thread in the order submitted, and only a few tasks wait at once
+        self.pending.append((self.pool.submit(func, *args), handle))
+        while len(self.pending) > self.workers * self.QUEUED_PER_WORKER:
+            self.finish_task()
+
+    def finish_task(self):
+        future, handle = self.pending.popleft()
+        size, result = future.result()
+        self.bytes_read += size
+        handle(result)
+
+    def drain(self):
+        while self.pending:
+            self.finish_task()
+
+    def check_superblocks(self):
+        self.total_blocks = self.blockfs.total_blocks()
+        self.superblocks = -(-self.total_blocks // self.filefs.SUPERBLOCK_INTERVAL)
+        for i in range(self.superblocks):
+            self.marked.data.extend(self.filefs.read_superblock(i).data)
+            block_id = i * self.filefs.SUPERBLOCK_INTERVAL
+            self.referenced.set(block_id)
+            if not self.marked[block_id]:
+                self.problem(f"Superblock {i} is not marked as used")
+
+        for block_id in range(self.total_blocks, len(self.marked.data) * 8):
+            if self.marked[block_id]:
+                self.problem(f"Block {block_id} is marked as used but does not exist")
+
+        for start, length in BitArray(self.marked.data).free_runs():
+            length = min(start + length, self.total_blocks) - start
+            for chunk_start in range(start, start + length, self.CHUNK_BLOCKS):
+                chunk_length = min(self.CHUNK_BLOCKS, start + length - chunk_start)
+                self.submit(self.report_unused_data, self.probe_unused, chunk_start, chunk_length)
+                self.report_progress("Checking unused blocks", chunk_start, self.total_blocks)
+
+    def probe_unused(self, start, length):
+        # Unused blocks should be wiped, which only needs their IVs to tell
+        size = self.blockfs.PHYSICAL_BLOCK_SIZE
+        data = self.blockfs.read_at(self.blockfs.block_start(start), length * size)
+        return len(data), [start + i for i in range(length)
+                           if data[i * size:i * size + self.blockfs.IV_SIZE] != self.blockfs.UNINITALISED_IV]
+
+    def report_unused_data(self, block_ids):
+        for block_id in block_ids:
+            self.problem(f"Block {block_id} is unused but contains data")
+            if self.fix_unused_data:
+                self.blockfs.wipe_block(block_id)
+            else:
+                print("Use --fix-unused-data")
+
+    def path(self, parent, name):
+        names = [name]
+        while parent is not None:
+            parent, name = self.directories[parent]
+            names.append(name)
+        return os.fsdecode(b"/".join(reversed(names)) or b"/")
+
+    def check_files(self):
+        stack = [(self.pathfs.SYSTEM_FILE_ID, self.pathfs.ROOT_FILE_ID, b"<system>"),
+                 (self.pathfs.ROOT_FILE_ID, None, b"")]
+        while stack:
+            self.check_file(stack, *stack.pop())
+            self.report_progress("Checking files", self.files)
+
+    def check_file(self, stack, file_id, parent, name):
+        path = self.path(parent, name)
+        if self.referenced[file_id]:
+            self.problem("File", path, "has header block", file_id, "which is already in use")
+            return
+        try:
+            _, header = self.filefs.get_file_header(file_id, 0)
+        except Exception:
+            self.problem("Corrupted file header for", path, "file id", file_id)
+            if self.remove_corrupted:
+                self.pathfs.remove_directory_entry(parent, name)
+                self.filefs.deallocate_blocks([file_id])
+            else:
+                print("Use --remove-corrupted")
+            return
+        self.files += 1
+        if self.list_found:
+            print("Found", path, "file id", file_id, "size", header.size,
+                  "blocks", self.filefs.num_file_blocks(file_id))
+
+        if header.file_type == FileType.dir.value:
+            self.directories[file_id] = parent, name
+            missing = []
+            for entry in self.pathfs.directory_entries(file_id):
+                if self.marked[entry.file_id]:
+                    stack.append((entry.file_id, file_id, entry.name))
+                else:
+                    self.problem("Directory entry", self.path(file_id, entry.name), "does not point to a used block")
+                    missing.append(entry.name)
+            # Removed once the listing is done, as removing changes the nodes being read
+            for entry_name in missing:
+                if self.fix_nonexistent_entry:
+                    self.pathfs.remove_directory_entry(file_id, entry_name)
+                else:
+                    print("Use --fix-nonexistent-entry")
+
+        xattr_block = header.xattr_block
+        while xattr_block:
+            self.check_block(path, xattr_block)
+            self.referenced.set(xattr_block)
+            data = self.blockfs.read_block(xattr_block)
+            if data is None:
+                self.problem("File", path, "points to xattr block", xattr_block, "but block is empty")
+                break
+            xattr_block, _ = self.filefs.unpack_xattr_block(data)
+
+        header_num = 0
+        header_block_id = file_id
+        to_verify = []
+        while header_block_id:
+            try:
+                header = self.filefs.read_file_header(file_id, header_num, header_block_id)
+            except Exception:
+                self.problem("File", path, "has a corrupted header block", header_block_id)
+                break
+            self.check_block(path, header_block_id)
+            self.referenced.set(header_block_id)
+            for block_id in header.block_ids:
+                if not block_id:
+                    # Hole in a sparse file
+                    continue
+                self.check_block(path, block_id)
+                if self.referenced[block_id]:
+                    self.shared[block_id] = self.shared.get(block_id, 1) + 1
+                else:
+                    self.referenced.set(block_id)
+                if self.verify:
+                    to_verify.append(block_id)
+                    if len(to_verify) == self.CHUNK_BLOCKS:
+                        self.submit(functools.partial(self.report_unverified, path), self.verify_blocks, to_verify)
+                        to_verify = []
+            header_num += 1
+            header_block_id = header.next_header
+        else:
+            total_file_blocks = (header_num - 1) * self.filefs.FILE_HEADER_INTERVAL + len(header.block_ids) + 1
+            if self.filefs.num_file_blocks(file_id) != total_file_blocks:
+                self.problem("File blocks mismatch, has", total_file_blocks, "should be",
+                             self.filefs.num_file_blocks(file_id))
+        if to_verify:
+            self.submit(functools.partial(self.report_unverified, path), self.verify_blocks, to_verify)
+
+    def check_block(self, path, block_id):
+        if self.marked[block_id]:
+            return
+        if block_id >= self.total_blocks:
+            self.problem("File", path, "points to block", block_id, "but block does not exist")
+            return
+        self.problem("File", path, "points to block", block_id, "but block is not marked as used")
+        data = self.blockfs.read_block(block_id)
+        if data is None:
+            print("Block is empty")
+        else:
+            print("Block data:", data[:100])
+
+    def verify_blocks(self, block_ids):
+        bad = []
+        size = 0
+        for block_id in block_ids:
+            if block_id >= self.total_blocks:
+                continue
+            data = self.blockfs.read_at(self.blockfs.block_start(block_id), self.blockfs.PHYSICAL_BLOCK_SIZE)
+            size += len(data)
+            # Allocated but never written
+            if data[:self.blockfs.IV_SIZE] == self.blockfs.UNINITALISED_IV:
+                continue
+            try:
+                self.blockfs.decrypt_block(data)
+            except Exception:
+                bad.append(block_id)
+        return size, bad
+
+    def report_unverified(self, path, block_ids):
+        for block_id in block_ids:
+            self.problem("File", path, "has block", block_id, "which fails verification")
+
+    def check_unreferenced(self):
+        # Compared a megabyte of each bitmap at a time as integers, only looking at the bytes which differ
+        step = 2 ** 20
+        end = -(-self.total_blocks // 8)
+        for start in range(0, end, step):
+            marked = self.marked.data[start:min(start + step, end)]
+            referenced = self.referenced.data[start:start + len(marked)].ljust(len(marked), b"\0")
+            unreferenced = int.from_bytes(marked, "big") & ~int.from_bytes(referenced, "big")
+            if not unreferenced:
+                continue
+            for i, byte in enumerate(unreferenced.to_bytes(len(marked), "big")):
+                for j in range(8):
+                    block_id = (start + i) * 8 + j
+                    if byte & (128 >> j) and block_id < self.total_blocks:
+                        self.unreferenced(block_id)
+
+    def unreferenced(self, block_id):
+        self.problem("Block", block_id, "is marked as used but no file points to it")
+        if self.fix_unreferenced:
+            self.filefs.mark_blocks([block_id], False)
+            self.blockfs.wipe_block(block_id)
+        else:
+            print("Use --fix-unreferenced")
+
+    def check_references(self):
+        # Run before check_unreferenced, as the table blocks holding the counts are only referenced from here
+        counted = set()
+        path = self.path(self.pathfs.SYSTEM_FILE_ID, self.pathfs.REFCOUNTS)
+        for first, table_block in self.filefs.refcount_table_blocks():
+            self.check_block(path, table_block)
+            if self.referenced[table_block]:
+                self.problem("Refcount table block", table_block, "is already in use")
+                continue
+            self.referenced.set(table_block)
+            data = self.blockfs.read_block(table_block)
+            if data is None:
+                self.problem("Refcount table block", table_block, "is empty")
+                continue
+            for block_id, count in enumerate(self.filefs.unpack_refcounts(data), first):
+                if count:
+                    counted.add(block_id)
+                    self.check_references_to(block_id, count)
+        for block_id in self.shared.keys() - counted:
+            self.check_references_to(block_id, 0)
+
+    def check_snapshots(self):
+        # Also before check_unreferenced, for the table blocks and copies. A copy may be shared by several snapshots.
+        snapshots = Snapshots(self.pathfs, preserve=False)
+        copies = set()
+        for snapshot in snapshots.current():
+            path = self.path(self.pathfs.SYSTEM_FILE_ID, self.pathfs.SNAPSHOTS) + "/" + os.fsdecode(snapshot.name)
+            for _, table_block in snapshots.table_blocks(snapshot):
+                self.check_block(path, table_block)
+                if self.referenced[table_block]:
+                    self.problem("Snapshot table block", table_block, "is already in use")
+                    continue
+                self.referenced.set(table_block)
+                data = self.blockfs.read_block(table_block)
+                if data is None:
+                    self.problem("Snapshot table block", table_block, "is empty")
+                    continue
+                for block_id in snapshots.unpack_values(data):
+                    if not block_id or block_id == snapshots.EMPTY or block_id in copies:
+                        continue
+                    self.check_block(path, block_id)
+                    if self.referenced[block_id]:
+                        self.problem("Snapshot copy", block_id, "is already in use")
+                        continue
+                    self.referenced.set(block_id)
+                    copies.add(block_id)
+
+    def check_references_to(self, block_id, count):
+        references = self.shared.get(block_id, int(self.referenced[block_id]))
+        if references != count + 1:
+            self.problem("Block", block_id, "is referenced by", references, "files but its reference count is",
+                         count + 1)
@@ -0,0 +1,312 @@
+import sys
+import time
+
+from .pathlevelfilesystem import PathLevelFilesystem, DirectoryEntry, FileType
+from .snapshot import Snapshots
+from .utils import Bitmap
+
+
+class Compactor:
+    """
+    Shrinks a filesystem by moving the blocks at its end into unused blocks nearer the start, then truncating it.
+
+    Every block a file points to is moved and the pointers to it rewritten: data blocks, continuation headers, xattr
+    blocks and the file header itself, whose new block id becomes the file id in its directory entry. Shared blocks
+    are moved once for all the files pointing to them, taking their reference counts along. Deleted files are freed
+    first rather than moved. File ids change, so this only runs while the filesystem isn't mounted, and snapshots read
+    blocks by their ids, so nothing is moved while there are any. The blocks of a file which are moved are placed next
+    to each other, after the last block of the file which isn't, so compacting doesn't fragment files further.
+    """
+
+    PROGRESS_INTERVAL = 5
+
+    def __init__(self, pathfs: PathLevelFilesystem, progress=sys.stderr):
+        self.pathfs = pathfs
+        self.filefs = pathfs.filefs
+        self.blockfs = pathfs.filefs.blockfs
+        self.progress = progress
+
+        self.used = Bitmap()
+        # Blocks which can't be moved, and those that can
+        self.pinned = Bitmap()
+        self.movable = Bitmap()
+        self.shared = Bitmap()
+        # Last block each file points to, so only files reaching past the boundary are rewritten
+        self.last_blocks = {}
+        # Directory and name of each file's entry, and the new ids of files whose headers have moved
+        self.entries = {}
+        self.new_file_ids = {}
+        # Where shared blocks have been moved to, for the other files pointing to them
+        self.shared_moves = {}
+        self.total_blocks = self.boundary = self.moved = self.unreferenced = self.reclaimed = 0
+        self.last_progress = 0
+
+    def run(self):
+        self.last_progress = time.monotonic()
+        if not self.blockfs.claim(exclusive=True):
+            print("The filesystem is mounted, unmount it before compacting")
+            total_blocks = self.blockfs.total_blocks()
+            return total_blocks, total_blocks
+        try:
+            with self.blockfs.lock_file(write=True):
+                self.total_blocks = self.blockfs.total_blocks()
+                if Snapshots(self.pathfs, preserve=False).names():
+                    print("Snapshots refer to blocks where they are, delete them before compacting")
+                    return self.total_blocks, self.total_blocks
+                self.compact()
+        finally:
+            self.blockfs.unclaim()
+
+        if self.reclaimed:
+            print(f"Freed {self.reclaimed} blocks of deleted files")
+        print(f"Moved {self.moved} blocks, removing {self.total_blocks - self.boundary} of "
+              f"{self.total_blocks} blocks")
+        if self.unreferenced:
+            print(f"Found {self.unreferenced} blocks marked as used which no file points to, which can't be moved. "
+                  f"Use check --fix-unreferenced to free them")
+        return self.total_blocks, self.boundary
+
+    def compact(self):
+        if self.pathfs.search_directory(self.pathfs.SYSTEM_FILE_ID, self.pathfs.ORPHANS):
+            self.reclaimed = self.pathfs.reclaim_orphans(self.total_blocks)
+        for i in range(-(-self.total_blocks // self.filefs.SUPERBLOCK_INTERVAL)):
+            self.used.data.extend(self.filefs.read_superblock(i).data)
+        self.find_blocks()
+        self.boundary = self.find_boundary()
+        if self.boundary < self.total_blocks:
+            self.reserve_tail()
+            for file_id, last_block in sorted(self.last_blocks.items()):
+                if last_block >= self.boundary:
+                    self.relocate_file(file_id)
+                    self.report_progress("Moving blocks", self.moved)
+            self.relocate_refcount_tables()
+            self.truncate()
+
+    def report_progress(self, phase, done):
+        now = time.monotonic()
+        if self.progress is None or now - self.last_progress < self.PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        print(f"{phase}: {done}", file=self.progress)
+
+    def is_superblock(self, block_id):
+        return not block_id % self.filefs.SUPERBLOCK_INTERVAL
+
+    def find_blocks(self):
+        # The root and system directories are where everything else is found from
+        self.pinned.set(self.pathfs.ROOT_FILE_ID)
+        self.pinned.set(self.pathfs.SYSTEM_FILE_ID)
+        stack = [self.pathfs.SYSTEM_FILE_ID, self.pathfs.ROOT_FILE_ID]
+        while stack:
+            file_id = stack.pop()
+            if file_id in self.last_blocks:
+                continue
+            self.last_blocks[file_id] = self.find_file_blocks(file_id)
+            self.report_progress("Finding blocks", len(self.last_blocks))
+            if self.filefs.get_file_header(file_id, 0)[1].file_type == FileType.dir.value:
+                for entry in self.pathfs.directory_entries(file_id):
+                    self.entries[entry.file_id] = file_id, entry.name
+                    stack.append(entry.file_id)
+
+        # Shared blocks have a reference count, which moves with them
+        for first, table_block in self.filefs.refcount_table_blocks():
+            self.movable.set(table_block)
+            for block_id, count in enumerate(self.filefs.unpack_refcounts(self.blockfs.read_block(table_block)), first):
+                if count:
+                    self.shared.set(block_id)
+
+    def find_file_blocks(self, file_id):
+        self.movable.set(file_id)
+        last_block = file_id
+        header = self.filefs.read_file_header(file_id, 0, file_id)
+        xattr_block = header.xattr_block
+        while xattr_block:
+            self.movable.set(xattr_block)
+            last_block = max(last_block, xattr_block)
+            xattr_block, _ = self.filefs.unpack_xattr_block(self.blockfs.read_block(xattr_block))
+
+        header_num = 0
+        while True:
+            for block_id in header.block_ids:
+                self.movable.set(block_id)
+            last_block = max([last_block, *header.block_ids])
+            if not header.next_header:
+                return last_block
+            header_num += 1
+            self.movable.set(header.next_header)
+            last_block = max(last_block, header.next_header)
+            header = self.filefs.read_file_header(file_id, header_num, header.next_header)
+
+    def find_boundary(self):
+        """
+        The smallest size the filesystem can be truncated to: no block at or after it may be pinned, and there must be
+        enough unused blocks before it to take the used blocks after it.
+        """
+        limit = 1
+        moves = 0
+        for block_id in range(self.total_blocks):
+            if not self.used[block_id] or self.is_superblock(block_id):
+                continue
+            elif self.movable[block_id] and not self.pinned[block_id]:
+                moves += self.move_cost(block_id)
+            else:
+                if not self.pinned[block_id]:
+                    self.unreferenced += 1
+                # Only blocks after the last one which can't move need moving
+                limit = block_id + 1
+                moves = 0
+
+        holes = limit - self.used.count(limit)
+        boundary = limit
+        while holes < moves:
+            if not self.used[boundary]:
+                holes += 1
+            elif not self.is_superblock(boundary):
+                moves -= self.move_cost(boundary)
+            boundary += 1
+        return boundary
+
+    def move_cost(self, block_id):
+        # Moving a shared block may need a new refcount table block for its count where it goes
+        return 2 if self.shared[block_id] else 1
+
+    def reserve_tail(self):
+        # Mark every block from the boundary to the end of its superblock as used, so blocks are only moved to before
+        # it, and stop allocations from adding superblocks after it
+        interval = self.filefs.SUPERBLOCK_INTERVAL
+        end = -(-self.total_blocks // interval) * interval
+        self.filefs.mark_blocks(range(self.boundary, end), True)
+
+    def move_blocks(self, block_ids, near):
+        new_block_ids = self.filefs.allocate_blocks(len(block_ids), near)
+        assert all(block_id < self.boundary for block_id in new_block_ids), new_block_ids
+        for old, new in zip(block_ids, new_block_ids):
+            self.blockfs.swap_blocks(old, new)
+        self.moved += len(block_ids)
+        return dict(zip(block_ids, new_block_ids))
+
+    def relocate_file(self, file_id):
+        header = self.filefs.read_file_header(file_id, 0, file_id)
+        if file_id >= self.boundary:
+            file_id = self.relocate_header(file_id, header)
+        near = file_id
+        header_dirty = False
+
+        prev_xattr_block, xattr_block = 0, header.xattr_block
+        while xattr_block:
+            next_xattr_block, _ = self.filefs.unpack_xattr_block(self.blockfs.read_block(xattr_block))
+            if xattr_block >= self.boundary:
+                xattr_block = self.move_blocks([xattr_block], near)[xattr_block]
+                if prev_xattr_block:
+                    self.blockfs.write_block(prev_xattr_block, 0,
+                                             xattr_block.to_bytes(self.blockfs.BLOCK_ID_SIZE, "little"))
+                else:
+                    header.xattr_block = xattr_block
+                    header_dirty = True
+            prev_xattr_block, xattr_block = xattr_block, next_xattr_block
+        self.filefs.xattr_cache.pop(file_id, None)
+
+        # Each header is written once the next one's block is known, as it points to it
+        prev_block_id, prev_header, prev_dirty = file_id, header, header_dirty
+        header_num = 0
+        block_id = file_id
+        while True:
+            if header_num:
+                header = self.filefs.read_file_header(file_id, header_num, block_id)
+            to_move = [x for x in header.block_ids if x >= self.boundary]
+            if header_num and block_id >= self.boundary:
+                to_move.insert(0, block_id)
+            near = max([near, *(x for x in header.block_ids if x < self.boundary)])
+            moves = self.move_file_blocks(to_move, near)
+
+            dirty = header_num == 0 and header_dirty
+            if header_num and block_id in moves:
+                block_id = moves[block_id]
+                prev_header.next_header = block_id
+                prev_dirty = True
+            if header_num and header.prev_header != prev_block_id:
+                header.prev_header = prev_block_id
+                dirty = True
+            if any(x in moves for x in header.block_ids):
+                header.block_ids = [moves.get(x, x) for x in header.block_ids]
+                dirty = True
+            if moves:
+                near = max(moves.values())
+
+            if header_num:
+                self.write_header(prev_block_id, header_num - 1, prev_header, prev_dirty)
+                prev_block_id, prev_header, prev_dirty = block_id, header, dirty
+            else:
+                prev_dirty = dirty
+            if not header.next_header:
+                break
+            header_num += 1
+            block_id = header.next_header
+        self.write_header(prev_block_id, header_num, prev_header, prev_dirty)
+        self.filefs.forget_file_headers(file_id)
+
+    def move_file_blocks(self, block_ids, near):
+        # Shared blocks already moved for another file stay where they went, and a file may point to one more than once
+        moves = {x: self.shared_moves[x] for x in block_ids if x in self.shared_moves}
+        to_move = list(dict.fromkeys(x for x in block_ids if x not in moves))
+        if to_move:
+            moves.update(self.move_blocks(to_move, near))
+        for old in to_move:
+            if self.shared[old]:
+                new = self.shared_moves[old] = moves[old]
+                self.filefs.set_block_references(new, self.filefs.block_references(old))
+                self.filefs.set_block_references(old, 0)
+        return moves
+
+    def relocate_header(self, file_id, header):
+        # The header is placed before the file's data which stays, and the directory entry pointed at its new block
+        near = min((x for x in header.block_ids if x < self.boundary), default=0)
+        new_file_id = self.move_blocks([file_id], near)[file_id]
+        self.new_file_ids[file_id] = new_file_id
+        self.filefs.forget_file_headers(file_id)
+        self.filefs.xattr_cache.pop(file_id, None)
+        for key in self.pathfs.node_cache.keys():
+            if key[0] == file_id:
+                self.pathfs.node_cache.pop(key, None)
+
+        parent, name = self.entries[file_id]
+        parent = self.new_file_ids.get(parent, parent)
+        self.pathfs.add_directory_entry(parent, DirectoryEntry(name, new_file_id), overwrite=True)
+        if file_id == self.filefs.refcount_file_id:
+            self.filefs.refcount_file_id = new_file_id
+        return new_file_id
+
+    def relocate_refcount_tables(self):
+        # Once the files are done, as moving shared blocks changes the tables. Tables for blocks past the boundary
+        # only hold zeros by then, so are dropped rather than moved
+        for first, table_block in list(self.filefs.refcount_table_blocks()):
+            if first >= self.boundary:
+                new_table_block = 0
+                if table_block < self.boundary:
+                    self.filefs.deallocate_blocks([table_block])
+            elif table_block >= self.boundary:
+                new_table_block = self.move_blocks([table_block], first)[table_block]
+            else:
+                continue
+            self.filefs.write(self.filefs.refcount_file_id,
+                              new_table_block.to_bytes(self.blockfs.BLOCK_ID_SIZE, "little"),
+                              first // self.filefs.REFCOUNTS_PER_BLOCK * self.blockfs.BLOCK_ID_SIZE)
+
+    def write_header(self, block_id, header_num, header, dirty):
+        if not dirty:
+            return
+        if header_num:
+            packed = self.filefs.pack_file_continuation_header(header)
+        else:
+            packed = self.filefs.pack_file_header(header)
+        self.blockfs.write_block(block_id, 0, packed)
+
+    def truncate(self):
+        interval = self.filefs.SUPERBLOCK_INTERVAL
+        if self.boundary % interval:
+            self.filefs.mark_blocks(range(self.boundary, -(-self.boundary // interval) * interval), False)
+        self.blockfs.remove_blocks(self.total_blocks - self.boundary)
+        self.filefs.rebuild_free_space_summary()
+        self.filefs.header_cache.clear()
+        self.filefs.xattr_cache.clear()
+        self.pathfs.node_cache.clear()
@@ -4,7 +4,7 @@ import attr
 import sys
 
 from .blocklevelfilesystem import BlockLevelFilesystem
-from .utils import check_types, LRUDict, BitArray
+from .utils import check_types, LRUDict, BitArray, FreeRuns
 
 
 @attr.s(slots=True)
@@ -37,6 +37,28 @@ class SuperblockCache:
     token = attr.ib()
 
 
+@attr.s(slots=True)
+class XattrCache:
+    inline = attr.ib()
+    blocks = attr.ib()
+    segments = attr.ib()
+    values = attr.ib()
+
+
+@attr.s(slots=True)
+class FreeSpaceSummary:
+    runs = attr.ib()
+    token = attr.ib()
+
+    @property
+    def free(self):
+        return self.runs.free
+
+    @property
+    def largest_run(self):
+        return self.runs.largest_run()
+
+
 class KeyAlreadyExists(KeyError):
     pass
 
@@ -50,17 +72,22 @@ class FileLevelFilesystem:
     BLOCK_IDS_PER_HEADER = 32
     FILE_HEADER_INTERVAL = BLOCK_IDS_PER_HEADER + 1
     XATTR_INLINE_SIZE = 256
+    REFCOUNT_SIZE = 4
 
-    __slots__ = ["blockfs", "header_cache", "superblock_cache",
+    __slots__ = ["blockfs", "header_cache", "superblock_cache", "free_space", "xattr_cache", "refcount_file_id",
                  "FILE_HEADER_SIZE", "FILE_HEADER_DATA_SIZE", "FILE_CONTINUATION_HEADER_SIZE",
                  "FILE_CONTINUATION_HEADER_DATA_SIZE", "SUPERBLOCK_INTERVAL", "XATTR_BLOCK_HEADER_SIZE",
-                 "XATTR_BLOCK_DATA_SIZE", "file_header_struct", "file_continuation_header_struct",
-                 "xattr_block_header_struct"]
+                 "XATTR_BLOCK_DATA_SIZE", "REFCOUNTS_PER_BLOCK", "file_header_struct",
+                 "file_continuation_header_struct", "xattr_block_header_struct", "xattr_record_struct"]
 
     def __init__(self, blockfs: BlockLevelFilesystem):
         self.blockfs = blockfs
         self.header_cache = LRUDict(1024)
         self.superblock_cache = LRUDict(128)
+        self.free_space = {}
+        self.xattr_cache = LRUDict(1024)
+        # File holding the block id of the refcount table block for each range of block ids, set by the path layer
+        self.refcount_file_id = 0
 
         self.FILE_HEADER_SIZE = (1 + self.FILESIZE_SIZE +
                                  (self.BLOCK_IDS_PER_HEADER + 2) * self.blockfs.BLOCK_ID_SIZE +
@@ -71,10 +98,13 @@ class FileLevelFilesystem:
         self.SUPERBLOCK_INTERVAL = self.blockfs.LOGICAL_BLOCK_SIZE * 8
         self.XATTR_BLOCK_HEADER_SIZE = self.blockfs.BLOCK_ID_SIZE
         self.XATTR_BLOCK_DATA_SIZE = self.blockfs.LOGICAL_BLOCK_SIZE - self.XATTR_BLOCK_HEADER_SIZE
+        # So each superblock's blocks have their counts in 32 table blocks
+        self.REFCOUNTS_PER_BLOCK = self.blockfs.LOGICAL_BLOCK_SIZE // self.REFCOUNT_SIZE
 
         self.file_header_struct = struct.Struct(f"<B{self.BLOCK_IDS_PER_HEADER + 3}Q{self.XATTR_INLINE_SIZE}s")
         self.file_continuation_header_struct = struct.Struct(f"<{self.BLOCK_IDS_PER_HEADER + 2}Q")
         self.xattr_block_header_struct = struct.Struct(f"<Q{self.XATTR_BLOCK_DATA_SIZE}s")
+        self.xattr_record_struct = struct.Struct("<BH")
 
     @classmethod
     @check_types
@@ -88,8 +118,8 @@ class FileLevelFilesystem:
     def unpack_file_header(self, data: bytes):
         (file_type, size, next_header, *block_ids,
          xattr_block, xattr_inline) = self.file_header_struct.unpack(data[:self.FILE_HEADER_SIZE])
-        if not block_ids[-1]:
-            block_ids = block_ids[:block_ids.index(0)]
+        while block_ids and not block_ids[-1]:
+            block_ids.pop()
         return FileHeader(file_type, size, next_header, block_ids, xattr_block, xattr_inline)
 
     @check_types
@@ -107,8 +137,8 @@ class FileLevelFilesystem:
         (next_header,
          prev_header,
          *block_ids) = self.file_continuation_header_struct.unpack(data[:self.FILE_CONTINUATION_HEADER_SIZE])
-        if not block_ids[-1]:
-            block_ids = block_ids[:block_ids.index(0)]
+        while block_ids and not block_ids[-1]:
+            block_ids.pop()
         return FileContinuationHeader(next_header, prev_header, block_ids)
 
     @check_types
@@ -125,9 +155,11 @@ class FileLevelFilesystem:
             hcache = self.superblock_cache[superblock_id]
             reload, _ = self.blockfs.block_version(block_id, hcache.token)
             if not reload:
+                self.blockfs.stats.cache("superblock_cache", True)
                 return hcache.data
         except KeyError:
             pass
+        self.blockfs.stats.cache("superblock_cache", False)
 
         if block_id >= self.blockfs.total_blocks():
             assert self.blockfs.total_blocks() == block_id
@@ -137,13 +169,65 @@ class FileLevelFilesystem:
         data, token = self.blockfs.read_block(block_id, with_token=True)
         arr = BitArray(data)
         self.superblock_cache[superblock_id] = SuperblockCache(arr, token)
+        summary = self.free_space.get(superblock_id)
+        if summary is None or summary.token != token:
+            self.summarise_superblock(superblock_id, arr, token)
         return arr
 
     @check_types
     def write_superblock(self, superblock_id: int, bitmap: BitArray):
+        # The summary is kept up to date by set_bits as the bitmap changes, so only its token changes here
         block_id = superblock_id * self.SUPERBLOCK_INTERVAL
-        token = self.blockfs.write_block(block_id, 0, bitmap.tobytes(), with_token=True)
+        with self.blockfs.lock_file(write=True):
+            # Before the bitmap is read, as keeping a copy for snapshots may allocate from it
+            self.blockfs.preserve(block_id)
+            token = self.blockfs.write_block(block_id, 0, bitmap.tobytes(), with_token=True)
         self.superblock_cache[superblock_id] = SuperblockCache(bitmap, token)
+        summary = self.free_space.get(superblock_id)
+        if summary is None:
+            self.summarise_superblock(superblock_id, bitmap, token)
+        else:
+            summary.token = token
+
+    @check_types
+    def summarise_superblock(self, superblock_id: int, bitmap: BitArray, token: bytes):
+        self.free_space[superblock_id] = FreeSpaceSummary(FreeRuns(bitmap), token)
+
+    @check_types
+    def set_bits(self, superblock_id: int, bitmap: BitArray, bits: list, used: bool):
+        # Change bits of a superblock read with read_superblock, updating its summary from the runs of them changed
+        runs = self.free_space[superblock_id].runs
+        bits = sorted(bits)
+        first = 0
+        for i, bit in enumerate(bits):
+            bitmap[bit] = used
+            if i + 1 == len(bits) or bits[i + 1] != bit + 1:
+                if used:
+                    runs.use(bits[first], bit + 1)
+                else:
+                    runs.release(bits[first], bit + 1)
+                first = i + 1
+
+    @check_types
+    def mark_blocks(self, block_ids, used: bool):
+        # Mark blocks as used or unused, writing each superblock once
+        superblocks = {}
+        for block_id in block_ids:
+            superblock_id, bit = divmod(block_id, self.SUPERBLOCK_INTERVAL)
+            superblocks.setdefault(superblock_id, []).append(bit)
+        with self.blockfs.lock_file(write=True):
+            for superblock_id, bits in superblocks.items():
+                bitmap = self.read_superblock(superblock_id)
+                self.set_bits(superblock_id, bitmap, bits, used)
+                self.write_superblock(superblock_id, bitmap)
+
+    def rebuild_free_space_summary(self):
+        self.free_space.clear()
+        self.superblock_cache.clear()
+        with self.blockfs.lock_file(write=False):
+            total_blocks = self.blockfs.total_blocks()
+        for superblock_id in range(-(-total_blocks // self.SUPERBLOCK_INTERVAL)):
+            self.read_superblock(superblock_id)
 
     @check_types
     def write_new_superblock(self, superblock_id: int):
@@ -152,64 +236,147 @@ class FileLevelFilesystem:
 
     @check_types
     def number_free_blocks(self, superblock_id: int):
-        return self.read_superblock(superblock_id).count(False)
-
-    def superblock_generator(self):
-        searched_superblocks = set()
-        for superblock_id in self.superblock_cache.keys():
-            cache = self.superblock_cache[superblock_id]
-            block_id = superblock_id * self.SUPERBLOCK_INTERVAL
-            reload, _ = self.blockfs.block_version(block_id, cache.token)
-            if not reload:
-                searched_superblocks.add(superblock_id)
-                yield superblock_id, cache.data
-        for superblock_id in itertools.count():
-            if superblock_id not in searched_superblocks:
-                yield superblock_id, self.read_superblock(superblock_id)
+        self.read_superblock(superblock_id)
+        return self.free_space[superblock_id].free
+
+    @check_types
+    def superblock_generator(self, near: int=0, single_run: int=0):
+        # Existing superblocks closest to near first, skipping any the summary says are full. Given single_run, only
+        # those whose summary has a run that long are tried, and no new superblocks are added
+        existing = -(-self.blockfs.total_blocks() // self.SUPERBLOCK_INTERVAL)
+        start = near // self.SUPERBLOCK_INTERVAL
+        for superblock_id in sorted(range(existing), key=lambda x: (abs(x - start), x)):
+            summary = self.free_space.get(superblock_id)
+            if summary is not None and single_run and summary.largest_run < single_run:
+                continue
+            if summary is not None and not summary.free:
+                reload, _ = self.blockfs.block_version(superblock_id * self.SUPERBLOCK_INTERVAL, summary.token)
+                if not reload:
+                    continue
+            yield superblock_id, self.read_superblock(superblock_id)
+        if single_run:
+            return
+        for superblock_id in itertools.count(existing):
+            yield superblock_id, self.read_superblock(superblock_id)
+
+    @check_types
+    def choose_free_blocks(self, superblock_id: int, number: int, start: int, single_run: bool):
+        # A single run that fits, starting at start if possible, otherwise holes in order from start
+        runs = self.free_space[superblock_id].runs
+        if single_run:
+            run_start = runs.find(number, start)
+            return [] if run_start is None else list(range(run_start, run_start + number))
+        return runs.bits(number, start)
 
     @check_types
-    def allocate_blocks(self, number: int):
+    def allocate_blocks(self, number: int, near: int=None):
         if not number:
             return []
         blocks = []
-        new_blocks = 0
+        if near is None:
+            near = 0
         with self.blockfs.lock_file(write=True):
-            total_size = self.blockfs.total_blocks()
-            for superblock_id, bitmap in self.superblock_generator():
-                for free_block in bitmap.search():
-                    bitmap[free_block] = True
-                    block_id = superblock_id * self.SUPERBLOCK_INTERVAL + free_block
-                    blocks.append(block_id)
-
-                    new_blocks += block_id >= total_size
-
-                    number -= 1
-                    if not number:
-                        break
+            # Every superblock is tried for a single run before the holes in the nearest are filled, so files only
+            # fragment once there is no room for them anywhere
+            superblocks = itertools.chain(((x, True) for x in self.superblock_generator(near, number)),
+                                          ((x, False) for x in self.superblock_generator(near)))
+            for (superblock_id, bitmap), single_run in superblocks:
+                superblock_start = superblock_id * self.SUPERBLOCK_INTERVAL
+                start = near - superblock_start if 0 <= near - superblock_start < self.SUPERBLOCK_INTERVAL else 0
+                free_blocks = self.choose_free_blocks(superblock_id, number - len(blocks), start, single_run)
+                if not free_blocks:
+                    continue
+
+                self.set_bits(superblock_id, bitmap, free_blocks, True)
+                blocks.extend(superblock_start + free_block for free_block in free_blocks)
 
                 self.write_superblock(superblock_id, bitmap)
-                if new_blocks:
-                    xs = self.blockfs.new_blocks(new_blocks)
-                    assert blocks[-new_blocks:] == xs, (xs, blocks)
-                    new_blocks = 0
 
-                if not number:
+                total_size = self.blockfs.total_blocks()
+                last_block = superblock_start + max(free_blocks)
+                if last_block >= total_size:
+                    xs = self.blockfs.new_blocks(last_block + 1 - total_size)
+                    assert xs == list(range(total_size, last_block + 1)), (xs, blocks)
+
+                if len(blocks) == number:
                     break
         return blocks
 
     @check_types
     def deallocate_blocks(self, block_ids: list):
-        superblocks = {}
         with self.blockfs.lock_file(write=True):
             for block_id in block_ids:
                 self.blockfs.wipe_block(block_id)
-                superblock_id, block_id = divmod(block_id, self.SUPERBLOCK_INTERVAL)
-                if superblock_id not in superblocks:
-                    superblocks[superblock_id] = self.read_superblock(superblock_id)
-                superblocks[superblock_id][block_id] = False
+            self.mark_blocks(block_ids, False)
 
-            for superblock_id, bitmap in superblocks.items():
-                self.write_superblock(superblock_id, bitmap)
+    @check_types
+    def refcount_table_block(self, block_id: int, create: bool=False):
+        # Table block holding the count of block_id, from the refcount file's entry for its range, 0 if there is none
+        index = block_id // self.REFCOUNTS_PER_BLOCK * self.blockfs.BLOCK_ID_SIZE
+        with self.blockfs.lock_file(write=create):
+            data = self.read(self.refcount_file_id, self.blockfs.BLOCK_ID_SIZE, index)
+            table_block = int.from_bytes(data, "little")
+            if not table_block and create:
+                table_block, = self.allocate_blocks(1, block_id)
+                self.blockfs.write_block(table_block, 0, b"\0" * self.blockfs.LOGICAL_BLOCK_SIZE)
+                self.write(self.refcount_file_id, table_block.to_bytes(self.blockfs.BLOCK_ID_SIZE, "little"), index)
+        return table_block
+
+    def refcount_table_blocks(self):
+        # First block id and table block of each range of block ids which has one
+        data = self.read(self.refcount_file_id) if self.refcount_file_id else b""
+        for i in range(0, len(data), self.blockfs.BLOCK_ID_SIZE):
+            table_block = int.from_bytes(data[i:i + self.blockfs.BLOCK_ID_SIZE], "little")
+            if table_block:
+                yield i // self.blockfs.BLOCK_ID_SIZE * self.REFCOUNTS_PER_BLOCK, table_block
+
+    @check_types
+    def unpack_refcounts(self, data: bytes):
+        return [int.from_bytes(data[i:i + self.REFCOUNT_SIZE], "little")
+                for i in range(0, self.REFCOUNTS_PER_BLOCK * self.REFCOUNT_SIZE, self.REFCOUNT_SIZE)]
+
+    @check_types
+    def block_references(self, block_id: int):
+        # Number of references in addition to the owning file, 0 unless the block is shared. Nothing is looked up
+        # until a block has been shared, which gives the refcount file its first entry
+        if not self.refcount_file_id:
+            return 0
+        with self.blockfs.lock_file(write=False):
+            if not self.get_file_header(self.refcount_file_id, 0)[1].size:
+                return 0
+            table_block = self.refcount_table_block(block_id)
+            if not table_block:
+                return 0
+            offset = block_id % self.REFCOUNTS_PER_BLOCK * self.REFCOUNT_SIZE
+            return int.from_bytes(self.blockfs.read_block(table_block)[offset:offset + self.REFCOUNT_SIZE], "little")
+
+    @check_types
+    def set_block_references(self, block_id: int, references: int):
+        assert self.refcount_file_id
+        with self.blockfs.lock_file(write=True):
+            table_block = self.refcount_table_block(block_id, create=bool(references))
+            if table_block:
+                self.blockfs.write_block(table_block, block_id % self.REFCOUNTS_PER_BLOCK * self.REFCOUNT_SIZE,
+                                         references.to_bytes(self.REFCOUNT_SIZE, "little"))
+
+    @check_types
+    def share_blocks(self, block_ids: list):
+        with self.blockfs.lock_file(write=True):
+            for block_id in block_ids:
+                self.set_block_references(block_id, self.block_references(block_id) + 1)
+
+    @check_types
+    def release_blocks(self, block_ids: list):
+        # Drop a reference to each block, freeing those which are no longer shared
+        with self.blockfs.lock_file(write=True):
+            blocks_to_free = []
+            for block_id in block_ids:
+                references = self.block_references(block_id)
+                if references:
+                    self.set_block_references(block_id, references - 1)
+                else:
+                    blocks_to_free.append(block_id)
+            self.deallocate_blocks(blocks_to_free)
 
     @check_types
     def num_file_blocks(self, file_id: int):
@@ -234,44 +401,117 @@ class FileLevelFilesystem:
         return header * self.FILE_HEADER_INTERVAL + block, offset
 
     @check_types
-    def extend_file_blocks(self, file_id: int, block_num: int, last_block: int=None):
-        with self.blockfs.lock_file(write=True):
-            if last_block is None:
-                last_header, header_block_id, hdata = self.get_last_file_header(file_id)
-                last_block = len(hdata.block_ids)
-            else:
-                last_header, last_block = divmod(last_block, self.FILE_HEADER_INTERVAL)
-                header_block_id, hdata = self.get_file_header(file_id, last_header)
-
-            num_blocks = block_num - last_header * self.FILE_HEADER_INTERVAL - last_block - 1
-            assert num_blocks > 0
-            new_blocks = self.allocate_blocks(num_blocks)
-            new_blocks_position = 0
-
-            while header_block_id:
-                blocks = hdata.block_ids
-                num_blocks = self.BLOCK_IDS_PER_HEADER - len(blocks)
-                blocks.extend(new_blocks[new_blocks_position:new_blocks_position + num_blocks])
-                new_blocks_position += num_blocks
-
-                if new_blocks_position < len(new_blocks):
-                    new_header_id = new_blocks[new_blocks_position]
-                    new_blocks_position += 1
-                else:
-                    new_header_id = 0
+    def offset_from_block(self, block_num: int):
+        header, block_num = divmod(block_num, self.FILE_HEADER_INTERVAL)
+        offset = 0
+        if header:
+            offset = (self.FILE_HEADER_DATA_SIZE
+                      + self.blockfs.LOGICAL_BLOCK_SIZE * self.BLOCK_IDS_PER_HEADER
+                      + (header - 1) * (self.blockfs.LOGICAL_BLOCK_SIZE * self.BLOCK_IDS_PER_HEADER
+                                        + self.FILE_CONTINUATION_HEADER_DATA_SIZE))
+        if block_num:
+            offset += self.file_data_in_block(header * self.FILE_HEADER_INTERVAL)
+            offset += (block_num - 1) * self.blockfs.LOGICAL_BLOCK_SIZE
+        return offset
 
-                hdata.next_header = new_header_id
+    @check_types
+    def file_block_id(self, file_id: int, block_num: int):
+        # Returns 0 for holes
+        header, block_num = divmod(block_num, self.FILE_HEADER_INTERVAL)
+        header_block_id, hdata = self.get_file_header(file_id, header, missing_ok=True)
+        if hdata is None:
+            return 0
+        if not block_num:
+            return header_block_id
+        if block_num > len(hdata.block_ids):
+            return 0
+        return hdata.block_ids[block_num - 1]
 
-                if header_block_id == file_id:
-                    packed = self.pack_file_header(hdata)
-                else:
-                    packed = self.pack_file_continuation_header(hdata)
+    @check_types
+    def allocated_blocks(self, file_id: int, start: int=0):
+        with self.blockfs.lock_file(write=False):
+            last_header, _, _ = self.get_last_file_header(file_id)
+            for header in range(start // self.FILE_HEADER_INTERVAL, last_header + 1):
+                _, hdata = self.get_file_header(file_id, header)
+                first = header * self.FILE_HEADER_INTERVAL
+                if first >= start:
+                    yield first
+                for i, block_id in enumerate(hdata.block_ids, first + 1):
+                    if block_id and i >= start:
+                        yield i
 
-                self.blockfs.write_block(header_block_id, 0, packed)
+    @check_types
+    def allocate_file_blocks(self, file_id: int, block_nums: range):
+        # Fill the holes in block_nums, creating any missing continuation headers, with one allocation
+        if not block_nums:
+            return
+        with self.blockfs.lock_file(write=True):
+            last_header, _, _ = self.get_last_file_header(file_id)
+            first_header = block_nums[0] // self.FILE_HEADER_INTERVAL
+            end_header = block_nums[-1] // self.FILE_HEADER_INTERVAL
+            if end_header > last_header:
+                first_header = min(first_header, last_header)
+
+            headers = {}
+            modified = set()
+            slots = []
+            near = None
+            for header in range(first_header, end_header + 1):
+                first = header * self.FILE_HEADER_INTERVAL
+                wanted = range(max(block_nums[0], first + 1),
+                               min(block_nums[-1] + 1, first + self.FILE_HEADER_INTERVAL))
+                if header <= last_header:
+                    header_block_id, hdata = self.get_file_header(file_id, header)
+                    allocated = header_block_id
+                    for block_num in wanted:
+                        i = block_num - first - 1
+                        if i < len(hdata.block_ids) and hdata.block_ids[i]:
+                            allocated = hdata.block_ids[i]
+                        else:
+                            if near is None:
+                                near = allocated + 1
+                            slots.append((header, block_num - first))
+                            modified.add(header)
+                    if near is None and header == last_header:
+                        near = (hdata.block_ids[-1] if hdata.block_ids else header_block_id) + 1
+                else:
+                    header_block_id, hdata = 0, FileContinuationHeader(0, 0, [])
+                    slots.append((header, 0))
+                    slots.extend((header, block_num - first) for block_num in wanted)
+                    modified.add(header)
+                headers[header] = [header_block_id, hdata]
+
+            if not slots:
+                return
+
+            new_blocks = iter(self.allocate_blocks(len(slots), near))
+            for header, i in slots:
+                block_id = next(new_blocks)
+                if not i:
+                    headers[header][0] = block_id
+                    continue
+                block_ids = headers[header][1].block_ids
+                if len(block_ids) < i:
+                    block_ids.extend([0] * (i - len(block_ids)))
+                block_ids[i - 1] = block_id
+
+            for header in range(first_header, end_header + 1):
+                header_block_id, hdata = headers[header]
+                if header >= last_header and header < end_header:
+                    hdata.next_header = headers[header + 1][0]
+                    modified.add(header)
+                if header > last_header:
+                    hdata.prev_header = headers[header - 1][0]
+                    self.blockfs.write_block(header_block_id, 0, self.pack_file_continuation_header(hdata))
+                elif header in modified:
+                    self.write_file_header(file_id, header, hdata)
 
-                if new_header_id:
-                    hdata = FileContinuationHeader(0, header_block_id, [])
-                header_block_id = new_header_id
+    @check_types
+    def extend_file_blocks(self, file_id: int, block_num: int):
+        with self.blockfs.lock_file(write=True):
+            total_blocks = self.num_file_blocks(file_id)
+            assert block_num > total_blocks
+            self.allocate_file_blocks(file_id, range(total_blocks, block_num))
 
     @check_types
     def truncate_file_blocks(self, file_id: int, block_num: int):
@@ -284,68 +524,259 @@ class FileLevelFilesystem:
             last_block = self.BLOCK_IDS_PER_HEADER
 
         with self.blockfs.lock_file(write=True):
+            if block_num >= self.num_file_blocks(file_id):
+                return
             header_block_id, hdata = self.get_file_header(file_id, last_header)
-            blocks_to_free = hdata.block_ids[last_block:]
+            blocks_to_free = [block_id for block_id in hdata.block_ids[last_block:] if block_id]
 
             next_block = hdata.next_header
-            free_header = last_header + 1
             while next_block:
                 data = self.blockfs.read_block(next_block)
                 data = self.unpack_file_continuation_header(data)
                 blocks_to_free.append(next_block)
-                blocks_to_free.extend(data.block_ids)
+                blocks_to_free.extend(block_id for block_id in data.block_ids if block_id)
                 next_block = data.next_header
-                free_header += 1
 
             hdata.block_ids = hdata.block_ids[:last_block]
+            while hdata.block_ids and not hdata.block_ids[-1]:
+                hdata.block_ids.pop()
             hdata.next_header = 0
 
             self.write_file_header(file_id, last_header, hdata)
-            self.deallocate_blocks(blocks_to_free)
+            self.release_blocks(blocks_to_free)
+            self.forget_file_headers(file_id, last_header + 1)
+
+    @check_types
+    def forget_file_headers(self, file_id: int, start: int = 0):
+        # Freed header blocks keep their tokens until reused, so their cache entries would still validate
+        for key in [key for key in self.header_cache.keys() if key[0] == file_id and key[1] >= start]:
+            self.header_cache.pop(key, None)
 
     @check_types
     def delete_file(self, file_id: int):
         with self.blockfs.lock_file(write=True):
             header_block_id, hdata = self.get_file_header(file_id, 0)
-            blocks_to_free = hdata.block_ids
+            blocks_to_free = [block_id for block_id in hdata.block_ids if block_id]
             blocks_to_free.append(header_block_id)
 
             next_block = hdata.next_header
-            free_header = 1
             while next_block:
                 data = self.blockfs.read_block(next_block)
                 data = self.unpack_file_continuation_header(data)
                 blocks_to_free.append(next_block)
-                blocks_to_free.extend(data.block_ids)
+                blocks_to_free.extend(block_id for block_id in data.block_ids if block_id)
                 next_block = data.next_header
-                free_header += 1
 
-            self.deallocate_blocks(blocks_to_free)
+            next_block = hdata.xattr_block
+            while next_block:
+                blocks_to_free.append(next_block)
+                next_block, _ = self.unpack_xattr_block(self.blockfs.read_block(next_block))
+
+            self.release_blocks(blocks_to_free)
+            self.forget_file_headers(file_id)
+            self.xattr_cache.pop(file_id, None)
+
+    @check_types
+    def reclaim_file(self, file_id: int, max_blocks: int):
+        # Free a deleted file from the end, a continuation header at a time, returning (finished, blocks freed)
+        freed = 0
+        with self.blockfs.lock_file(write=True):
+            while True:
+                last_header, _, hdata = self.get_last_file_header(file_id)
+                blocks = 1 + sum(1 for block_id in hdata.block_ids if block_id)
+                if freed and freed + blocks > max_blocks:
+                    return False, freed
+                if not last_header:
+                    self.delete_file(file_id)
+                    return True, freed + blocks
+                self.truncate_file_blocks(file_id, last_header * self.FILE_HEADER_INTERVAL)
+                freed += blocks
 
     @check_types
     def truncate_file_size(self, file_id: int, size: int):
         assert size >= 0
-        last_block, _ = self.block_from_offset(size)
+        last_block, offset = self.block_from_offset(size)
         with self.blockfs.lock_file(write=True):
+            old_size = self.get_file_header(file_id, 0)[1].size
             self.truncate_file_blocks(file_id, last_block + 1)
+            if size < old_size and self.file_block_id(file_id, last_block):
+                # Don't leave old data behind to reappear if the file grows again
+                self.write_file_data(file_id, last_block, offset,
+                                     b"\0" * (self.file_data_in_block(last_block) - offset))
             _, header = self.get_file_header(file_id, 0)
             header.size = size
             self.write_file_header(file_id, 0, header)
 
     @check_types
-    def get_file_header(self, file_id: int, header_num: int):
+    def punch_hole(self, file_id: int, start: int, length: int):
+        with self.blockfs.lock_file(write=True):
+            end = min(start + length, self.get_file_header(file_id, 0)[1].size)
+            if end <= start:
+                return
+            first_block, first_offset = self.block_from_offset(start)
+            last_block, last_offset = self.block_from_offset(end)
+
+            freed = {}
+            for block_num in self.allocated_blocks(file_id, first_block):
+                if block_num > last_block:
+                    break
+                block_start = first_offset if block_num == first_block else 0
+                block_end = last_offset if block_num == last_block else self.file_data_in_block(block_num)
+                if block_start >= block_end:
+                    continue
+                header, i = divmod(block_num, self.FILE_HEADER_INTERVAL)
+                if i and block_end - block_start == self.blockfs.LOGICAL_BLOCK_SIZE:
+                    freed.setdefault(header, []).append(i)
+                else:
+                    self.write_file_data(file_id, block_num, block_start, b"\0" * (block_end - block_start))
+
+            blocks_to_free = []
+            for header, indexes in freed.items():
+                _, hdata = self.get_file_header(file_id, header)
+                for i in indexes:
+                    blocks_to_free.append(hdata.block_ids[i - 1])
+                    hdata.block_ids[i - 1] = 0
+                while hdata.block_ids and not hdata.block_ids[-1]:
+                    hdata.block_ids.pop()
+                self.write_file_header(file_id, header, hdata)
+            self.release_blocks(blocks_to_free)
+
+    @check_types
+    def map_file_blocks(self, file_id: int, block_map: dict):
+        # Point block numbers at the given (possibly shared) block ids, 0 for a hole, releasing the old blocks
+        if not block_map:
+            return
+        with self.blockfs.lock_file(write=True):
+            end_header = max(block_map) // self.FILE_HEADER_INTERVAL
+            self.allocate_file_blocks(file_id, range(end_header * self.FILE_HEADER_INTERVAL,
+                                                     end_header * self.FILE_HEADER_INTERVAL + 1))
+
+            headers = {}
+            for block_num, block_id in block_map.items():
+                header, i = divmod(block_num, self.FILE_HEADER_INTERVAL)
+                assert i, "header blocks can't be shared"
+                headers.setdefault(header, []).append((i, block_id))
+
+            blocks_to_share = []
+            blocks_to_release = []
+            for header, entries in headers.items():
+                _, hdata = self.get_file_header(file_id, header)
+                for i, block_id in entries:
+                    if len(hdata.block_ids) < i:
+                        hdata.block_ids.extend([0] * (i - len(hdata.block_ids)))
+                    old_block_id = hdata.block_ids[i - 1]
+                    if old_block_id == block_id:
+                        continue
+                    if block_id:
+                        blocks_to_share.append(block_id)
+                    if old_block_id:
+                        blocks_to_release.append(old_block_id)
+                    hdata.block_ids[i - 1] = block_id
+                while hdata.block_ids and not hdata.block_ids[-1]:
+                    hdata.block_ids.pop()
+                self.write_file_header(file_id, header, hdata)
+
+            self.share_blocks(blocks_to_share)
+            self.release_blocks(blocks_to_release)
+
+    @check_types
+    def clone_range(self, src_file_id: int, src_offset: int, dst_file_id: int, dst_offset: int, length: int):
+        # Copy length bytes, sharing whole data blocks when the ranges line up, returns the number of bytes copied
+        with self.blockfs.lock_file(write=True):
+            src_size = self.get_file_header(src_file_id, 0)[1].size
+            end = min(src_offset + length, src_size)
+            if end <= src_offset:
+                return 0
+            length = end - src_offset
+
+            if src_offset != dst_offset or src_file_id == dst_file_id:
+                for pos in range(0, length, self.blockfs.LOGICAL_BLOCK_SIZE * self.BLOCK_IDS_PER_HEADER):
+                    data = self.read(src_file_id, self.blockfs.LOGICAL_BLOCK_SIZE * self.BLOCK_IDS_PER_HEADER,
+                                     src_offset + pos)
+                    self.write(dst_file_id, data[:length - pos], dst_offset + pos)
+                return length
+
+            _, dst_header = self.get_file_header(dst_file_id, 0)
+            # The tail of the last block is zeroed, so it can be shared if it will also be the last block of dst
+            whole_tail = end == src_size and end >= dst_header.size
+            first_block, first_offset = self.block_from_offset(src_offset)
+            last_block, last_offset = self.block_from_offset(end)
+
+            block_map = {}
+            for block_num in range(first_block, last_block + 1):
+                block_size = self.file_data_in_block(block_num)
+                block_start = first_offset if block_num == first_block else 0
+                block_end = last_offset if block_num == last_block else block_size
+                whole_block = block_end == block_size or whole_tail and block_end
+                if block_num % self.FILE_HEADER_INTERVAL and not block_start and whole_block:
+                    block_map[block_num] = self.file_block_id(src_file_id, block_num)
+                elif block_start < block_end:
+                    data = self.read_file_data(src_file_id, block_num)[block_start:block_end]
+                    self.write(dst_file_id, data, self.offset_from_block(block_num) + block_start)
+
+            self.map_file_blocks(dst_file_id, block_map)
+            _, dst_header = self.get_file_header(dst_file_id, 0)
+            if end > dst_header.size:
+                dst_header.size = end
+                self.write_file_header(dst_file_id, 0, dst_header)
+        return length
+
+    @check_types
+    def clone_file(self, file_id: int):
+        with self.blockfs.lock_file(write=True):
+            _, header = self.get_file_header(file_id, 0)
+            new_file_id = self.create_new_file(header.file_type)
+            self.clone_range(file_id, 0, new_file_id, 0, header.size)
+            self.write_xattrs(new_file_id, self.read_xattrs(file_id))
+        return new_file_id
+
+    @check_types
+    def seek_data(self, file_id: int, offset: int):
+        # Returns None if there is no data after offset
+        with self.blockfs.lock_file(write=False):
+            size = self.get_file_header(file_id, 0)[1].size
+            if offset >= size:
+                return None
+            block_num, _ = self.block_from_offset(offset)
+            for allocated in self.allocated_blocks(file_id, block_num):
+                data_offset = max(offset, self.offset_from_block(allocated))
+                return data_offset if data_offset < size else None
+        return None
+
+    @check_types
+    def seek_hole(self, file_id: int, offset: int):
+        # Returns None if offset is past the end of the file, which counts as a hole
+        with self.blockfs.lock_file(write=False):
+            size = self.get_file_header(file_id, 0)[1].size
+            if offset >= size:
+                return None
+            block_num, _ = self.block_from_offset(offset)
+            hole = block_num
+            for allocated in self.allocated_blocks(file_id, block_num):
+                if allocated != hole:
+                    break
+                hole += 1
+        return min(max(offset, self.offset_from_block(hole)), size)
+
+    @check_types
+    def get_file_header(self, file_id: int, header_num: int, missing_ok: bool=False):
         try:
             hcache = self.header_cache[(file_id, header_num)]
             reload, _ = self.blockfs.block_version(hcache.block_id, hcache.token)
             if not reload:
+                self.blockfs.stats.cache("header_cache", True)
                 return hcache.block_id, hcache.hdata
         except KeyError:
             pass
+        self.blockfs.stats.cache("header_cache", False)
 
         with self.blockfs.lock_file(write=False):
             for start in sorted((hnum for fid, hnum in self.header_cache.keys() if fid == file_id),
                                 key=lambda x: abs(x - header_num)):
-                hcache = self.header_cache[(file_id, start)]
+                # Other readers fill the cache too, and may have evicted it since the keys were taken
+                hcache = self.header_cache.get((file_id, start))
+                if hcache is None:
+                    continue
                 reload, _ = self.blockfs.block_version(hcache.block_id, hcache.token)
                 if not reload:
                     hdata = hcache.hdata
@@ -357,6 +788,8 @@ class FileLevelFilesystem:
                 hdata = self.read_file_header(file_id, start, block_id)
 
             while start < header_num:
+                if missing_ok and not hdata.next_header:
+                    return 0, None
                 block_id = hdata.next_header
                 assert hdata.next_header
                 start += 1
@@ -402,7 +835,9 @@ class FileLevelFilesystem:
     def get_last_file_header(self, file_id: int):
         with self.blockfs.lock_file(write=False):
             for start in sorted((hnum for fid, hnum in self.header_cache.keys() if fid == file_id), reverse=True):
-                hcache = self.header_cache[(file_id, start)]
+                hcache = self.header_cache.get((file_id, start))
+                if hcache is None:
+                    continue
                 reload, _ = self.blockfs.block_version(hcache.block_id, hcache.token)
                 if not reload:
                     hdata = hcache.hdata
@@ -442,25 +877,54 @@ class FileLevelFilesystem:
 
     @check_types
     def read_file_data(self, file_id: int, block_num: int):
-        header, block_num = divmod(block_num, self.FILE_HEADER_INTERVAL)
-
         with self.blockfs.lock_file(write=False):
+            if not self.file_block_id(file_id, block_num):
+                return b"\0" * self.file_data_in_block(block_num)
+
+            header, block_num = divmod(block_num, self.FILE_HEADER_INTERVAL)
             header_block_id, hdata = self.get_file_header(file_id, header)
             if block_num:
-                return self.blockfs.read_block(hdata.block_ids[block_num - 1])
+                data = self.blockfs.read_block(hdata.block_ids[block_num - 1])
+                if data is None:
+                    # Preallocated but never written
+                    return b"\0" * self.blockfs.LOGICAL_BLOCK_SIZE
+                return data
             elif header:
                 return self.blockfs.read_block(header_block_id)[self.FILE_CONTINUATION_HEADER_SIZE:]
             else:
                 return self.blockfs.read_block(header_block_id)[self.FILE_HEADER_SIZE:]
 
     @check_types
-    def write_file_data(self, file_id: int, block_num: int, offset: int, data: bytes):
+    def unshare_file_block(self, file_id: int, header: int, i: int, copy: bool=True):
+        # Copy on write, giving the file its own copy of a shared block
+        with self.blockfs.lock_file(write=True):
+            _, hdata = self.get_file_header(file_id, header)
+            old_block_id = hdata.block_ids[i - 1]
+            block_id, = self.allocate_blocks(1, old_block_id + 1)
+            data = self.blockfs.read_block(old_block_id) if copy else None
+            if data is not None:
+                self.blockfs.write_block(block_id, 0, data)
+            hdata.block_ids[i - 1] = block_id
+            self.write_file_header(file_id, header, hdata)
+            self.release_blocks([old_block_id])
+        return block_id
+
+    @check_types
+    def write_file_data(self, file_id: int, block_num: int, offset: int, data: bytes, cipher_data=None):
+        # cipher_data is data already encrypted, for whole data blocks
         header, block_num = divmod(block_num, self.FILE_HEADER_INTERVAL)
 
         with self.blockfs.lock_file(write=True):
             header_block_id, hdata = self.get_file_header(file_id, header)
             if block_num:
-                self.blockfs.write_block(hdata.block_ids[block_num - 1], offset, data)
+                block_id = hdata.block_ids[block_num - 1]
+                if file_id != self.refcount_file_id and self.block_references(block_id):
+                    block_id = self.unshare_file_block(file_id, header, block_num,
+                                                       copy=len(data) != self.blockfs.LOGICAL_BLOCK_SIZE)
+                if cipher_data is None:
+                    self.blockfs.write_block(block_id, offset, data)
+                else:
+                    self.blockfs.write_encrypted_block(block_id, data, cipher_data)
             elif header:
                 # Set token as we didn't change the header part
                 self.header_cache[(file_id, header)].token = self.blockfs.write_block(header_block_id,
@@ -494,19 +958,21 @@ class FileLevelFilesystem:
 
     @check_types
     def write(self, file_id: int, data: bytes, start: int=0):
+        # Whole data blocks are encrypted before taking the lock, so other threads can read meanwhile
+        encrypted = self.encrypt_data_blocks(data, start)
         with self.blockfs.lock_file(write=True):
             _, main_header = self.get_file_header(file_id, 0)
             total_file_size = main_header.size
-            total_blocks = self.num_file_blocks(file_id)
             new_file_size = max(start + len(data), total_file_size)
 
             if total_file_size != new_file_size:
                 main_header.size = new_file_size
                 self.write_file_header(file_id, 0, main_header)
 
-                block_num, offset = self.block_from_offset(new_file_size)
-                if block_num >= total_blocks:
-                    self.extend_file_blocks(file_id, block_num + 1, total_blocks - 1)
+            if data:
+                first_block, _ = self.block_from_offset(start)
+                last_block, _ = self.block_from_offset(start + len(data) - 1)
+                self.allocate_file_blocks(file_id, range(first_block, last_block + 1))
 
             pos = 0
             while pos < len(data):
@@ -514,9 +980,35 @@ class FileLevelFilesystem:
 
                 block_size = self.file_data_in_block(block_num)
                 new_pos = pos + block_size - offset
-                self.write_file_data(file_id, block_num, offset, data[pos:new_pos])
+                self.write_file_data(file_id, block_num, offset, data[pos:new_pos], encrypted.get(block_num))
                 pos = new_pos
 
+    @check_types
+    def encrypt_data_blocks(self, data: bytes, start: int):
+        encrypted = {}
+        pos = 0
+        while pos < len(data):
+            block_num, offset = self.block_from_offset(start + pos)
+            new_pos = pos + self.file_data_in_block(block_num) - offset
+            if block_num % self.FILE_HEADER_INTERVAL and not offset and new_pos <= len(data):
+                encrypted[block_num] = self.blockfs.encrypt_block(data[pos:new_pos])
+            pos = new_pos
+        return encrypted
+
+    @check_types
+    def preallocate(self, file_id: int, size: int, keep_size: bool=False, start: int=0):
+        assert size >= 0
+        with self.blockfs.lock_file(write=True):
+            if size > start:
+                first_block, _ = self.block_from_offset(start)
+                last_block, _ = self.block_from_offset(size - 1)
+                self.allocate_file_blocks(file_id, range(first_block, last_block + 1))
+
+            _, header = self.get_file_header(file_id, 0)
+            if not keep_size and size > header.size:
+                header.size = size
+                self.write_file_header(file_id, 0, header)
+
     @check_types
     def pack_xattr_block(self, next_block: int, data: bytes):
         return self.xattr_block_header_struct.pack(next_block, data)
@@ -526,70 +1018,164 @@ class FileLevelFilesystem:
         return self.xattr_block_header_struct.unpack(data)
 
     @check_types
-    def write_xattrs(self, file_id: int, attrs: dict):
-        data = b"\0".join(b"\0".join(x) for x in attrs.items())
-        initial_data, data = data[:self.XATTR_INLINE_SIZE], data[self.XATTR_INLINE_SIZE:]
+    def unpack_xattr_segment(self, data: bytes):
+        records = []
+        position = 0
+        while position + self.xattr_record_struct.size <= len(data):
+            name_length, length = self.xattr_record_struct.unpack_from(data, position)
+            if not name_length:
+                break
+            position += self.xattr_record_struct.size
+            name = data[position:position + name_length]
+            position += name_length
+            records.append([name, data[position:position + length]])
+            position += length
+        return records
 
-        with self.blockfs.lock_file(write=True):
+    @check_types
+    def pack_xattr_segment(self, records: list):
+        return b"".join(self.xattr_record_struct.pack(len(name), len(value)) + name + value
+                        for name, value in records)
+
+    @check_types
+    def xattr_segment_free(self, cache: XattrCache, segment: int):
+        size = self.XATTR_BLOCK_DATA_SIZE if segment else self.XATTR_INLINE_SIZE
+        return size - sum(self.xattr_record_struct.size + len(name) + len(value)
+                          for name, value in cache.segments[segment])
+
+    @check_types
+    def load_xattrs(self, file_id: int):
+        with self.blockfs.lock_file(write=False):
             _, hdata = self.get_file_header(file_id, 0)
-            hdata.xattr_inline = initial_data
+            cache = self.xattr_cache.get(file_id)
+            if (cache is not None and cache.inline == hdata.xattr_inline
+                    and (cache.blocks[0][0] if cache.blocks else 0) == hdata.xattr_block
+                    and not any(self.blockfs.block_version(block_id, token)[0] for block_id, token in cache.blocks)):
+                self.blockfs.stats.cache("xattr_cache", True)
+                return cache
+            self.blockfs.stats.cache("xattr_cache", False)
+
+            cache = XattrCache(hdata.xattr_inline, [], [self.unpack_xattr_segment(hdata.xattr_inline)], {})
             next_block = hdata.xattr_block
-            blocks = []
             while next_block:
-                blocks.append(next_block)
-                raw_data = self.blockfs.read_block(next_block)
-                next_block, _ = self.unpack_xattr_block(raw_data)
+                raw_data, token = self.blockfs.read_block(next_block, with_token=True)
+                cache.blocks.append([next_block, token])
+                next_block, data = self.unpack_xattr_block(raw_data)
+                cache.segments.append(self.unpack_xattr_segment(data))
 
-            block_data = []
-            blocks_needed = len(data) // self.XATTR_BLOCK_DATA_SIZE + bool(len(data) % self.XATTR_BLOCK_DATA_SIZE)
-            for i in range(blocks_needed):
-                block_data.append(data[i * self.XATTR_BLOCK_DATA_SIZE:(i + 1) * self.XATTR_BLOCK_DATA_SIZE])
+        for segment in cache.segments:
+            for name, value in segment:
+                cache.values[name] = cache.values.get(name, b"") + value
+        self.xattr_cache[file_id] = cache
+        return cache
 
-            if len(blocks) < blocks_needed:
-                blocks.extend(self.allocate_blocks(len(block_data) - len(blocks)))
-            elif blocks_needed < len(blocks):
-                rm_blocks, blocks = blocks[blocks_needed:], blocks[:blocks_needed]
-                self.deallocate_blocks(rm_blocks)
+    @check_types
+    def place_xattr(self, file_id: int, cache: XattrCache, key: bytes, value: bytes, dirty: set, prefer: list):
+        record_size = self.xattr_record_struct.size + len(key)
+        # Keep the whole value in one segment if possible, ideally the one it was already in
+        for segment in prefer + list(range(len(cache.segments))):
+            if self.xattr_segment_free(cache, segment) >= record_size + len(value):
+                cache.segments[segment].append([key, value])
+                dirty.add(segment)
+                return
+
+        # Only values too big for a block of their own are split across the free space
+        placed = False
+        for segment in range(len(cache.segments)):
+            space = self.xattr_segment_free(cache, segment) - record_size
+            if space > 0 and record_size + len(value) > self.XATTR_BLOCK_DATA_SIZE:
+                cache.segments[segment].append([key, value[:space]])
+                dirty.add(segment)
+                value = value[space:]
+                placed = True
+
+        if placed and not value:
+            return
+        space = self.XATTR_BLOCK_DATA_SIZE - record_size
+        blocks_needed = max(-(-len(value) // space), 1)
+        near = cache.blocks[-1][0] + 1 if cache.blocks else file_id
+        dirty.add(len(cache.segments) - 1)
+        for i, block_id in enumerate(self.allocate_blocks(blocks_needed, near)):
+            cache.blocks.append([block_id, None])
+            cache.segments.append([[key, value[i * space:(i + 1) * space]]])
+            dirty.add(len(cache.segments) - 1)
+
+    @check_types
+    def write_xattr_segments(self, file_id: int, cache: XattrCache, dirty: set):
+        # Drop emptied blocks from the chain, then rewrite only the segments which changed
+        blocks_to_free = []
+        for segment in range(len(cache.segments) - 1, 0, -1):
+            if not cache.segments[segment]:
+                blocks_to_free.append(cache.blocks[segment - 1][0])
+                del cache.blocks[segment - 1]
+                del cache.segments[segment]
+                dirty = {x - (x > segment) for x in dirty if x != segment}
+                dirty.add(segment - 1)
 
-            for i, (block, data) in enumerate(zip(blocks, block_data)):
-                raw_data = self.pack_xattr_block(0 if i + 1 == len(blocks) else blocks[i + 1], data)
-                self.blockfs.write_block(block, 0, raw_data)
+        with self.blockfs.lock_file(write=True):
+            _, hdata = self.get_file_header(file_id, 0)
+            xattr_block = cache.blocks[0][0] if cache.blocks else 0
+            if 0 in dirty or hdata.xattr_block != xattr_block:
+                hdata.xattr_inline = self.pack_xattr_segment(cache.segments[0]).ljust(self.XATTR_INLINE_SIZE, b"\0")
+                hdata.xattr_block = xattr_block
+                self.write_file_header(file_id, 0, hdata)
+            cache.inline = hdata.xattr_inline
+
+            for segment in sorted(dirty - {0}):
+                block = cache.blocks[segment - 1]
+                next_block = cache.blocks[segment][0] if segment < len(cache.blocks) else 0
+                raw_data = self.pack_xattr_block(next_block, self.pack_xattr_segment(cache.segments[segment]))
+                block[1] = self.blockfs.write_block(block[0], 0, raw_data, with_token=True)
 
-            hdata.xattr_block = blocks[0] if blocks else 0
-            self.write_file_header(file_id, 0, hdata)
+            self.deallocate_blocks(blocks_to_free)
+
+    @check_types
+    def write_xattrs(self, file_id: int, attrs: dict):
+        with self.blockfs.lock_file(write=True):
+            cache = self.load_xattrs(file_id)
+            cache.segments = [[] for _ in cache.segments]
+            cache.values = {}
+            dirty = set(range(len(cache.segments)))
+            for key, value in attrs.items():
+                self.place_xattr(file_id, cache, key, value, dirty, [])
+                cache.values[key] = value
+            self.write_xattr_segments(file_id, cache, dirty)
 
     @check_types
     def read_xattrs(self, file_id: int):
-        with self.blockfs.lock_file(write=False):
-            _, hdata = self.get_file_header(file_id, 0)
-            data = [hdata.xattr_inline]
-            next_block = hdata.xattr_block
-            while next_block:
-                raw_data = self.blockfs.read_block(next_block)
-                next_block, data_part = self.unpack_xattr_block(raw_data)
-                data.append(data_part)
-        data = b"".join(data).rstrip(b"\0")
-        if data:
-            iter_items = iter(data.split(b"\0"))
-            return {i: next(iter_items) for i in iter_items}
-        return {}
+        return dict(self.load_xattrs(file_id).values)
 
     @check_types
     def lookup_xattr(self, file_id: int, key: bytes):
-        return self.read_xattrs(file_id)[key]
+        return self.load_xattrs(file_id).values[key]
+
+    @check_types
+    def remove_xattr_records(self, cache: XattrCache, key: bytes):
+        segments = []
+        for segment, records in enumerate(cache.segments):
+            if any(name == key for name, _ in records):
+                cache.segments[segment] = [record for record in records if record[0] != key]
+                segments.append(segment)
+        return segments
 
     @check_types
     def set_xattr(self, file_id: int, key: bytes, value: bytes, create_only: bool=False, replace_only: bool=False):
-        data = self.read_xattrs(file_id)
-        if create_only and key in data:
-            raise KeyAlreadyExists()
-        if replace_only and key not in data:
-            raise KeyDoesNotExist()
-        data[key] = value
-        self.write_xattrs(file_id, data)
+        assert 0 < len(key) < 256
+        with self.blockfs.lock_file(write=True):
+            cache = self.load_xattrs(file_id)
+            if create_only and key in cache.values:
+                raise KeyAlreadyExists()
+            if replace_only and key not in cache.values:
+                raise KeyDoesNotExist()
+            old_segments = self.remove_xattr_records(cache, key)
+            dirty = set(old_segments)
+            self.place_xattr(file_id, cache, key, value, dirty, old_segments)
+            cache.values[key] = value
+            self.write_xattr_segments(file_id, cache, dirty)
 
     @check_types
     def delete_xattr(self, file_id: int, key: bytes):
-        data = self.read_xattrs(file_id)
-        del data[key]
-        self.write_xattrs(file_id, data)
+        with self.blockfs.lock_file(write=True):
+            cache = self.load_xattrs(file_id)
+            del cache.values[key]
+            self.write_xattr_segments(file_id, cache, set(self.remove_xattr_records(cache, key)))
@@ -87,6 +87,31 @@ enum fuse_fill_dir_flags {
 typedef int (*fuse_fill_dir_t) (void *buf, const char *name,
 				const struct stat *stbuf, off_t off,
 				enum fuse_fill_dir_flags flags);
+
+/**
+ * Connection information, passed to the ->init() method
+ */
+struct fuse_conn_info {
+	/** Maximum size of the write buffer */
+	unsigned max_write;
+
+	/** Maximum size of read requests */
+	unsigned max_read;
+
+	/** Maximum readahead */
+	unsigned max_readahead;
+
+	/** Capability flags that the kernel supports (read-only) */
+	unsigned capable;
+
+	/** Capability flags that the filesystem wants to enable */
+	unsigned want;
+	...;
+};
+
+/** Use the kernel's writeback cache for buffered writes */
+#define FUSE_CAP_WRITEBACK_CACHE ...
+
 /**
  * Configuration of the high-level API
  *
@@ -729,6 +754,11 @@ struct fuse_operations {
                                     off_t offset_in, const char *path_out,
                                     struct fuse_file_info *fi_out,
                                     off_t offset_out, size_t size, int flags);
+
+	/**
+	 * Find next data or hole after the specified offset
+	 */
+	off_t (*lseek) (const char *, off_t off, int whence, struct fuse_file_info *);
 };
 
 /** Extra context that may be needed by some filesystems
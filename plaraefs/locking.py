@@ -13,6 +13,12 @@ if os.name == "nt":  # pragma: no cover
     def unlock_file(file):
         msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
 
+    def claim_file(file, exclusive):
+        return True
+
+    def unclaim_file(file):
+        pass
+
 
 else:
     import fcntl
@@ -26,3 +32,15 @@ else:
 
     def unlock_file(file):
         fcntl.lockf(file.fileno(), fcntl.LOCK_UN)
+
+    # flock locks are separate from the lockf ones above, so are held for as long as the file is in use rather than
+    # for an operation, and are given up rather than waited for
+    def claim_file(file, exclusive):
+        try:
+            fcntl.flock(file.fileno(), (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def unclaim_file(file):
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
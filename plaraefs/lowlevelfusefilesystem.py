@@ -0,0 +1,383 @@
+from errno import *
+from signal import signal, SIGINT, SIG_DFL
+import collections
+import logging
+import os
+import threading
+import time
+
+from .fusefilesystem import FUSEFilesystem, ffi, libfuse
+from .pathlevelfilesystem import FileType
+from .utils import LRUDict
+
+
+FUSE_ROOT_ID = 1
+
+logger = logging.getLogger(__name__)
+
+
+class LowLevelFUSEFilesystem(FUSEFilesystem):
+    """
+    Binding to libfuse's inode based low level API, with file ids as inode numbers, so the kernel
+    caches lookups instead of every operation resolving its path again.
+    """
+
+    # Seconds the kernel may cache names and attributes for, processes share these caches so the
+    # access controller's lookup checks are only made when they expire
+    ENTRY_TIMEOUT = 1.0
+    ATTR_TIMEOUT = 1.0
+    NEGATIVE_TIMEOUT = 1.0
+
+    # Operations which don't reply to the request, and ones which aren't requests at all
+    NO_REPLY = {"forget"}
+    NOT_REQUESTS = {"init", "destroy"}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.request = threading.local()
+        # Number of lookups the kernel holds for each file id, these files can't be freed yet
+        self.lookup_counts = collections.Counter()
+        self.lookup_counts_lock = threading.Lock()
+        options = self.options
+        self.entry_timeout = self.ENTRY_TIMEOUT if options.entry_timeout is None else options.entry_timeout
+        self.attr_timeout = self.ATTR_TIMEOUT if options.attr_timeout is None else options.attr_timeout
+        self.negative_timeout = self.NEGATIVE_TIMEOUT if options.negative_timeout is None else options.negative_timeout
+        # Sizes of files when they were last opened, for auto_cache
+        self.open_sizes = LRUDict(self.DENTRY_CACHE_SIZE)
+
+    def mount(self, mount_point):
+        self.mount_point = mount_point
+        self.open_filesystem()
+
+        args = ["plaraefs", "-o", "fsname=plaraefs", "-o", "allow_other"] + self.mount_args()
+        argv = [ffi.new("char[]", arg.encode()) for arg in args]
+        argv_array = ffi.new("char *[]", argv)
+        fuse_args = ffi.new("struct fuse_args*", [len(args), argv_array, 0])
+        fuse_ops = ffi.new("struct fuse_lowlevel_ops*")
+        self.start_metrics_dumper()
+
+        methods = [x[3:] for x in self.__class__.__dict__ if x.startswith("ll_")]
+        self.keep_alive = []
+        for method in methods:
+            if hasattr(fuse_ops, method):
+                cdef = ffi.typeof(getattr(fuse_ops, method)).cname
+
+                def w(req, *args, _method=method):
+                    return self(_method, req, *args)
+
+                w.__name__ = method + "_wrapper"
+                w.__qualname__ = method + "_wrapper"
+
+                callback = ffi.callback(cdef, w)
+                self.keep_alive.append(callback)
+                setattr(fuse_ops, method, callback)
+
+        try:
+            old_handler = signal(SIGINT, SIG_DFL)
+        except ValueError:
+            old_handler = SIG_DFL
+
+        session = libfuse.fuse_session_new(fuse_args, fuse_ops, ffi.sizeof("struct fuse_lowlevel_ops"), ffi.NULL)
+        if session == ffi.NULL:
+            logger.critical("Could not create FUSE session")
+            raise RuntimeError()
+        try:
+            if libfuse.fuse_set_signal_handlers(session):
+                raise RuntimeError()
+            try:
+                if libfuse.fuse_session_mount(session, str(mount_point).encode()):
+                    logger.critical("Mount failed")
+                    raise RuntimeError()
+                try:
+                    err = libfuse.fuse_session_loop_mt(session, 0)
+                finally:
+                    libfuse.fuse_session_unmount(session)
+            finally:
+                libfuse.fuse_remove_signal_handlers(session)
+        finally:
+            libfuse.fuse_session_destroy(session)
+
+        try:
+            signal(SIGINT, old_handler)
+        except ValueError:
+            pass
+
+        if err:
+            logger.critical(f"FUSE session failed with error [{os.strerror(abs(err))}]")
+            raise RuntimeError(err)
+
+    def process_info(self):
+        ctx = libfuse.fuse_req_ctx(self.request.req)
+        return ctx.uid, ctx.gid, ctx.pid
+
+    def __call__(self, op, req, *args):
+        if op in self.NOT_REQUESTS:
+            try:
+                getattr(self, "ll_" + op)(req, *args)
+            except Exception:
+                logger.error(f"<- {op} [Unhandled exception]", exc_info=True)
+            return
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug(f"-> {op} {repr(args)}")
+        self.request.req = req
+        t = time.perf_counter() if debug or self.metrics else 0
+        try:
+            getattr(self, "ll_" + op)(req, *args)
+            if debug:
+                logger.debug(f"<- {op} in {time.perf_counter() - t} seconds")
+            if self.metrics:
+                self.metrics.record(op, time.perf_counter() - t)
+            return
+        except PermissionError as e:
+            val = e.args[0] if e.args else EACCES
+            logger.warning(f"<- {op} {repr(args)} Permission denied with [{os.strerror(val)}]")
+        except OSError as e:
+            val = e.args[0] if e.args else EACCES
+            if debug:
+                logger.debug(f"<- {op} {repr(args)} [{os.strerror(val)}]")
+        except Exception:
+            logger.error(f"<- {op} {repr(args)} [Unhandled exception]", exc_info=True)
+            val = EACCES
+        if self.metrics:
+            self.metrics.record(op, time.perf_counter() - t, True)
+        if op not in self.NO_REPLY:
+            libfuse.fuse_reply_err(req, val)
+
+    def file_id(self, ino):
+        return self.root_file_id if ino == FUSE_ROOT_ID else ino
+
+    def inode(self, file_id):
+        return FUSE_ROOT_ID if file_id == self.root_file_id else file_id
+
+    def keep_cache(self, file_id):
+        if file_id == self.METRICS_FILE_ID:
+            return False
+        # Without mtimes, auto_cache can only notice changes to the size
+        if self.options.kernel_cache:
+            return True
+        if not self.options.auto_cache:
+            return False
+        size = self.filefs.get_file_header(file_id, 0)[1].size
+        keep = self.open_sizes.get(file_id) == size
+        self.open_sizes[file_id] = size
+        return keep
+
+    def files_in_use(self):
+        with self.lookup_counts_lock:
+            return super().files_in_use() | set(self.lookup_counts)
+
+    def entry_param(self, file_id, header=None):
+        entry = ffi.new("struct fuse_entry_param*")
+        entry.ino = self.inode(file_id)
+        self.fill_stat(file_id, entry.attr, header)
+        entry.attr.st_ino = entry.ino
+        entry.attr_timeout = self.attr_timeout
+        entry.entry_timeout = self.entry_timeout
+        return entry
+
+    def reply_entry(self, req, file_id, info=None):
+        entry = self.entry_param(file_id)
+        with self.lookup_counts_lock:
+            self.lookup_counts[file_id] += 1
+        if info is None:
+            err = libfuse.fuse_reply_entry(req, entry)
+        else:
+            err = libfuse.fuse_reply_create(req, entry, info)
+        if err:
+            # The kernel never got the entry, so won't forget it
+            self.forget_file(file_id, 1)
+
+    def forget_file(self, file_id, nlookup):
+        with self.lookup_counts_lock:
+            self.lookup_counts[file_id] -= nlookup
+            if self.lookup_counts[file_id] > 0:
+                return
+            del self.lookup_counts[file_id]
+        # It may have been waiting to be freed
+        self.reclaim_wakeup.set()
+
+    def ll_access(self, req, ino, mask):
+        self.check_access(self.file_id(ino), mask)
+        libfuse.fuse_reply_err(req, 0)
+
+    def ll_copy_file_range(self, req, ino_in, offset_in, info_in, ino_out, offset_out, info_out, size, flags):
+        copied = self.copy_range(self.file_id(ino_in), offset_in, self.file_id(ino_out), offset_out, size, flags)
+        libfuse.fuse_reply_write(req, copied)
+
+    def ll_create(self, req, parent, name, mode, info):
+        file_id = self.create_entry(self.file_id(parent), ffi.string(name), FileType.file)
+        info.fh = self.open_handle(file_id, info.flags)
+        self.reply_entry(req, file_id, info)
+
+    def ll_destroy(self, userdata):
+        self.destroy(None)
+
+    def ll_fallocate(self, req, ino, mode, offset, length, info):
+        self.allocate(self.file_id(ino), mode, offset, length)
+        libfuse.fuse_reply_err(req, 0)
+
+    def ll_flush(self, req, ino, info):
+        self.flush_handle(self.handles[info.fh])
+        libfuse.fuse_reply_err(req, 0)
+
+    def ll_forget(self, req, ino, nlookup):
+        self.forget_file(self.file_id(ino), nlookup)
+        libfuse.fuse_reply_none(req)
+
+    def ll_fsync(self, req, ino, datasync, info):
+        self.flush_handle(self.handles[info.fh])
+        libfuse.fuse_reply_err(req, 0)
+
+    def ll_fsyncdir(self, req, ino, datasync, info):
+        libfuse.fuse_reply_err(req, 0)
+
+    def ll_getattr(self, req, ino, info):
+        file_id = self.file_id(ino)
+        if file_id != self.METRICS_FILE_ID:
+            self.access_violation(self.accesscontroller.file_read(file=file_id))
+        result = ffi.new("struct stat*")
+        self.fill_stat(file_id, result)
+        result.st_ino = ino
+        libfuse.fuse_reply_attr(req, result, self.attr_timeout)
+
+    def ll_getxattr(self, req, ino, name, size):
+        value = self.get_xattr(self.file_id(ino), ffi.string(name))
+        if not size:
+            libfuse.fuse_reply_xattr(req, len(value))
+        elif len(value) > size:
+            raise OSError(ERANGE)
+        else:
+            libfuse.fuse_reply_buf(req, value, len(value))
+
+    def ll_listxattr(self, req, ino, size):
+        value = self.list_xattrs(self.file_id(ino))
+        if not size:
+            libfuse.fuse_reply_xattr(req, len(value))
+        elif len(value) > size:
+            raise OSError(ERANGE)
+        else:
+            libfuse.fuse_reply_buf(req, value, len(value))
+
+    def ll_lookup(self, req, parent, name):
+        try:
+            file_id = self.lookup_child(self.file_id(parent), ffi.string(name))
+        except PermissionError:
+            raise
+        except OSError as e:
+            if e.args[:1] != (ENOENT,):
+                raise
+            # Let the kernel cache that the name doesn't exist
+            entry = ffi.new("struct fuse_entry_param*")
+            entry.entry_timeout = self.negative_timeout
+            libfuse.fuse_reply_entry(req, entry)
+            return
+        self.reply_entry(req, file_id)
+
+    def ll_init(self, userdata, conn):
+        self.configure_connection(conn)
+
+    def ll_lseek(self, req, ino, offset, whence, info):
+        libfuse.fuse_reply_lseek(req, self.seek(self.file_id(ino), offset, whence))
+
+    def ll_mkdir(self, req, parent, name, mode):
+        self.reply_entry(req, self.create_entry(self.file_id(parent), ffi.string(name), FileType.dir))
+
+    def ll_open(self, req, ino, info):
+        file_id = self.file_id(ino)
+        self.open_file(file_id, info.flags)
+        info.fh = self.open_handle(file_id, info.flags)
+        info.keep_cache = self.keep_cache(file_id)
+        info.direct_io = file_id == self.METRICS_FILE_ID
+        libfuse.fuse_reply_open(req, info)
+
+    def ll_opendir(self, req, ino, info):
+        file_id = self.file_id(ino)
+        self.open_directory(file_id)
+        info.fh = self.open_handle(file_id)
+        libfuse.fuse_reply_open(req, info)
+
+    def ll_read(self, req, ino, size, offset, info):
+        data = self.read_file(self.file_id(ino), size, offset, self.handles[info.fh])
+        libfuse.fuse_reply_buf(req, data, len(data))
+
+    def ll_readdir(self, req, ino, size, offset, info):
+        handle = self.handles[info.fh]
+        buf = ffi.new("char[]", size)
+        result = ffi.new("struct stat*")
+        position = 0
+        for next_offset, name, file_id, _ in self.list_directory(handle, offset):
+            result.st_ino = self.inode(file_id)
+            length = libfuse.fuse_add_direntry(req, buf + position, size - position, name, result, next_offset)
+            if length > size - position:
+                break
+            position += length
+            if name not in (b".", b".."):
+                handle.cursor = next_offset, name
+        libfuse.fuse_reply_buf(req, buf, position)
+
+    def ll_readdirplus(self, req, ino, size, offset, info):
+        handle = self.handles[info.fh]
+        buf = ffi.new("char[]", size)
+        position = 0
+        looked_up = []
+        for next_offset, name, file_id, header in self.list_directory(handle, offset, plus=True):
+            entry = self.entry_param(file_id, header)
+            length = libfuse.fuse_add_direntry_plus(req, buf + position, size - position, name, entry, next_offset)
+            if length > size - position:
+                break
+            position += length
+            if name not in (b".", b".."):
+                handle.cursor = next_offset, name
+                looked_up.append(file_id)
+        # The entries are lookups as far as the kernel is concerned, and it forgets them in the same way
+        with self.lookup_counts_lock:
+            self.lookup_counts.update(looked_up)
+        if libfuse.fuse_reply_buf(req, buf, position):
+            for file_id in looked_up:
+                self.forget_file(file_id, 1)
+
+    def ll_release(self, req, ino, info):
+        self.close_handle(info.fh)
+        libfuse.fuse_reply_err(req, 0)
+
+    def ll_releasedir(self, req, ino, info):
+        self.close_handle(info.fh)
+        libfuse.fuse_reply_err(req, 0)
+
+    def ll_removexattr(self, req, ino, name):
+        self.remove_xattr(self.file_id(ino), ffi.string(name))
+        libfuse.fuse_reply_err(req, 0)
+
+    def ll_rename(self, req, parent, name, new_parent, new_name, flags):
+        self.rename_entry(self.file_id(parent), ffi.string(name), self.file_id(new_parent), ffi.string(new_name), flags)
+        libfuse.fuse_reply_err(req, 0)
+
+    def ll_rmdir(self, req, parent, name):
+        self.remove_entry(self.file_id(parent), ffi.string(name), FileType.dir)
+        libfuse.fuse_reply_err(req, 0)
+
+    def ll_setattr(self, req, ino, attr, to_set, info):
+        file_id = self.file_id(ino)
+        if to_set & (libfuse.FUSE_SET_ATTR_MODE | libfuse.FUSE_SET_ATTR_UID | libfuse.FUSE_SET_ATTR_GID):
+            raise OSError(ENOSYS)
+        if to_set & libfuse.FUSE_SET_ATTR_SIZE:
+            self.truncate_file(file_id, attr.st_size)
+        self.ll_getattr(req, ino, info)
+
+    def ll_setxattr(self, req, ino, name, value, size, flags):
+        self.set_xattr(self.file_id(ino), ffi.string(name), ffi.buffer(value, size)[:], flags)
+        libfuse.fuse_reply_err(req, 0)
+
+    def ll_statfs(self, req, ino):
+        result = ffi.new("struct statvfs*")
+        self.fill_statfs(result)
+        libfuse.fuse_reply_statfs(req, result)
+
+    def ll_unlink(self, req, parent, name):
+        self.remove_entry(self.file_id(parent), ffi.string(name), FileType.file)
+        libfuse.fuse_reply_err(req, 0)
+
+    def ll_write(self, req, ino, buf, size, offset, info):
+        self.write_file(self.file_id(ino), ffi.buffer(buf, size)[:], offset, self.handles[info.fh])
+        libfuse.fuse_reply_write(req, size)
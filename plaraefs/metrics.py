@@ -0,0 +1,73 @@
+import bisect
+import collections
+import os
+import pathlib
+import threading
+
+
+# Latency buckets are HDR style, each power of two microseconds is split into SUB_BUCKETS linear steps so every bound
+# is within 1 / SUB_BUCKETS of the latencies it counts, from a microsecond to a couple of minutes
+SUB_BUCKETS = 4
+MAX_EXPONENT = 26
+BOUNDS = sorted({2 ** e * (SUB_BUCKETS + s) / SUB_BUCKETS / 1e6
+                 for e in range(MAX_EXPONENT + 1) for s in range(SUB_BUCKETS)})
+
+
+class Metrics:
+    """
+    Counters and latency histograms per FUSE operation, in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # op -> counts per bucket, the last being everything above the largest bound
+        self.buckets = {}
+        self.seconds = collections.Counter()
+        self.errors = collections.Counter()
+
+    def record(self, op, seconds, error=False):
+        i = bisect.bisect_left(BOUNDS, seconds)
+        with self.lock:
+            buckets = self.buckets.get(op)
+            if buckets is None:
+                buckets = self.buckets[op] = [0] * (len(BOUNDS) + 1)
+            buckets[i] += 1
+            self.seconds[op] += seconds
+            if error:
+                self.errors[op] += 1
+
+    def count(self, op):
+        with self.lock:
+            return sum(self.buckets.get(op, ()))
+
+    def prometheus(self):
+        with self.lock:
+            buckets = {op: list(counts) for op, counts in self.buckets.items()}
+            seconds = dict(self.seconds)
+            errors = dict(self.errors)
+
+        lines = ["# HELP plaraefs_fuse_requests_total FUSE requests handled",
+                 "# TYPE plaraefs_fuse_requests_total counter"]
+        lines.extend(f'plaraefs_fuse_requests_total{{op="{op}"}} {sum(buckets[op])}' for op in sorted(buckets))
+        lines.extend(["# HELP plaraefs_fuse_errors_total FUSE requests which returned an error",
+                      "# TYPE plaraefs_fuse_errors_total counter"])
+        lines.extend(f'plaraefs_fuse_errors_total{{op="{op}"}} {errors.get(op, 0)}' for op in sorted(buckets))
+        lines.extend(["# HELP plaraefs_fuse_request_seconds Time taken to handle FUSE requests",
+                      "# TYPE plaraefs_fuse_request_seconds histogram"])
+        for op in sorted(buckets):
+            total = 0
+            for bound, count in zip(BOUNDS + [float("inf")], buckets[op]):
+                total += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'plaraefs_fuse_request_seconds_bucket{{op="{op}",le="{le}"}} {total}')
+            lines.append(f'plaraefs_fuse_request_seconds_sum{{op="{op}"}} {seconds[op]}')
+            lines.append(f'plaraefs_fuse_request_seconds_count{{op="{op}"}} {total}')
+        return "\n".join(lines) + "\n"
+
+
+def write_atomically(path, text):
+    # Replaced atomically, so a scraper never reads half a file
+    path = pathlib.Path(path)
+    temp = path.with_name(path.name + ".tmp")
+    temp.write_text(text)
+    os.replace(str(temp), str(path))
@@ -1,9 +1,10 @@
+import bisect
 import enum
 import attr
 import struct
 
 from .filelevelfilesystem import FileLevelFilesystem
-from .utils import check_types
+from .utils import check_types, LRUDict
 
 
 @attr.s(slots=True)
@@ -12,6 +13,27 @@ class DirectoryEntry:
     file_id = attr.ib()
 
 
+@attr.s(slots=True)
+class DirectoryNode:
+    leaf = attr.ib()
+    # Next leaf for leaves, first child for internal nodes
+    link = attr.ib()
+    # For internal nodes, the file id is the node holding the names from this one up to the next
+    entries = attr.ib()
+    # Only kept in the root
+    node_count = attr.ib(default=0)
+    entry_count = attr.ib(default=0)
+
+
+@attr.s(slots=True)
+class DirectoryNodeCache:
+    # The decoded node, shared by every lookup so never changed, and the names of its entries to bisect
+    node = attr.ib()
+    names = attr.ib()
+    block_id = attr.ib()
+    token = attr.ib()
+
+
 class FileType(enum.Enum):
     file = 0
     dir = 1
@@ -19,19 +41,36 @@ class FileType(enum.Enum):
 
 class PathLevelFilesystem:
     ROOT_FILE_ID = 1
+    SYSTEM_FILE_ID = 2
     FILENAME_SIZE = 256
 
-    __slots__ = ["filefs", "DIRECTORY_ENTRY_SIZE", "directory_entry_struct"]
+    ORPHANS = b"orphans"
+    REFCOUNTS = b"refcounts"
+    SNAPSHOTS = b"snapshots"
+    BULK_WRITE_NODES = 256
+    DIRECTORY_NODE_CACHE_SIZE = 4096
+
+    __slots__ = ["filefs", "node_cache", "DIRECTORY_ENTRY_SIZE", "DIRECTORY_NODE_ENTRIES",
+                 "directory_entry_struct", "directory_node_header_struct"]
 
     def __init__(self, filefs: FileLevelFilesystem):
         self.filefs = filefs
+        # (file id, node number) -> DirectoryNodeCache, for lookups which don't change the directory
+        self.node_cache = LRUDict(self.DIRECTORY_NODE_CACHE_SIZE)
         self.DIRECTORY_ENTRY_SIZE = self.FILENAME_SIZE + self.filefs.blockfs.BLOCK_ID_SIZE
         self.directory_entry_struct = struct.Struct(f"<{self.FILENAME_SIZE}sQ")
+        self.directory_node_header_struct = struct.Struct("<BHQQQ")
+        # Each node is stored in one file block, and the first block is the smallest
+        self.DIRECTORY_NODE_ENTRIES = ((self.filefs.FILE_HEADER_DATA_SIZE - self.directory_node_header_struct.size)
+                                       // self.DIRECTORY_ENTRY_SIZE)
+        self.filefs.refcount_file_id = self.system_file(self.REFCOUNTS, FileType.file)
 
     @classmethod
     @check_types
     def initialise(cls, filefs: FileLevelFilesystem):
-        filefs.create_new_file(FileType.dir.value)
+        assert filefs.create_new_file(FileType.dir.value) == cls.ROOT_FILE_ID
+        # Hidden directory for the filesystem's own bookkeeping
+        assert filefs.create_new_file(FileType.dir.value) == cls.SYSTEM_FILE_ID
 
     @check_types
     def unpack_directory_entry(self, data: bytes, offset: int=0):
@@ -43,53 +82,268 @@ class PathLevelFilesystem:
         return self.directory_entry_struct.pack(entry.name, entry.file_id)
 
     @check_types
-    def search_directory(self, file_id: int, name: bytes):
+    def unpack_directory_node(self, data: bytes):
+        leaf, count, link, node_count, entry_count = self.directory_node_header_struct.unpack_from(data)
+        entries = [self.unpack_directory_entry(data, self.directory_node_header_struct.size
+                                               + i * self.DIRECTORY_ENTRY_SIZE)
+                   for i in range(count)]
+        return DirectoryNode(bool(leaf), link, entries, node_count, entry_count)
+
+    @check_types
+    def pack_directory_node(self, node: DirectoryNode):
+        return self.directory_node_header_struct.pack(node.leaf,
+                                                      len(node.entries),
+                                                      node.link,
+                                                      node.node_count,
+                                                      node.entry_count) + b"".join(map(self.pack_directory_entry,
+                                                                                       node.entries))
+
+    @check_types
+    def read_directory_node(self, file_id: int, node_num: int):
+        return self.unpack_directory_node(self.filefs.read_file_data(file_id, node_num))
+
+    @check_types
+    def write_directory_node(self, file_id: int, node_num: int, node: DirectoryNode):
+        self.node_cache.pop((file_id, node_num), None)
+        self.filefs.write(file_id, self.pack_directory_node(node), self.filefs.offset_from_block(node_num))
+
+    @check_types
+    def directory_path(self, file_id: int, name: bytes):
+        # Nodes from the root to the leaf which does or would contain name, empty if the directory is empty
         _, header = self.filefs.get_file_header(file_id, 0)
         assert header.file_type == FileType.dir.value
-        assert header.size % self.DIRECTORY_ENTRY_SIZE == 0
         if not header.size:
-            return None, 0
-        start = 0
-        end = header.size // self.DIRECTORY_ENTRY_SIZE
-        # Binary search
+            return []
+        path = []
+        node_num = 0
         while True:
-            middle = (start + end) // 2
-            entry = self.unpack_directory_entry(self.filefs.read(file_id, self.DIRECTORY_ENTRY_SIZE, middle * self.DIRECTORY_ENTRY_SIZE))
-            if entry.name == name:
-                return entry, middle * self.DIRECTORY_ENTRY_SIZE
-            elif entry.name < name:
-                start = middle + 1
-            else:
-                end = middle
-            if start == end:
-                return None, start * self.DIRECTORY_ENTRY_SIZE
+            node = self.read_directory_node(file_id, node_num)
+            path.append((node_num, node))
+            if node.leaf:
+                return path
+            i = bisect.bisect_right([entry.name for entry in node.entries], name)
+            node_num = node.entries[i - 1].file_id if i else node.link
+
+    @check_types
+    def cached_directory_node(self, file_id: int, node_num: int):
+        # Validated against the token of the block holding the node, which changes whenever anyone writes it
+        blockfs = self.filefs.blockfs
+        with blockfs.lock_file(write=False):
+            block_id = self.filefs.file_block_id(file_id, node_num)
+            cache = self.node_cache.get((file_id, node_num))
+            if cache is not None and cache.block_id == block_id:
+                reload, _ = blockfs.block_version(block_id, cache.token)
+                if not reload:
+                    blockfs.stats.cache("directory_node_cache", True)
+                    return cache
+            blockfs.stats.cache("directory_node_cache", False)
+            data, token = blockfs.read_block(block_id, with_token=True)
+        node = self.unpack_directory_node(data[blockfs.LOGICAL_BLOCK_SIZE - self.filefs.file_data_in_block(node_num):])
+        cache = DirectoryNodeCache(node, [entry.name for entry in node.entries], block_id, token)
+        self.node_cache[(file_id, node_num)] = cache
+        return cache
+
+    @check_types
+    def directory_leaf(self, file_id: int, name: bytes):
+        # Cached leaf which does or would contain name, None if the directory is empty
+        with self.filefs.blockfs.lock_file(write=False):
+            _, header = self.filefs.get_file_header(file_id, 0)
+            assert header.file_type == FileType.dir.value
+            if not header.size:
+                return None
+            cache = self.cached_directory_node(file_id, 0)
+            while not cache.node.leaf:
+                i = bisect.bisect_right(cache.names, name)
+                cache = self.cached_directory_node(file_id, cache.node.entries[i - 1].file_id if i else cache.node.link)
+            return cache
+
+    @check_types
+    def search_directory(self, file_id: int, name: bytes):
+        leaf = self.directory_leaf(file_id, name)
+        return None if leaf is None else self.search_leaf(leaf, name)
+
+    @check_types
+    def search_leaf(self, leaf: DirectoryNodeCache, name: bytes):
+        i = bisect.bisect_left(leaf.names, name)
+        if i < len(leaf.names) and leaf.names[i] == name:
+            return DirectoryEntry(name, leaf.node.entries[i].file_id)
+        return None
+
+    @check_types
+    def split_directory_node(self, file_id: int, root: DirectoryNode, node_num: int, node: DirectoryNode):
+        # Moves the top half of node into a new node, returning the separating name and the new node's number
+        new_node_num = root.node_count
+        root.node_count += 1
+        middle = len(node.entries) // 2
+        if node.leaf:
+            new_node = DirectoryNode(True, node.link, node.entries[middle:])
+            node.link = new_node_num
+            separator = new_node.entries[0].name
+        else:
+            new_node = DirectoryNode(False, node.entries[middle].file_id, node.entries[middle + 1:])
+            separator = node.entries[middle].name
+        node.entries = node.entries[:middle]
+        if node_num:
+            self.write_directory_node(file_id, node_num, node)
+        self.write_directory_node(file_id, new_node_num, new_node)
+        return separator, new_node_num
 
     @check_types
     def add_directory_entry(self, file_id: int, entry: DirectoryEntry, overwrite: bool=False):
-        existing_entry, position = self.search_directory(file_id, entry.name)
-        if existing_entry:
-            if not overwrite:
+        with self.filefs.blockfs.lock_file(write=True):
+            path = self.directory_path(file_id, entry.name)
+            if not path:
+                self.write_directory_node(file_id, 0, DirectoryNode(True, 0, [entry], 1, 1))
+                return
+
+            root = path[0][1]
+            node_num, node = path[-1]
+            names = [existing.name for existing in node.entries]
+            i = bisect.bisect_left(names, entry.name)
+            if i < len(names) and names[i] == entry.name:
+                if not overwrite:
+                    raise FileExistsError()
+                node.entries[i] = entry
+                self.write_directory_node(file_id, node_num, node)
+                return
+            node.entries.insert(i, entry)
+            root.entry_count += 1
+
+            # Split full nodes, bottom up, the root is always written as it holds the counts
+            for depth in range(len(path) - 1, -1, -1):
+                node_num, node = path[depth]
+                if len(node.entries) <= self.DIRECTORY_NODE_ENTRIES:
+                    if node_num:
+                        self.write_directory_node(file_id, node_num, node)
+                    break
+                if node_num:
+                    separator, new_node_num = self.split_directory_node(file_id, root, node_num, node)
+                    parent = path[depth - 1][1]
+                    i = bisect.bisect_right([existing.name for existing in parent.entries], separator)
+                    parent.entries.insert(i, DirectoryEntry(separator, new_node_num))
+                else:
+                    # The root stays at node 0, so its contents move to a new node which is then split
+                    moved = DirectoryNode(root.leaf, root.link, root.entries)
+                    moved_node_num = root.node_count
+                    root.node_count += 1
+                    separator, new_node_num = self.split_directory_node(file_id, root, moved_node_num, moved)
+                    root.leaf = False
+                    root.link = moved_node_num
+                    root.entries = [DirectoryEntry(separator, new_node_num)]
+            self.write_directory_node(file_id, 0, root)
+
+    @check_types
+    def add_directory_entries(self, file_id: int, entries: list):
+        # An empty directory is built bottom up from the sorted entries with full nodes, otherwise they are inserted
+        entries = sorted(entries, key=lambda entry: entry.name)
+        with self.filefs.blockfs.lock_file(write=True):
+            if self.filefs.get_file_header(file_id, 0)[1].size:
+                for entry in entries:
+                    self.add_directory_entry(file_id, entry)
+                return
+            if any(a.name == b.name for a, b in zip(entries, entries[1:])):
                 raise FileExistsError()
-            self.filefs.write(file_id, self.pack_directory_entry(entry), position)
-            return
-        entries_after = self.filefs.read(file_id, -1, position)
-        self.filefs.write(file_id, self.pack_directory_entry(entry) + entries_after, position)
+            if not entries:
+                return
+
+            # Each level is a list of the lowest name under each node and the node, until one node can be the root
+            size = self.DIRECTORY_NODE_ENTRIES
+            level = [(entries[i].name, DirectoryNode(True, 0, entries[i:i + size]))
+                     for i in range(0, len(entries), size)]
+            nodes = {}
+            node_count = 1
+            while len(level) > 1:
+                node_nums = range(node_count, node_count + len(level))
+                node_count += len(level)
+                if level[0][1].leaf:
+                    for (_, node), next_node_num in zip(level, node_nums[1:]):
+                        node.link = next_node_num
+                nodes.update(zip(node_nums, (node for _, node in level)))
+                # Each parent links to its first child and has an entry for each of the rest
+                parents = []
+                for i in range(0, len(level), size + 1):
+                    children = [DirectoryEntry(name, node_num) for node_num, (name, _)
+                                in zip(node_nums[i:i + size + 1], level[i:i + size + 1])]
+                    parents.append((children[0].name, DirectoryNode(False, children[0].file_id, children[1:])))
+                level = parents
+            root = nodes[0] = level[0][1]
+            root.node_count = node_count
+            root.entry_count = len(entries)
+
+            # Nodes are consecutive file blocks, so a batch of them is written at once, padded to fill their blocks
+            for start in range(0, node_count, self.BULK_WRITE_NODES):
+                node_nums = range(start, min(start + self.BULK_WRITE_NODES, node_count))
+                data = b"".join(self.pack_directory_node(nodes[node_num]).ljust(
+                    self.filefs.file_data_in_block(node_num) if node_num + 1 < node_count else 0, b"\0")
+                    for node_num in node_nums)
+                self.filefs.write(file_id, data, self.filefs.offset_from_block(start))
+                for node_num in node_nums:
+                    self.node_cache.pop((file_id, node_num), None)
 
     @check_types
     def remove_directory_entry(self, file_id: int, name: bytes):
-        existing_entry, position = self.search_directory(file_id, name)
-        if not existing_entry:
-            raise FileNotFoundError()
-        entries_after = self.filefs.read(file_id, -1, position + self.DIRECTORY_ENTRY_SIZE)
-        self.filefs.truncate_file_size(file_id, position + len(entries_after))
-        self.filefs.write(file_id, entries_after, position)
+        # Nodes are not merged, empty leaves are left for later inserts
+        with self.filefs.blockfs.lock_file(write=True):
+            path = self.directory_path(file_id, name)
+            if not path:
+                raise FileNotFoundError()
+            root = path[0][1]
+            node_num, node = path[-1]
+            names = [entry.name for entry in node.entries]
+            i = bisect.bisect_left(names, name)
+            if i == len(names) or names[i] != name:
+                raise FileNotFoundError()
+            del node.entries[i]
+            root.entry_count -= 1
+            if not root.entry_count:
+                self.filefs.truncate_file_size(file_id, 0)
+                return
+            if node_num:
+                self.write_directory_node(file_id, node_num, node)
+            self.write_directory_node(file_id, 0, root)
 
     @check_types
-    def directory_entries(self, file_id: int):
-        _, header = self.filefs.get_file_header(file_id, 0)
-        assert header.file_type == FileType.dir.value
-        assert header.size % self.DIRECTORY_ENTRY_SIZE == 0
-        num_entries = header.size // self.DIRECTORY_ENTRY_SIZE
-        data = self.filefs.read(file_id)
-        for i in range(num_entries):
-            yield self.unpack_directory_entry(data, i * self.DIRECTORY_ENTRY_SIZE)
+    def system_file(self, name: bytes, file_type: FileType=FileType.dir):
+        with self.filefs.blockfs.lock_file(write=True):
+            entry = self.search_directory(self.SYSTEM_FILE_ID, name)
+            if entry:
+                return entry.file_id
+            file_id = self.filefs.create_new_file(file_type.value)
+            self.add_directory_entry(self.SYSTEM_FILE_ID, DirectoryEntry(name, file_id))
+        return file_id
+
+    @check_types
+    def orphan_file(self, file_id: int):
+        # The file must already be detached from its directory, the blocks are freed by reclaim_orphans
+        with self.filefs.blockfs.lock_file(write=True):
+            orphans = self.system_file(self.ORPHANS)
+            self.add_directory_entry(orphans, DirectoryEntry(f"{file_id:016x}".encode(), file_id))
+
+    @check_types
+    def reclaim_orphans(self, max_blocks: int, keep=frozenset()):
+        # Files in keep are still in use, so are left for a later call
+        freed = 0
+        with self.filefs.blockfs.lock_file(write=True):
+            orphans = self.system_file(self.ORPHANS)
+            while freed < max_blocks:
+                entry = next((x for x in self.directory_entries(orphans) if x.file_id not in keep), None)
+                if entry is None:
+                    break
+                finished, blocks = self.filefs.reclaim_file(entry.file_id, max_blocks - freed)
+                freed += blocks
+                if not finished:
+                    break
+                self.remove_directory_entry(orphans, entry.name)
+        return freed
+
+    @check_types
+    def directory_entries(self, file_id: int, after=None):
+        # Read a leaf at a time, starting after the given name if there is one
+        leaf = self.directory_leaf(file_id, after or b"")
+        if leaf is None:
+            return
+        start = bisect.bisect_right(leaf.names, after) if after else 0
+        yield from leaf.node.entries[start:]
+        while leaf.node.link:
+            leaf = self.cached_directory_node(file_id, leaf.node.link)
+            yield from leaf.node.entries
@@ -0,0 +1,85 @@
+import concurrent.futures
+import os
+import sys
+import time
+
+from .pathlevelfilesystem import PathLevelFilesystem, FileType
+
+
+class Rekeyer:
+    """
+    Re-encrypts every block with the block level filesystem's key, reading those not done yet with its old key.
+
+    Blocks are read and written a batch at a time, the batch split between a pool of worker threads to re-encrypt.
+    The file lock is only held for a batch, and rate limits how fast the blocks are read, so other processes aren't
+    starved. Progress is saved every so often in a system file, written with the new key, so an interrupted rekey
+    carries on where it was; re-encrypting a block twice does no harm, so it doesn't matter if some are redone.
+    """
+
+    REKEY = b"rekey"
+    BATCH_BLOCKS = 256
+    # Seconds between saving progress and reporting it
+    CHECKPOINT_INTERVAL = 1
+    PROGRESS_INTERVAL = 5
+
+    def __init__(self, pathfs: PathLevelFilesystem, workers=None, rate=None, progress=sys.stderr):
+        self.pathfs = pathfs
+        self.filefs = pathfs.filefs
+        self.blockfs = pathfs.filefs.blockfs
+        self.workers = workers or os.cpu_count() or 1
+        # Bytes per second, or None for as fast as possible
+        self.rate = rate
+        self.progress = progress
+
+    def run(self):
+        started = last_checkpoint = last_progress = time.monotonic()
+        state_id = self.pathfs.system_file(self.REKEY, FileType.file)
+        start = int.from_bytes(self.filefs.read(state_id), "little")
+        if start:
+            self.message(f"Carrying on from block {start}")
+        done = 0
+        size = self.blockfs.PHYSICAL_BLOCK_SIZE
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            while True:
+                with self.blockfs.lock_file(write=True) as f:
+                    # Blocks added meanwhile were written with the new key, but are redone anyway
+                    total_blocks = self.blockfs.total_blocks()
+                    if start >= total_blocks:
+                        break
+                    self.blockfs.flush_writes()
+                    number = min(self.BATCH_BLOCKS, total_blocks - start)
+                    data = self.blockfs.read_at(self.blockfs.block_start(start), number * size)
+                    per_worker = -(-number // self.workers)
+                    chunks = pool.map(self.reencrypt, (data[i * size:(i + per_worker) * size]
+                                                       for i in range(0, number, per_worker)))
+                    f.seek(self.blockfs.block_start(start))
+                    f.write(b"".join(chunks))
+                    self.blockfs.stats.add("block_writes", number)
+
+                start += number
+                done += number
+                now = time.monotonic()
+                if now - last_checkpoint >= self.CHECKPOINT_INTERVAL:
+                    self.filefs.write(state_id, start.to_bytes(8, "little"))
+                    last_checkpoint = now
+                if now - last_progress >= self.PROGRESS_INTERVAL:
+                    self.message(f"Re-encrypted {start}/{total_blocks} blocks "
+                                 f"({done * size / 2 ** 20 / (now - started):.1f}MiB/s)")
+                    last_progress = now
+                if self.rate:
+                    # Sleeping outside the lock, until the average is back down to the rate
+                    time.sleep(max(0, done * size / self.rate - (time.monotonic() - started)))
+
+            # Everything uses the new key now, including the system directory the state is removed from
+            self.pathfs.remove_directory_entry(self.pathfs.SYSTEM_FILE_ID, self.REKEY)
+            self.filefs.delete_file(state_id)
+            self.blockfs.sync()
+        self.message(f"Re-encrypted {done} blocks in {time.monotonic() - started:.1f} seconds")
+
+    def message(self, message):
+        if self.progress is not None:
+            print(message, file=self.progress)
+
+    def reencrypt(self, data):
+        size = self.blockfs.PHYSICAL_BLOCK_SIZE
+        return b"".join(self.blockfs.reencrypt_block(data[i:i + size]) for i in range(0, len(data), size))
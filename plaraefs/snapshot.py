@@ -0,0 +1,307 @@
+import attr
+import contextlib
+import errno
+
+from .blocklevelfilesystem import BlockLevelFilesystem
+from .pathlevelfilesystem import PathLevelFilesystem, DirectoryEntry, FileType
+from .utils import check_types, BitArray, Bitmap
+
+
+@attr.s(slots=True)
+class Snapshot:
+    name = attr.ib()
+    record_id = attr.ib()
+    # Blocks from here on were added afterwards, so are never part of it
+    total_blocks = attr.ib()
+    # Blocks which need no copy: already copied, or unused when it was taken
+    handled = attr.ib(default=attr.Factory(Bitmap))
+    # Superblock bitmaps as they were when it was taken, by superblock id
+    bitmaps = attr.ib(default=attr.Factory(dict))
+
+
+class Snapshots:
+    """
+    Read-only views of the whole filesystem as it was when each snapshot was taken, kept by copying a block the first
+    time it changes afterwards.
+
+    Taking a snapshot only records the number of blocks. From then on, before a block which was in use is written or
+    wiped, its ciphertext is copied to a new block and the copy's id recorded for the snapshot. Reading the snapshot
+    reads each block from its copy if it has one, otherwise from where it is. Copies keep the block's IV, so the
+    tokens the layers above cache by are the same in the snapshot. Whether a block was in use is read from the
+    superblocks as they were, which are copied like any other block.
+
+    Each snapshot is a file in the snapshots system directory, holding the number of blocks followed by the block id
+    of a table block for each range of LOGICAL_BLOCK_SIZE / 8 block ids, 0 until a block in the range is copied. A
+    table block holds the copy of each block in its range, 0 for none, or EMPTY if the block was never written. A copy
+    made for several snapshots at once is shared between them.
+
+    Every process writing to the filesystem needs one of these, which checks for new snapshots each time it takes the
+    file lock. Records and tables are never copied. Others made with preserve=False, for example to look at the tables,
+    leave the copying to it.
+    """
+
+    EMPTY = 2 ** 64 - 1
+    TOTAL_SIZE = 8
+
+    def __init__(self, pathfs: PathLevelFilesystem, preserve=True):
+        self.pathfs = pathfs
+        self.filefs = pathfs.filefs
+        self.blockfs = pathfs.filefs.blockfs
+        self.VALUES_PER_BLOCK = self.blockfs.LOGICAL_BLOCK_SIZE // self.blockfs.BLOCK_ID_SIZE
+        self.snapshots = []
+        # Lock generation and snapshots directory token the snapshots were read at
+        self.generation = None
+        self.token = None
+        # Blocks of the records and tables
+        self.machinery = Bitmap()
+        if preserve:
+            self.blockfs.before_write = self.preserve
+
+    def current(self):
+        if self.generation != self.blockfs.lock_generation:
+            self.load()
+        return self.snapshots
+
+    def directory(self):
+        entry = self.pathfs.search_directory(self.pathfs.SYSTEM_FILE_ID, self.pathfs.SNAPSHOTS)
+        return entry.file_id if entry else 0
+
+    def load(self):
+        # Only reread when the directory has changed, as what is known about each snapshot is kept in memory
+        with self.blockfs.lock_file(write=False):
+            directory = self.directory()
+            token = self.blockfs.block_version(directory)[1] if directory else None
+            if token != self.token:
+                self.snapshots = []
+                self.machinery = Bitmap()
+                for entry in self.pathfs.directory_entries(directory) if directory else ():
+                    total_blocks = int.from_bytes(self.filefs.read(entry.file_id, self.TOTAL_SIZE, 0), "little")
+                    snapshot = Snapshot(entry.name, entry.file_id, total_blocks)
+                    self.snapshots.append(snapshot)
+                    self.mark_machinery(snapshot)
+                self.token = token
+            self.generation = self.blockfs.lock_generation
+
+    def names(self):
+        with self.blockfs.lock_file(write=False):
+            return [snapshot.name for snapshot in self.current()]
+
+    def find(self, name):
+        snapshot = next((x for x in self.current() if x.name == name), None)
+        if snapshot is None:
+            raise FileNotFoundError(name)
+        return snapshot
+
+    @check_types
+    def create(self, name: bytes):
+        with self.blockfs.lock_file(write=True):
+            if any(snapshot.name == name for snapshot in self.current()):
+                raise FileExistsError(name)
+            self.blockfs.flush_writes()
+            directory = self.pathfs.system_file(self.pathfs.SNAPSHOTS)
+            record_id = self.filefs.create_new_file(FileType.file.value)
+            self.pathfs.add_directory_entry(directory, DirectoryEntry(name, record_id))
+            # Taken once the record is written, so nothing about it needs copying
+            total_blocks = self.blockfs.total_blocks()
+            self.filefs.write(record_id, total_blocks.to_bytes(self.TOTAL_SIZE, "little"))
+            # Copies are made of what is on disk
+            self.blockfs.flush_writes()
+            self.generation = None
+
+    def file_blocks(self, file_id):
+        blocks = []
+        for header_num in range(-(-self.filefs.num_file_blocks(file_id) // self.filefs.FILE_HEADER_INTERVAL)):
+            header_block_id, header = self.filefs.get_file_header(file_id, header_num)
+            blocks.append(header_block_id)
+            blocks.extend(block_id for block_id in header.block_ids if block_id)
+        return blocks
+
+    def mark_machinery(self, snapshot):
+        for block_id in self.file_blocks(snapshot.record_id):
+            self.machinery.set(block_id)
+        for _, table_block in self.table_blocks(snapshot):
+            self.machinery.set(table_block)
+
+    def table_blocks(self, snapshot):
+        # First block id and table block of each range which has one
+        data = self.filefs.read(snapshot.record_id)[self.TOTAL_SIZE:]
+        for i in range(0, len(data), self.blockfs.BLOCK_ID_SIZE):
+            table_block = int.from_bytes(data[i:i + self.blockfs.BLOCK_ID_SIZE], "little")
+            if table_block:
+                yield i // self.blockfs.BLOCK_ID_SIZE * self.VALUES_PER_BLOCK, table_block
+
+    def table_block(self, snapshot, block_id, create=False):
+        index = self.TOTAL_SIZE + block_id // self.VALUES_PER_BLOCK * self.blockfs.BLOCK_ID_SIZE
+        data = self.filefs.read(snapshot.record_id, self.blockfs.BLOCK_ID_SIZE, index)
+        table_block = int.from_bytes(data, "little")
+        if not table_block and create:
+            table_block, = self.filefs.allocate_blocks(1, block_id)
+            self.machinery.set(table_block)
+            self.blockfs.write_block(table_block, 0, b"\0" * self.blockfs.LOGICAL_BLOCK_SIZE)
+            self.filefs.write(snapshot.record_id, table_block.to_bytes(self.blockfs.BLOCK_ID_SIZE, "little"), index)
+            for record_block in self.file_blocks(snapshot.record_id):
+                self.machinery.set(record_block)
+        return table_block
+
+    def unpack_values(self, data):
+        return [int.from_bytes(data[i:i + self.blockfs.BLOCK_ID_SIZE], "little")
+                for i in range(0, len(data), self.blockfs.BLOCK_ID_SIZE)]
+
+    def value(self, snapshot, block_id):
+        # Where the snapshot's block is, 0 if it hasn't been copied
+        table_block = self.table_block(snapshot, block_id)
+        if not table_block:
+            return 0
+        offset = block_id % self.VALUES_PER_BLOCK * self.blockfs.BLOCK_ID_SIZE
+        return int.from_bytes(self.blockfs.read_block(table_block)[offset:offset + self.blockfs.BLOCK_ID_SIZE],
+                              "little")
+
+    def set_value(self, snapshot, block_id, value):
+        table_block = self.table_block(snapshot, block_id, create=True)
+        self.blockfs.write_block(table_block, block_id % self.VALUES_PER_BLOCK * self.blockfs.BLOCK_ID_SIZE,
+                                 value.to_bytes(self.blockfs.BLOCK_ID_SIZE, "little"))
+
+    def was_used(self, snapshot, block_id):
+        superblock_id, bit = divmod(block_id, self.filefs.SUPERBLOCK_INTERVAL)
+        bitmap = snapshot.bitmaps.get(superblock_id)
+        if bitmap is None:
+            superblock_block_id = superblock_id * self.filefs.SUPERBLOCK_INTERVAL
+            value = self.value(snapshot, superblock_block_id)
+            bitmap = BitArray(self.blockfs.read_block(value or superblock_block_id))
+            snapshot.bitmaps[superblock_id] = bitmap
+        return bitmap[bit]
+
+    def needs_copy(self, snapshot, block_id):
+        if block_id >= snapshot.total_blocks or snapshot.handled[block_id]:
+            return False
+        if self.was_used(snapshot, block_id) and not self.value(snapshot, block_id):
+            return True
+        snapshot.handled.set(block_id)
+        return False
+
+    def preserve(self, block_id):
+        # Called before block_id is written or wiped, with the write lock held
+        if not self.current() or self.machinery[block_id]:
+            return
+        needing = [snapshot for snapshot in self.snapshots if self.needs_copy(snapshot, block_id)]
+        if not needing:
+            return
+        for snapshot in needing:
+            snapshot.handled.set(block_id)
+        if block_id in self.blockfs.unflushed_writes:
+            self.blockfs.flush_writes([block_id])
+        cipher_data = self.blockfs.read_at(self.blockfs.block_start(block_id), self.blockfs.PHYSICAL_BLOCK_SIZE)
+        superblock_id, bit = divmod(block_id, self.filefs.SUPERBLOCK_INTERVAL)
+        if not bit:
+            # Allocating the copy may change this superblock before its copy is recorded
+            for snapshot in needing:
+                snapshot.bitmaps.setdefault(superblock_id, BitArray(self.blockfs.decrypt_block(cipher_data)))
+        if cipher_data[:self.blockfs.IV_SIZE] == self.blockfs.UNINITALISED_IV:
+            value = self.EMPTY
+        else:
+            value, = self.filefs.allocate_blocks(1, block_id)
+            self.blockfs.write_raw_block(value, cipher_data)
+        for snapshot in needing:
+            self.set_value(snapshot, block_id, value)
+
+    def forget(self, block_id):
+        # The block is about to be freed and the snapshots have no use for it, so they never need a copy of it
+        for snapshot in self.snapshots:
+            if self.needs_copy(snapshot, block_id):
+                snapshot.handled.set(block_id)
+                self.set_value(snapshot, block_id, self.EMPTY)
+
+    @check_types
+    def delete(self, name: bytes):
+        with self.blockfs.lock_file(write=True):
+            snapshot = self.find(name)
+            self.pathfs.remove_directory_entry(self.directory(), name)
+            self.snapshots.remove(snapshot)
+            to_free = []
+            for first, table_block in self.table_blocks(snapshot):
+                to_free.append(table_block)
+                others = [self.table_block(other, first) for other in self.snapshots]
+                others = [self.unpack_values(self.blockfs.read_block(x)) for x in others if x]
+                for i, value in enumerate(self.unpack_values(self.blockfs.read_block(table_block))):
+                    if value and value != self.EMPTY and all(values[i] != value for values in others):
+                        to_free.append(value)
+            record_blocks = self.file_blocks(snapshot.record_id)
+            for block_id in to_free + record_blocks:
+                self.forget(block_id)
+            self.filefs.deallocate_blocks(to_free)
+            self.filefs.delete_file(snapshot.record_id)
+            self.generation = None
+
+    @check_types
+    def view(self, name: bytes):
+        with self.blockfs.lock_file(write=False):
+            return SnapshotBlockLevelFilesystem(self, self.find(name))
+
+
+class SnapshotBlockLevelFilesystem(BlockLevelFilesystem):
+    """
+    A snapshot, read through the live filesystem's blocks and the copies of those changed since. Writing isn't
+    allowed, and reading fails once the snapshot has been deleted.
+    """
+
+    __slots__ = ["snapshots", "snapshot"]
+
+    def __init__(self, snapshots: Snapshots, snapshot: Snapshot):
+        self.snapshots = snapshots
+        self.snapshot = snapshot
+        live = snapshots.blockfs
+        self.rwlock = live.rwlock
+        self.stats = live.stats
+        self.fname = live.fname
+        self.offset = live.offset
+        self._file = live._file
+
+    @property
+    def live(self):
+        return self.snapshots.blockfs
+
+    @contextlib.contextmanager
+    def lock_file(self, write):
+        # The layers above take the write lock when they might write, which they never do here
+        with self.live.lock_file(write=False) as f:
+            if not any(x.record_id == self.snapshot.record_id and x.name == self.snapshot.name
+                       for x in self.snapshots.current()):
+                raise OSError(errno.ENOENT, "Snapshot has been deleted")
+            yield f
+
+    def total_blocks(self):
+        return self.snapshot.total_blocks
+
+    def location(self, block_id):
+        assert block_id < self.snapshot.total_blocks
+        return self.snapshots.value(self.snapshot, block_id) or block_id
+
+    @check_types
+    def read_block(self, block_id: int, with_token: bool=False):
+        with self.lock_file(write=False):
+            location = self.location(block_id)
+            if location == self.snapshots.EMPTY:
+                return None
+            return self.live.read_block(location, with_token)
+
+    @check_types
+    def block_version(self, block_id: int, old_version: bytes=b""):
+        with self.lock_file(write=False):
+            location = self.location(block_id)
+            if location == self.snapshots.EMPTY:
+                return old_version != self.UNINITALISED_IV, self.UNINITALISED_IV
+            return self.live.block_version(location, old_version)
+
+    def write_block(self, *args, **kwargs):
+        raise OSError(errno.EROFS, "Snapshots are read-only")
+
+    wipe_block = new_blocks = remove_blocks = swap_blocks = write_encrypted_block = write_raw_block = write_block
+
+    def flush_writes(self, only=None):
+        pass
+
+    def sync(self):
+        pass
+
+    def close(self):
+        self.live.close()
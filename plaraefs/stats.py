@@ -0,0 +1,151 @@
+import collections
+import pathlib
+import sys
+import threading
+import weakref
+
+
+# Modules attributed to each layer by the sampler, anything else in the package belongs to whoever called it
+LAYERS = {
+    "blocklevelfilesystem": "block",
+    "filelevelfilesystem": "file",
+    "pathlevelfilesystem": "path",
+    "fusefilesystem": "fuse",
+    "lowlevelfusefilesystem": "fuse",
+}
+PACKAGE_DIR = pathlib.Path(__file__).parent
+
+
+class ThreadCounters:
+    # Only held by the thread's local storage, so it goes when the thread does
+    __slots__ = ["counters", "__weakref__"]
+
+    def __init__(self, counters):
+        self.counters = counters
+
+
+class Stats:
+    """
+    Counters the storage layers report into. The block level filesystem owns one and the layers above share it.
+
+    Counters are added to several times per block, so each thread adds to its own without taking a lock, and they are
+    only summed when read. Those of threads which have finished are folded into one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.threads = []
+        self.finished = collections.Counter()
+
+    def __getitem__(self, name):
+        with self.lock:
+            return self.finished[name] + sum(counters.get(name, 0) for counters in self.threads)
+
+    def thread_counters(self):
+        counters = collections.Counter()
+        self.local.counters = ThreadCounters(counters)
+        weakref.finalize(self.local.counters, self.thread_finished, counters).atexit = False
+        with self.lock:
+            self.threads.append(counters)
+        return counters
+
+    def thread_finished(self, counters):
+        with self.lock:
+            self.finished.update(counters)
+            self.threads = [x for x in self.threads if x is not counters]
+
+    def add(self, name, value=1):
+        try:
+            counters = self.local.counters.counters
+        except AttributeError:
+            counters = self.thread_counters()
+        counters[name] += value
+
+    def cache(self, name, hit):
+        self.add(name + ("_hits" if hit else "_misses"))
+
+    def snapshot(self):
+        total = collections.Counter()
+        with self.lock:
+            total.update(self.finished)
+            for counters in self.threads:
+                # Copied in one go, as the thread may be adding to it
+                total.update(dict(counters))
+        return dict(total)
+
+    def prometheus(self):
+        lines = []
+        for name, value in sorted(self.snapshot().items()):
+            lines.append(f"# TYPE plaraefs_{name}_total counter")
+            lines.append(f"plaraefs_{name}_total {value}")
+        return "".join(line + "\n" for line in lines)
+
+
+def frame_layer(frame):
+    """
+    The layer the innermost frame of this package in a stack belongs to, for attributing profiler samples.
+    """
+    while frame is not None:
+        path = pathlib.Path(frame.f_code.co_filename)
+        if path.parent == PACKAGE_DIR and path.stem in LAYERS:
+            return LAYERS[path.stem]
+        if path.parent.parent == PACKAGE_DIR and path.parent.name == "accesscontroller":
+            return "accesscontroller"
+        frame = frame.f_back
+    return None
+
+
+class LayerSampler:
+    """
+    Samples every thread's stack and counts which layer it is in, so time can be attributed to layers without
+    timing each call.
+    """
+
+    def __init__(self, stats, interval):
+        self.stats = stats
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="sampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self.thread.ident:
+                continue
+            # Threads outside the package are idle, either waiting for requests or in other code
+            layer = frame_layer(frame)
+            if layer is not None:
+                self.stats.add(f"profile_{layer}_samples")
+                self.stats.add(f"profile_{layer}_seconds", self.interval)
+
+
+def parse_prometheus(text):
+    """
+    Values in a Prometheus text file by series.
+    """
+    values = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+            series, value = line.rsplit(" ", 1)
+            values[series] = float(value)
+    return values
+
+
+def diff(before, after):
+    """
+    How much each series in after changed since before, leaving out those which didn't.
+    """
+    return {series: value - before.get(series, 0) for series, value in after.items()
+            if value != before.get(series, 0)}
@@ -0,0 +1,412 @@
+import attr
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import os
+import pathlib
+import sys
+import tarfile
+import time
+
+from .pathlevelfilesystem import PathLevelFilesystem, DirectoryEntry, FileType
+
+
+def error_reason(error):
+    return error.strerror or str(error)
+
+
+@attr.s(slots=True)
+class PendingDirectory:
+    file_id = attr.ib()
+    # Whether it was there before the import, in which case names are checked against it
+    existed = attr.ib()
+    # Added in one go once the import is done
+    entries = attr.ib(default=attr.Factory(dict))
+
+
+class Transfer:
+    """
+    Shared by Importer and Exporter: a pool of worker threads, fed a bounded number of tasks at a time whose results
+    are handled in order on this thread, and progress reports.
+    """
+
+    QUEUED_PER_WORKER = 4
+    PROGRESS_INTERVAL = 5
+
+    def __init__(self, pathfs: PathLevelFilesystem, workers=None, progress=sys.stderr):
+        self.pathfs = pathfs
+        self.filefs = pathfs.filefs
+        self.blockfs = pathfs.filefs.blockfs
+        self.workers = workers or os.cpu_count() or 1
+        self.progress = progress
+
+        self.pool = None
+        self.pending = collections.deque()
+        self.files = self.directories = self.skipped = self.bytes = 0
+        self.started = self.last_progress = 0
+
+    @contextlib.contextmanager
+    def running(self, verb):
+        self.started = self.last_progress = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as self.pool:
+            yield
+            self.drain()
+        elapsed = time.monotonic() - self.started
+        self.message(f"{verb} {self.files} files and {self.directories} directories, {self.bytes / 2 ** 20:.1f}MiB in "
+                     f"{elapsed:.1f} seconds ({self.bytes / 2 ** 20 / max(elapsed, 1e-9):.1f}MiB/s)")
+        if self.skipped:
+            self.message(f"Skipped {self.skipped} entries")
+
+    def message(self, message):
+        # Not to stdout, which may be a tar stream
+        if self.progress is not None:
+            print(message, file=self.progress)
+
+    def skip(self, parts, reason):
+        self.skipped += 1
+        self.message(f"Skipping /{os.fsdecode(b'/'.join(parts))}: {reason}")
+
+    def report_progress(self):
+        now = time.monotonic()
+        if now - self.last_progress < self.PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        self.message(f"{self.files} files, {self.bytes / 2 ** 20:.1f}MiB "
+                     f"({self.bytes / 2 ** 20 / (now - self.started):.1f}MiB/s)")
+
+    def submit(self, handle, func, *args):
+        self.pending.append((self.pool.submit(func, *args), handle))
+        while len(self.pending) > self.workers * self.QUEUED_PER_WORKER:
+            self.finish_task()
+
+    def finish_task(self):
+        future, handle = self.pending.popleft()
+        handle(future.result())
+
+    def drain(self):
+        while self.pending:
+            self.finish_task()
+
+
+class Importer(Transfer):
+    """
+    Copies a host directory tree or a tar stream into the filesystem without going through FUSE.
+
+    Each file is preallocated, so its blocks are allocated together, and each new directory is built in one go from
+    its sorted entries at the end. Worker threads read and encrypt the data blocks of files, which this thread then
+    writes out in order. Only regular files and directories are copied, without their metadata, as the filesystem has
+    nowhere to keep it. Files already in the filesystem are left alone. A file which can't be read is skipped and its
+    blocks freed, and if the import stops part way the files finished so far are still added to their directories.
+    It writes without going through a mount, so refuses to run while the filesystem is mounted.
+    """
+
+    # File blocks per task, a whole number of headers so each task writes at most a few header blocks
+    SEGMENT_HEADERS = 8
+    # Partial writes, such as to file headers, are flushed once this many are waiting
+    FLUSH_BLOCKS = 4096
+
+    def __init__(self, pathfs: PathLevelFilesystem, workers=None, progress=sys.stderr):
+        super().__init__(pathfs, workers, progress)
+        self.segment_blocks = self.filefs.FILE_HEADER_INTERVAL * self.SEGMENT_HEADERS
+        # By path, as a tuple of names
+        self.pending_directories = {(): PendingDirectory(pathfs.ROOT_FILE_ID, True)}
+        # File id -> [path, segments not written yet], for files whose data isn't all written
+        self.unfinished = {}
+
+    @contextlib.contextmanager
+    def running(self, verb="Imported"):
+        if not self.blockfs.claim(exclusive=True):
+            print("The filesystem is mounted, unmount it before importing!")
+            raise RuntimeError()
+        try:
+            with self.blockfs.lock_file(write=True), super().running(verb):
+                try:
+                    yield
+                    self.drain()
+                finally:
+                    self.add_entries()
+        finally:
+            self.blockfs.unclaim()
+
+    def add_entries(self):
+        # Files left unfinished by an error are freed rather than added with part of their data
+        for file_id in list(self.unfinished):
+            self.abandon(file_id, "import stopped")
+        for directory in self.pending_directories.values():
+            self.pathfs.add_directory_entries(directory.file_id, [DirectoryEntry(name, file_id) for name, file_id
+                                                                  in directory.entries.items()])
+        self.blockfs.flush_writes()
+
+    def abandon(self, file_id, reason):
+        parts, _ = self.unfinished.pop(file_id)
+        del self.pending_directories[parts[:-1]].entries[parts[-1]]
+        self.files -= 1
+        self.filefs.delete_file(file_id)
+        self.skip(parts, reason)
+
+    def import_tree(self, source):
+        with self.running():
+            stack = [((), pathlib.Path(source))]
+            while stack:
+                parts, path = stack.pop()
+                if self.directory(parts) is None:
+                    continue
+                try:
+                    entries = sorted(os.scandir(path), key=lambda entry: entry.name)
+                except OSError as e:
+                    self.skip(parts, error_reason(e))
+                    continue
+                for entry in entries:
+                    entry_parts = parts + (os.fsencode(entry.name),)
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry_parts, pathlib.Path(entry.path)))
+                    elif entry.is_file(follow_symlinks=False):
+                        try:
+                            size = entry.stat(follow_symlinks=False).st_size
+                        except OSError as e:
+                            self.skip(entry_parts, error_reason(e))
+                            continue
+                        file_id = self.create_file(entry_parts, size)
+                        if file_id is not None:
+                            for block_num, start, length in self.segments(size):
+                                self.submit(functools.partial(self.write_blocks, file_id), self.read_segment,
+                                            entry.path, start, length, block_num)
+                    else:
+                        self.skip(entry_parts, "not a regular file or directory")
+
+    def import_tar(self, fileobj):
+        with self.running(), tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+            for member in tar:
+                parts = tuple(os.fsencode(part) for part in pathlib.PurePosixPath(member.name).parts
+                              if part not in ("/", "."))
+                if b".." in parts:
+                    self.skip(parts, "outside the archive's root")
+                elif member.isdir():
+                    self.directory(parts)
+                elif member.isreg():
+                    file_id = self.create_file(parts, member.size)
+                    if file_id is not None:
+                        # The stream can only be read here, but can still be encrypted in parallel
+                        data = tar.extractfile(member)
+                        for block_num, _, length in self.segments(member.size):
+                            self.submit(functools.partial(self.write_blocks, file_id), self.encrypt_segment,
+                                        data.read(length), block_num)
+                else:
+                    self.skip(parts, "not a regular file or directory")
+
+    def directory(self, parts):
+        # The file id of the directory at parts, created if needed, or None if it can't be
+        directory = self.pending_directories.get(parts)
+        if directory is not None:
+            return directory.file_id
+        parent_id = self.directory(parts[:-1])
+        if parent_id is None or not self.check_name(parts, FileType.dir):
+            return None
+        parent = self.pending_directories[parts[:-1]]
+        existing = parent.existed and self.pathfs.search_directory(parent_id, parts[-1])
+        if existing:
+            directory = PendingDirectory(existing.file_id, True)
+        else:
+            directory = PendingDirectory(self.filefs.create_new_file(FileType.dir.value), False)
+            parent.entries[parts[-1]] = directory.file_id
+            self.directories += 1
+        self.pending_directories[parts] = directory
+        return directory.file_id
+
+    def check_name(self, parts, file_type):
+        # Whether parts can be added to its parent, which must already be known, as file_type
+        if not parts:
+            return file_type == FileType.dir
+        if len(parts[-1]) > self.pathfs.FILENAME_SIZE:
+            self.skip(parts, "name too long")
+            return False
+        parent = self.pending_directories[parts[:-1]]
+        if parts[-1] in parent.entries:
+            self.skip(parts, "already imported")
+            return False
+        if parent.existed:
+            existing = self.pathfs.search_directory(parent.file_id, parts[-1])
+            if existing is not None:
+                existing_type = self.filefs.get_file_header(existing.file_id, 0)[1].file_type
+                if existing_type != FileType.dir.value or file_type != FileType.dir:
+                    self.skip(parts, "already exists")
+                    return False
+        return True
+
+    def create_file(self, parts, size):
+        parent_id = self.directory(parts[:-1])
+        if parent_id is None or not self.check_name(parts, FileType.file):
+            return None
+        file_id = self.filefs.create_new_file(FileType.file.value)
+        self.pending_directories[parts[:-1]].entries[parts[-1]] = file_id
+        self.filefs.preallocate(file_id, size)
+        segments = sum(1 for _ in self.segments(size))
+        if segments:
+            self.unfinished[file_id] = [parts, segments]
+        self.files += 1
+        self.report_progress()
+        return file_id
+
+    def segments(self, size):
+        # Block number, offset and length of each task's part of a file
+        block_num = start = 0
+        while start < size:
+            end = self.filefs.offset_from_block(block_num + self.segment_blocks)
+            yield block_num, start, min(end, size) - start
+            block_num += self.segment_blocks
+            start = end
+
+    def read_segment(self, path, start, length, block_num):
+        # Files may be unreadable, or gone since the directory was listed, which only skips that file
+        try:
+            with open(path, "rb") as f:
+                f.seek(start)
+                data = f.read(length)
+        except OSError as e:
+            return e
+        return self.encrypt_segment(data, block_num)
+
+    def encrypt_segment(self, data, block_num):
+        # Data blocks are encrypted here, header blocks are left to be merged with their header
+        blocks = []
+        pos = 0
+        while pos < len(data):
+            size = self.filefs.file_data_in_block(block_num)
+            chunk = data[pos:pos + size]
+            if block_num % self.filefs.FILE_HEADER_INTERVAL:
+                chunk = chunk.ljust(size, b"\0")
+                blocks.append((block_num, chunk, self.blockfs.encrypt_block(chunk)))
+            else:
+                blocks.append((block_num, chunk, None))
+            pos += size
+            block_num += 1
+        return len(data), blocks
+
+    def write_blocks(self, file_id, result):
+        if file_id not in self.unfinished:
+            # Abandoned after an earlier segment failed
+            return
+        if isinstance(result, OSError):
+            self.abandon(file_id, error_reason(result))
+            return
+        size, blocks = result
+        try:
+            for block_num, data, cipher_data in blocks:
+                if cipher_data is None:
+                    self.filefs.write_file_data(file_id, block_num, 0, data)
+                else:
+                    self.blockfs.write_encrypted_block(self.filefs.file_block_id(file_id, block_num), data,
+                                                       cipher_data)
+        except OSError as e:
+            self.abandon(file_id, error_reason(e))
+            return
+        self.unfinished[file_id][1] -= 1
+        if not self.unfinished[file_id][1]:
+            del self.unfinished[file_id]
+        self.bytes += size
+        if len(self.blockfs.unflushed_writes) > self.FLUSH_BLOCKS:
+            self.blockfs.flush_writes()
+        self.report_progress()
+
+
+class ChunkReader:
+    """
+    A file object reading a file's data from the exporter's events, for tarfile.
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self.buffer = b""
+
+    def read(self, size):
+        chunks = [self.buffer]
+        available = len(self.buffer)
+        while available < size:
+            kind, _, data = next(self.events)
+            assert kind == "data", kind
+            chunks.append(data)
+            available += len(data)
+        data = b"".join(chunks)
+        self.buffer = data[size:]
+        return data[:size]
+
+
+class Exporter(Transfer):
+    """
+    Copies the filesystem's files out to a host directory or a tar stream. Worker threads read and decrypt files ahead
+    of this thread writing them out, across files, so small files are read in parallel too.
+    """
+
+    SEGMENT_SIZE = 2 ** 20
+
+    def events(self):
+        # Each directory and file in turn, then the data of each file, read by the pool ahead of being needed
+        ahead = collections.deque()
+        for event in self.walk():
+            ahead.append(event)
+            if len(ahead) > self.workers * self.QUEUED_PER_WORKER:
+                yield self.resolve(ahead.popleft())
+        while ahead:
+            yield self.resolve(ahead.popleft())
+
+    def resolve(self, event):
+        kind, parts, value = event
+        if kind == "data":
+            value = value.result()
+            self.bytes += len(value)
+            self.report_progress()
+        return kind, parts, value
+
+    def walk(self):
+        stack = [((), self.pathfs.ROOT_FILE_ID)]
+        while stack:
+            parts, file_id = stack.pop()
+            _, header = self.filefs.get_file_header(file_id, 0)
+            if header.file_type == FileType.dir.value:
+                self.directories += bool(parts)
+                yield "dir", parts, None
+                entries = list(self.pathfs.directory_entries(file_id))
+                stack.extend((parts + (entry.name,), entry.file_id) for entry in reversed(entries))
+            else:
+                self.files += 1
+                yield "file", parts, header.size
+                for start in range(0, header.size, self.SEGMENT_SIZE):
+                    yield "data", parts, self.pool.submit(self.filefs.read, file_id, self.SEGMENT_SIZE, start)
+
+    def export_tree(self, destination):
+        destination = pathlib.Path(destination)
+        f = None
+        try:
+            with self.running("Exported"):
+                for kind, parts, value in self.events():
+                    path = destination.joinpath(*map(os.fsdecode, parts))
+                    if kind == "dir":
+                        path.mkdir(exist_ok=not parts)
+                    elif kind == "file":
+                        if f is not None:
+                            f.close()
+                        f = open(path, "xb")
+                    else:
+                        f.write(value)
+        finally:
+            if f is not None:
+                f.close()
+
+    def export_tar(self, fileobj):
+        mtime = time.time()
+        with self.running("Exported"), tarfile.open(fileobj=fileobj, mode="w|") as tar:
+            events = self.events()
+            for kind, parts, value in events:
+                if not parts:
+                    continue
+                info = tarfile.TarInfo(os.fsdecode(b"/".join(parts)))
+                info.mtime = mtime
+                if kind == "dir":
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                    tar.addfile(info)
+                else:
+                    info.size = value
+                    info.mode = 0o644
+                    tar.addfile(info, ChunkReader(events))
@@ -1,6 +1,10 @@
+import bisect
 import inspect
 import functools
+import itertools
 import collections
+import contextlib
+import threading
 
 
 def check_types(func):
@@ -22,39 +26,204 @@ def check_types(func):
 
 
 class LRUDict(collections.OrderedDict):
+    # Caches are filled by concurrent readers, so every access holds the lock
     def __init__(self, maxsize):
         super().__init__()
         self.maxsize = maxsize
+        self.lock = threading.RLock()
 
     def __getitem__(self, key):
-        try:
-            self.move_to_end(key)
-        except KeyError:
-            pass
-        return super().__getitem__(key)
+        with self.lock:
+            try:
+                self.move_to_end(key)
+            except KeyError:
+                pass
+            return super().__getitem__(key)
 
     def __setitem__(self, key, value):
-        super().__setitem__(key, value)
-        self.move_to_end(key)
-        if len(self) > self.maxsize:
-            self.popitem(last=False)
+        with self.lock:
+            super().__setitem__(key, value)
+            self.move_to_end(key)
+            if len(self) > self.maxsize:
+                self.popitem(last=False)
+
+    def __delitem__(self, key):
+        with self.lock:
+            super().__delitem__(key)
+
+    def get(self, key, default=None):
+        with self.lock:
+            return super().get(key, default)
+
+    def pop(self, key, *default):
+        with self.lock:
+            return super().pop(key, *default)
+
+    def clear(self):
+        with self.lock:
+            super().clear()
+
+    def keys(self):
+        with self.lock:
+            return list(super().keys())
+
+
+POPCOUNT = bytes(bin(i).count("1") for i in range(256))
+
+
+class Bitmap:
+    """
+    A bit per block, in the same order as the superblock bitmaps. Blocks past the end read as unset.
+    """
+
+    __slots__ = ["data"]
+
+    def __init__(self, data=b""):
+        self.data = bytearray(data)
+
+    def __getitem__(self, block_id):
+        byte, bit = divmod(block_id, 8)
+        return byte < len(self.data) and bool(self.data[byte] & (128 >> bit))
+
+    def set(self, block_id):
+        byte, bit = divmod(block_id, 8)
+        if byte >= len(self.data):
+            self.data.extend(bytes(byte + 1 - len(self.data)))
+        self.data[byte] |= 128 >> bit
+
+    def count(self, end=None):
+        # Set bits before end
+        if end is None:
+            return sum(self.data.translate(POPCOUNT))
+        whole_bytes = end // 8
+        return sum(self.data[:whole_bytes].translate(POPCOUNT)) + sum(self[i] for i in range(whole_bytes * 8, end))
+
+
+class RWLock:
+    """
+    Reader/writer lock, which a thread may take again while it holds it, or take for reading while it holds it for
+    writing. on_acquire and on_release are called when the lock goes from free to held and back, with whether it is
+    held for writing. on_acquire may block, so is called without holding the condition, with other threads waiting
+    until it returns.
+    """
+
+    def __init__(self, on_acquire=None, on_release=None):
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = collections.Counter()
+        self.writer = None
+        self.writer_depth = 0
+        self.waiting_writers = 0
+        # Set while the first reader is in on_acquire
+        self.acquiring = False
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+
+    def held(self, write=False):
+        me = threading.get_ident()
+        return self.writer == me or not write and me in self.readers
+
+    @contextlib.contextmanager
+    def read(self):
+        me = threading.get_ident()
+        if self.writer == me:
+            with self.write():
+                yield
+            return
+        with self.condition:
+            # Writers waiting don't hold up readers which already hold the lock, or they would deadlock
+            while me not in self.readers and (self.writer is not None or self.waiting_writers or self.acquiring):
+                self.condition.wait()
+            first = not self.readers and self.on_acquire is not None
+            if first:
+                self.acquiring = True
+            else:
+                self.readers[me] += 1
+        if first:
+            try:
+                self.on_acquire(False)
+            except BaseException:
+                with self.condition:
+                    self.acquiring = False
+                    self.condition.notify_all()
+                raise
+            with self.condition:
+                self.acquiring = False
+                self.readers[me] += 1
+                self.condition.notify_all()
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers[me] -= 1
+                if not self.readers[me]:
+                    del self.readers[me]
+                if not self.readers:
+                    try:
+                        if self.on_release:
+                            self.on_release(False)
+                    finally:
+                        self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        me = threading.get_ident()
+        if self.writer == me:
+            self.writer_depth += 1
+            try:
+                yield
+            finally:
+                self.writer_depth -= 1
+            return
+        with self.condition:
+            if me in self.readers:
+                raise RuntimeError("Locked for read and need lock for write")
+            self.waiting_writers += 1
+            try:
+                while self.writer is not None or self.readers or self.acquiring:
+                    self.condition.wait()
+            finally:
+                self.waiting_writers -= 1
+            self.writer = me
+        try:
+            if self.on_acquire:
+                self.on_acquire(True)
+            try:
+                yield
+            finally:
+                if self.on_release:
+                    self.on_release(True)
+        finally:
+            with self.condition:
+                self.writer = None
+                self.condition.notify_all()
 
 
 class BitArray:
-    __slots__ = ["data", "start_search"]
+    __slots__ = ["data"]
 
     def __init__(self, data):
         self.data = bytearray(data)
-        self.start_search = 0
 
-    def search(self):
-        for i in range(self.start_search, len(self.data)):
-            byte = self.data[i]
-            if byte != 255:
-                self.start_search = i
+    def free_runs(self):
+        run_start = None
+        for i, byte in enumerate(self.data):
+            if not byte:
+                if run_start is None:
+                    run_start = i * 8
+            elif byte == 255:
+                if run_start is not None:
+                    yield run_start, i * 8 - run_start
+                    run_start = None
+            else:
                 for j in range(8):
-                    if not byte & (128 >> j):
-                        yield i * 8 + j
+                    if byte & (128 >> j):
+                        if run_start is not None:
+                            yield run_start, i * 8 + j - run_start
+                            run_start = None
+                    elif run_start is None:
+                        run_start = i * 8 + j
+        if run_start is not None:
+            yield run_start, len(self.data) * 8 - run_start
 
     def tobytes(self):
         return bytes(self.data)
@@ -70,12 +239,105 @@ class BitArray:
 
     def __setitem__(self, position, x):
         i, j = divmod(position, 8)
-        if not x:
-            self.start_search = min(self.start_search, i)
         if x:
             self.data[i] |= (128 >> j)
         else:
             self.data[i] &= ~(128 >> j)
 
     def count(self, x):
-        return sum(1 for i in self if i == x)
+        ones = bin(int.from_bytes(self.data, "big")).count("1")
+        return ones if x else len(self.data) * 8 - ones
+
+
+class FreeRuns:
+    """
+    The runs of unset bits in a BitArray, as sorted starts and their lengths, kept up to date as ranges of bits are
+    used and freed rather than found by scanning the bitmap again.
+    """
+
+    __slots__ = ["starts", "lengths", "free", "largest"]
+
+    def __init__(self, bitmap):
+        self.starts = []
+        self.lengths = {}
+        for start, length in bitmap.free_runs():
+            self.starts.append(start)
+            self.lengths[start] = length
+        self.free = sum(self.lengths.values())
+        self.largest = max(self.lengths.values(), default=0)
+
+    def largest_run(self):
+        if self.largest is None:
+            self.largest = max(self.lengths.values(), default=0)
+        return self.largest
+
+    def use(self, first, end):
+        # Runs overlapping [first, end) lose that part, leaving whatever is either side of it
+        i = max(bisect.bisect_right(self.starts, first) - 1, 0)
+        j = i
+        pieces = []
+        while j < len(self.starts) and self.starts[j] < end:
+            start = self.starts[j]
+            length = self.lengths.pop(start)
+            if start + length <= first:
+                pieces.append((start, length))
+            else:
+                self.free -= min(start + length, end) - max(start, first)
+                if length == self.largest:
+                    self.largest = None
+                if start < first:
+                    pieces.append((start, first - start))
+                if start + length > end:
+                    pieces.append((end, start + length - end))
+            j += 1
+        self.starts[i:j] = [start for start, _ in pieces]
+        self.lengths.update(pieces)
+
+    def release(self, first, end):
+        # [first, end) becomes free, joined with any runs overlapping or next to it
+        i = max(bisect.bisect_right(self.starts, first) - 1, 0)
+        if i < len(self.starts) and self.starts[i] + self.lengths[self.starts[i]] < first:
+            i += 1
+        j = i
+        new_start, new_end = first, end
+        already_free = 0
+        while j < len(self.starts) and self.starts[j] <= end:
+            start = self.starts[j]
+            length = self.lengths.pop(start)
+            already_free += max(min(start + length, end) - max(start, first), 0)
+            new_start, new_end = min(new_start, start), max(new_end, start + length)
+            j += 1
+        self.starts[i:j] = [new_start]
+        self.lengths[new_start] = new_end - new_start
+        self.free += end - first - already_free
+        if self.largest is not None:
+            self.largest = max(self.largest, new_end - new_start)
+
+    def find(self, number, start=0):
+        # Start of a run of at least number bits, at start if it has room, otherwise the first one after it
+        i = bisect.bisect_right(self.starts, start) - 1
+        if i >= 0 and start + number <= self.starts[i] + self.lengths[self.starts[i]]:
+            return start
+        if number > self.largest_run():
+            return None
+        for k in itertools.chain(range(i + 1, len(self.starts)), range(i + 1)):
+            if self.lengths[self.starts[k]] >= number:
+                return self.starts[k]
+        return None
+
+    def bits(self, number, start=0):
+        # Up to number free bits at or after start, then wrapping round to the ones before it
+        i = bisect.bisect_right(self.starts, start) - 1
+        bits = []
+        if i >= 0:
+            run_end = self.starts[i] + self.lengths[self.starts[i]]
+            bits.extend(range(start, min(run_end, start + number)))
+        for k in itertools.chain(range(i + 1, len(self.starts)), range(max(i, 0))):
+            if len(bits) >= number:
+                break
+            run_start = self.starts[k]
+            bits.extend(range(run_start, min(run_start + self.lengths[run_start], run_start + number - len(bits))))
+        if i >= 0 and len(bits) < number:
+            run_start = self.starts[i]
+            bits.extend(range(run_start, min(start, run_end, run_start + number - len(bits))))
+        return bits
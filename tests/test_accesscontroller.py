@@ -0,0 +1,83 @@
+import os
+
+from plaraefs.accesscontroller import AccessController, cached_decision
+from plaraefs.accesscontroller.dummy import DummyAccessController
+from plaraefs.pathlevelfilesystem import DirectoryEntry
+
+
+class Filesystem:
+    def __init__(self):
+        self.uid = 0
+
+    def process_info(self):
+        return self.uid, 0, os.getpid()
+
+
+class CountingAccessController(DummyAccessController):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    @cached_decision
+    def file_read(self, file):
+        self.calls += 1
+        return file != 3
+
+
+def make_controller():
+    ac = CountingAccessController()
+    ac.fs = Filesystem()
+    return ac
+
+
+def test_process_identity():
+    ac = make_controller()
+    process = ac.process()
+    assert process.pid == os.getpid()
+    assert process.exe == os.readlink("/proc/self/exe")
+    assert ac.process() is process
+
+    ac.IDENTITY_TTL = 0
+    assert ac.process() is process
+
+    # Another process given the same pid
+    process.start_time -= 1
+    assert ac.process() is not process
+    assert ac.process().start_time == process.start_time + 1
+
+
+def test_cached_decision():
+    ac = make_controller()
+    assert ac.file_read(file=1)
+    assert not ac.file_read(file=3)
+    assert ac.file_read(file=1)
+    assert ac.calls == 2
+
+    # Each user is decided for separately
+    ac.fs.uid = 1000
+    assert ac.file_read(file=1)
+    assert ac.calls == 3
+
+    ac.forget_decisions()
+    assert ac.file_read(file=1)
+    assert ac.calls == 4
+
+    ac.DECISION_TTL = 0
+    assert ac.file_read(file=1)
+    assert ac.calls == 5
+
+    # The dummy's own checks are cached under their own names
+    assert ac.dir_lookup(dir=1, name=b"a", file=2)
+    assert ac.dir_lookup(dir=1, name=b"a", file=2)
+    assert len(ac.decisions) == 2
+
+
+def test_lookup_many():
+    ac = make_controller()
+    entries = [DirectoryEntry(b"a", 1), DirectoryEntry(b"b", 3)]
+    assert ac.dir_lookup_many(dir=1, entries=entries) == entries
+    assert ac.xattr_lookup_many(file=1, names=[b"user.a"]) == [b"user.a"]
+
+    # Falls back to a check per item
+    assert AccessController.dir_lookup_many(ac, dir=1, entries=entries) == entries
+    assert len(ac.decisions) == 2
@@ -0,0 +1,22 @@
+import json
+
+from plaraefs import bench
+
+
+def test_run_benchmarks():
+    names = [name for name in bench.BENCHMARKS if not name.endswith(("[1000]", "[100000]"))]
+    results = bench.run_benchmarks(names, 2, progress=None)
+    assert sorted(results["benchmarks"]) == sorted(names)
+    for result in results["benchmarks"].values():
+        assert result["ops"] == bench.OPS and result["repeat"] == 2
+        assert 0 < result["best"] <= result["median"]
+    assert json.loads(json.dumps(results)) == results
+
+
+def test_compare():
+    old = {"benchmarks": {"a": {"best": 1.0}, "b": {"best": 1.0}, "c": {"best": 1.0}}}
+    new = {"benchmarks": {"a": {"best": 1.05}, "b": {"best": 1.5}, "d": {"best": 1.0}}}
+    changes = bench.compare(old, new, 0.1)
+    assert changes.keys() == {"a", "b"}
+    assert not changes["a"][1]
+    assert changes["b"][1] and abs(changes["b"][0] - 0.5) < 1e-9
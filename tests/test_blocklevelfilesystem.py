@@ -1,6 +1,7 @@
 import pytest
 import pathlib
 import os
+import threading
 
 from plaraefs.blocklevelfilesystem import BlockLevelFilesystem
 
@@ -98,3 +99,67 @@ def test_new_version(fs: BlockLevelFilesystem):
     fs.write_block(0, 0, b"a" * BlockLevelFilesystem.LOGICAL_BLOCK_SIZE)
     reload, token = fs.block_version(0, token)
     assert reload
+
+
+def test_concurrent_access(fs: BlockLevelFilesystem):
+    fs.new_blocks(8)
+    for i in range(8):
+        fs.write_block(i, 0, bytes([i]) * BlockLevelFilesystem.LOGICAL_BLOCK_SIZE)
+    errors = []
+
+    def reader():
+        try:
+            for _ in range(50):
+                for i in range(4):
+                    fs.block_cache.clear()
+                    assert fs.read_block(i) == bytes([i]) * BlockLevelFilesystem.LOGICAL_BLOCK_SIZE
+        except Exception as e:
+            errors.append(e)
+
+    def writer():
+        try:
+            for n in range(50):
+                with fs.lock_file(write=True):
+                    fs.write_block(4 + n % 4, 0, bytes([n]) * 10)
+                    assert fs.read_block(4 + n % 4)[:10] == bytes([n]) * 10
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=reader) for _ in range(4)] + [threading.Thread(target=writer)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert not fs.rwlock.held() and not fs.lock_file_locked
+
+
+def test_stats(fs: BlockLevelFilesystem):
+    fs.new_blocks(2)
+    fs.write_block(0, 0, b"a" * BlockLevelFilesystem.LOGICAL_BLOCK_SIZE)
+    assert fs.stats["bytes_encrypted"] == BlockLevelFilesystem.LOGICAL_BLOCK_SIZE
+    assert fs.stats["encrypt_seconds"] > 0
+
+    # Cached, but only known to be valid after reading the IV
+    before = fs.stats.snapshot()
+    fs.read_block(0)
+    assert fs.stats["iv_reads"] == before.get("iv_reads", 0) + 1
+    assert fs.stats["block_cache_revalidations"] == before.get("block_cache_revalidations", 0) + 1
+
+    fs.block_cache.clear()
+    fs.read_block(0)
+    assert fs.stats["block_cache_misses"] == 1
+    assert fs.stats["bytes_decrypted"] == BlockLevelFilesystem.LOGICAL_BLOCK_SIZE
+
+    with fs.lock_file(write=True):
+        fs.write_block(0, 0, b"b")
+        fs.write_block(1, 0, b"b")
+        iv_reads = fs.stats["iv_reads"]
+        hits = fs.stats["block_cache_hits"]
+        assert fs.read_block(1)[:1] == b"b"
+        assert fs.stats["iv_reads"] == iv_reads
+        assert fs.stats["block_cache_hits"] == hits + 1
+    assert fs.stats["flushes"] == 1
+    assert fs.stats["flushed_blocks"] == 2
+    assert fs.stats["fcntl_locks"] >= 1
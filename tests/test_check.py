@@ -0,0 +1,109 @@
+import pytest
+import pathlib
+import os
+
+from plaraefs.blocklevelfilesystem import BlockLevelFilesystem
+from plaraefs.filelevelfilesystem import FileLevelFilesystem
+from plaraefs.pathlevelfilesystem import PathLevelFilesystem, DirectoryEntry
+from plaraefs.check import Checker, Bitmap
+
+
+@pytest.fixture()
+def fs():
+    key = os.urandom(32)
+    location = pathlib.Path("test_bfs.plaraefs")
+    if location.exists():
+        location.unlink()
+    BlockLevelFilesystem.initialise(location, key)
+    bfs = BlockLevelFilesystem(location, key)
+    FileLevelFilesystem.initialise(bfs)
+    ffs = FileLevelFilesystem(bfs)
+    PathLevelFilesystem.initialise(ffs)
+    fs = PathLevelFilesystem(ffs)
+    dir_id = fs.filefs.create_new_file(1)
+    fs.add_directory_entry(fs.ROOT_FILE_ID, DirectoryEntry(b"dir", dir_id))
+    file_id = fs.filefs.create_new_file(0)
+    fs.add_directory_entry(dir_id, DirectoryEntry(b"file", file_id))
+    fs.filefs.write(file_id, os.urandom(100000), 0)
+    fs.filefs.set_xattr(file_id, b"user.a", b"a" * 5000)
+    fs.filefs.blockfs.flush_writes()
+    yield fs
+    bfs.close()
+    location.unlink()
+
+
+def check(fs, capsys, **kwargs):
+    problems = Checker(fs, workers=2, progress=None, **kwargs).run()
+    return problems, capsys.readouterr().out.splitlines()
+
+
+def test_bitmap():
+    bitmap = Bitmap()
+    assert not bitmap[100]
+    bitmap.set(100)
+    bitmap.set(3)
+    assert bitmap[100] and bitmap[3] and not bitmap[4]
+    assert bitmap.count() == 2
+    assert bitmap.count(100) == 1
+    assert bitmap.count(101) == 2
+
+
+def test_clean(fs: PathLevelFilesystem, capsys):
+    problems, lines = check(fs, capsys, verify=True, list_found=True)
+    assert problems == 0
+    assert any(line.startswith("Found /dir/file file id") for line in lines)
+    assert "Found 1 super blocks" in lines
+
+
+def test_unreferenced(fs: PathLevelFilesystem, capsys):
+    block_id, = fs.filefs.allocate_blocks(1)
+    problems, lines = check(fs, capsys)
+    assert problems == 1
+    assert f"Block {block_id} is marked as used but no file points to it" in lines
+
+    check(fs, capsys, fix_unreferenced=True)
+    assert check(fs, capsys)[0] == 0
+
+
+def test_unused_data(fs: PathLevelFilesystem, capsys):
+    block_id, = fs.filefs.allocate_blocks(1)
+    fs.filefs.blockfs.write_block(block_id, 0, b"a" * fs.filefs.blockfs.LOGICAL_BLOCK_SIZE)
+    fs.filefs.deallocate_blocks([block_id])
+    fs.filefs.blockfs.write_block(block_id, 0, b"a" * fs.filefs.blockfs.LOGICAL_BLOCK_SIZE)
+    problems, lines = check(fs, capsys)
+    assert problems == 1
+    assert f"Block {block_id} is unused but contains data" in lines
+
+    check(fs, capsys, fix_unused_data=True)
+    assert check(fs, capsys)[0] == 0
+
+
+def test_verify(fs: PathLevelFilesystem, capsys):
+    dir_id = fs.search_directory(fs.ROOT_FILE_ID, b"dir").file_id
+    file_id = fs.search_directory(dir_id, b"file").file_id
+    _, header = fs.filefs.get_file_header(file_id, 0)
+    block_id = header.block_ids[3]
+    with open(str(fs.filefs.blockfs.fname), "r+b") as f:
+        f.seek(fs.filefs.blockfs.block_start(block_id) + 100)
+        f.write(b"tampered")
+
+    # Only noticed when the data is decrypted
+    assert check(fs, capsys)[0] == 0
+    problems, lines = check(fs, capsys, verify=True)
+    assert problems == 1
+    assert f"File /dir/file has block {block_id} which fails verification" in lines
+
+
+def test_references(fs: PathLevelFilesystem, capsys):
+    dir_id = fs.search_directory(fs.ROOT_FILE_ID, b"dir").file_id
+    file_id = fs.search_directory(dir_id, b"file").file_id
+    _, header = fs.filefs.get_file_header(file_id, 0)
+    fs.filefs.set_block_references(header.block_ids[0], 1)
+    problems, lines = check(fs, capsys)
+    assert problems == 1
+    assert f"Block {header.block_ids[0]} is referenced by 1 files but its reference count is 2" in lines
+
+    # Shared by a clone, so referenced twice
+    fs.filefs.set_block_references(header.block_ids[0], 0)
+    fs.add_directory_entry(dir_id, DirectoryEntry(b"clone", fs.filefs.clone_file(file_id)))
+    assert check(fs, capsys)[0] == 0
@@ -0,0 +1,169 @@
+import pytest
+import pathlib
+import os
+
+from plaraefs.blocklevelfilesystem import BlockLevelFilesystem
+from plaraefs.filelevelfilesystem import FileLevelFilesystem
+from plaraefs.pathlevelfilesystem import PathLevelFilesystem, DirectoryEntry
+from plaraefs.check import Checker
+from plaraefs.compact import Compactor
+from plaraefs.snapshot import Snapshots
+
+
+@pytest.fixture()
+def fs():
+    key = os.urandom(32)
+    location = pathlib.Path("test_bfs.plaraefs")
+    if location.exists():
+        location.unlink()
+    BlockLevelFilesystem.initialise(location, key)
+    bfs = BlockLevelFilesystem(location, key)
+    FileLevelFilesystem.initialise(bfs)
+    ffs = FileLevelFilesystem(bfs)
+    PathLevelFilesystem.initialise(ffs)
+    fs = PathLevelFilesystem(ffs)
+    yield fs
+    bfs.close()
+    location.unlink()
+
+
+def add_file(fs, name, data):
+    file_id = fs.filefs.create_new_file(0)
+    fs.add_directory_entry(fs.ROOT_FILE_ID, DirectoryEntry(name, file_id))
+    fs.filefs.write(file_id, data, 0)
+    return file_id
+
+
+def compact(fs, capsys):
+    result = Compactor(fs, progress=None).run()
+    lines = capsys.readouterr().out.splitlines()
+    assert Checker(fs, workers=2, progress=None, verify=True).run() == 0, capsys.readouterr().out
+    capsys.readouterr()
+    return result, lines
+
+
+def test_compact(fs: PathLevelFilesystem, capsys):
+    blocks = fs.filefs.BLOCK_IDS_PER_HEADER * 3
+    first = add_file(fs, b"first", os.urandom(blocks * fs.filefs.blockfs.LOGICAL_BLOCK_SIZE))
+    data = os.urandom(blocks * fs.filefs.blockfs.LOGICAL_BLOCK_SIZE)
+    file_id = add_file(fs, b"second", data)
+    xattr = os.urandom(3 * fs.filefs.blockfs.LOGICAL_BLOCK_SIZE)
+    fs.filefs.set_xattr(file_id, b"user.a", xattr)
+
+    fs.remove_directory_entry(fs.ROOT_FILE_ID, b"first")
+    fs.filefs.delete_file(first)
+    fs.filefs.blockfs.flush_writes()
+
+    (before, after), lines = compact(fs, capsys)
+    assert after < before - blocks
+    assert fs.filefs.blockfs.total_blocks() == after
+    assert fs.filefs.read(file_id, len(data), 0) == data
+    assert fs.filefs.read_xattrs(file_id)[b"user.a"] == xattr
+
+    # Moved blocks are placed together
+    header = fs.filefs.read_file_header(file_id, 1, fs.filefs.get_file_header(file_id, 1)[0])
+    assert header.block_ids == list(range(header.block_ids[0], header.block_ids[0] + len(header.block_ids)))
+
+    # Nothing left to move
+    (before, after), lines = compact(fs, capsys)
+    assert before == after
+    assert lines == [f"Moved 0 blocks, removing 0 of {before} blocks"]
+
+
+def test_compact_shared(fs: PathLevelFilesystem, capsys):
+    data = os.urandom(10 * fs.filefs.blockfs.LOGICAL_BLOCK_SIZE)
+    first = add_file(fs, b"first", data)
+    file_id = add_file(fs, b"second", data)
+    fs.add_directory_entry(fs.ROOT_FILE_ID, DirectoryEntry(b"clone", fs.filefs.clone_file(file_id)))
+    fs.remove_directory_entry(fs.ROOT_FILE_ID, b"first")
+    fs.filefs.delete_file(first)
+    fs.filefs.blockfs.flush_writes()
+
+    # The shared blocks and their refcount table move once for both files
+    (before, after), lines = compact(fs, capsys)
+    assert after < before
+    second, clone = (fs.search_directory(fs.ROOT_FILE_ID, name).file_id for name in (b"second", b"clone"))
+    assert fs.filefs.read(second) == fs.filefs.read(clone) == data
+    assert fs.filefs.block_references(fs.filefs.file_block_id(second, 1)) == 1
+    assert all(table_block < after for _, table_block in fs.filefs.refcount_table_blocks())
+
+
+def test_compact_headers(fs: PathLevelFilesystem, capsys):
+    first = add_file(fs, b"first", os.urandom(50 * fs.filefs.blockfs.LOGICAL_BLOCK_SIZE))
+    dir_id = fs.filefs.create_new_file(1)
+    fs.add_directory_entry(fs.ROOT_FILE_ID, DirectoryEntry(b"dir", dir_id))
+    file_id = fs.filefs.create_new_file(0)
+    fs.add_directory_entry(dir_id, DirectoryEntry(b"file", file_id))
+    fs.filefs.write(file_id, b"a" * 10, 0)
+    fs.filefs.set_xattr(file_id, b"user.a", b"b")
+    fs.remove_directory_entry(fs.ROOT_FILE_ID, b"first")
+    fs.filefs.delete_file(first)
+    fs.filefs.blockfs.flush_writes()
+
+    # Headers at the end move, and the directory entries pointing to them follow
+    (before, after), lines = compact(fs, capsys)
+    assert after < dir_id
+    new_dir_id = fs.search_directory(fs.ROOT_FILE_ID, b"dir").file_id
+    new_file_id = fs.search_directory(new_dir_id, b"file").file_id
+    assert new_dir_id != dir_id and new_file_id != file_id
+    assert fs.filefs.read(new_file_id) == b"a" * 10
+    assert fs.filefs.read_xattrs(new_file_id) == {b"user.a": b"b"}
+
+
+def test_compact_orphans(fs: PathLevelFilesystem, capsys):
+    first = add_file(fs, b"first", os.urandom(10 * fs.filefs.blockfs.LOGICAL_BLOCK_SIZE))
+    file_id = add_file(fs, b"second", b"a" * 10)
+    fs.remove_directory_entry(fs.ROOT_FILE_ID, b"first")
+    fs.orphan_file(first)
+
+    # Deleted files are freed rather than moved
+    (before, after), lines = compact(fs, capsys)
+    assert after < file_id
+    assert lines[0] == "Freed 11 blocks of deleted files"
+    assert fs.filefs.read(fs.search_directory(fs.ROOT_FILE_ID, b"second").file_id) == b"a" * 10
+
+
+def test_compact_unreferenced(fs: PathLevelFilesystem, capsys):
+    first = add_file(fs, b"first", os.urandom(10 * fs.filefs.blockfs.LOGICAL_BLOCK_SIZE))
+    fs.filefs.allocate_blocks(1)
+    fs.remove_directory_entry(fs.ROOT_FILE_ID, b"first")
+    fs.filefs.delete_file(first)
+
+    # Nothing moves past a block nothing points to, which might still hold data
+    before, after = Compactor(fs, progress=None).run()
+    assert after == before
+    lines = capsys.readouterr().out.splitlines()
+    assert any("Use check --fix-unreferenced" in line for line in lines)
+
+
+def test_compact_mounted(fs: PathLevelFilesystem, capsys):
+    first = add_file(fs, b"first", os.urandom(10 * fs.filefs.blockfs.LOGICAL_BLOCK_SIZE))
+    add_file(fs, b"second", b"a" * 10)
+    fs.remove_directory_entry(fs.ROOT_FILE_ID, b"first")
+    fs.filefs.delete_file(first)
+    fs.filefs.blockfs.flush_writes()
+
+    # A mount holds a shared claim on the file for as long as it is mounted
+    blockfs = fs.filefs.blockfs
+    mount = BlockLevelFilesystem(blockfs.fname, blockfs.key)
+    assert mount.claim(exclusive=False)
+    (before, after), lines = compact(fs, capsys)
+    assert before == after
+    assert lines == ["The filesystem is mounted, unmount it before compacting"]
+
+    mount.close()
+    (before, after), lines = compact(fs, capsys)
+    assert after < before
+
+
+def test_compact_with_snapshots(fs: PathLevelFilesystem, capsys):
+    data = os.urandom(10 * fs.filefs.blockfs.LOGICAL_BLOCK_SIZE)
+    first = add_file(fs, b"first", data)
+    add_file(fs, b"second", data)
+    Snapshots(fs).create(b"backup")
+    fs.remove_directory_entry(fs.ROOT_FILE_ID, b"first")
+    fs.filefs.delete_file(first)
+
+    (before, after), lines = compact(fs, capsys)
+    assert before == after
+    assert lines == ["Snapshots refer to blocks where they are, delete them before compacting"]
@@ -6,6 +6,7 @@ import bitarray
 
 from plaraefs.blocklevelfilesystem import BlockLevelFilesystem
 from plaraefs.filelevelfilesystem import FileLevelFilesystem, FileHeader, FileContinuationHeader
+from plaraefs.utils import BitArray, FreeRuns
 
 
 @pytest.fixture()
@@ -287,7 +288,8 @@ def test_xattr_write_small(fs: FileLevelFilesystem):
     fs.set_xattr(file_id, b"user.test", b"test")
     fs.header_cache.clear()
 
-    assert fs.get_file_header(file_id, 0)[1].xattr_inline == b"user.test\0test".ljust(fs.XATTR_INLINE_SIZE, b"\0")
+    assert (fs.get_file_header(file_id, 0)[1].xattr_inline
+            == b"\x09\x04\0user.testtest".ljust(fs.XATTR_INLINE_SIZE, b"\0"))
     assert fs.read_xattrs(file_id) == {b"user.test": b"test"}
     assert fs.lookup_xattr(file_id, b"user.test") == b"test"
 
@@ -330,3 +332,306 @@ def test_xattr_write_large(fs: FileLevelFilesystem):
 
     assert fs.read_xattrs(file_id) == {}
     assert fs.read_superblock(0).count(1) == 2
+
+
+def test_free_space_summary(fs: FileLevelFilesystem):
+    fs.allocate_blocks(10)
+    fs.rebuild_free_space_summary()
+
+    summary = fs.free_space[0]
+    assert summary.free == fs.SUPERBLOCK_INTERVAL - 11
+    assert summary.largest_run == fs.SUPERBLOCK_INTERVAL - 11
+
+    fs.deallocate_blocks([3, 4])
+
+    assert fs.free_space[0].free == fs.SUPERBLOCK_INTERVAL - 9
+    assert fs.free_space[0].largest_run == fs.SUPERBLOCK_INTERVAL - 11
+    assert fs.number_free_blocks(0) == fs.SUPERBLOCK_INTERVAL - 9
+
+
+def test_allocate_blocks_contiguous(fs: FileLevelFilesystem):
+    blocks = fs.allocate_blocks(10)
+    fs.deallocate_blocks([blocks[2], blocks[5]])
+
+    # Holes are too small, so the run after the allocated blocks is used
+    assert fs.allocate_blocks(3) == [11, 12, 13]
+    # Single blocks fill the holes first
+    assert fs.allocate_blocks(1) == [blocks[2]]
+    # Allocation near a block continues straight after it
+    assert fs.allocate_blocks(2, 30) == [30, 31]
+    assert fs.allocate_blocks(2, 30) == [32, 33]
+
+
+def test_allocate_blocks_skips_full_superblock(fs: FileLevelFilesystem):
+    blocks = fs.allocate_blocks(fs.SUPERBLOCK_INTERVAL - 1)
+
+    assert blocks == list(range(1, fs.SUPERBLOCK_INTERVAL))
+    assert fs.free_space[0].free == 0
+
+    blocks = fs.allocate_blocks(2)
+
+    assert blocks == [fs.SUPERBLOCK_INTERVAL + 1, fs.SUPERBLOCK_INTERVAL + 2]
+    assert fs.read_superblock(1)[0]
+
+
+def test_allocate_blocks_prefers_run_in_other_superblock(fs: FileLevelFilesystem):
+    fs.allocate_blocks(fs.SUPERBLOCK_INTERVAL - 1)
+    fs.allocate_blocks(5)
+    fs.deallocate_blocks([2, 4, 6])
+
+    # The holes near the start only take blocks which don't fit in a run anywhere else
+    assert fs.allocate_blocks(3) == [fs.SUPERBLOCK_INTERVAL + 6, fs.SUPERBLOCK_INTERVAL + 7,
+                                     fs.SUPERBLOCK_INTERVAL + 8]
+    assert fs.allocate_blocks(1) == [2]
+
+
+def test_free_space_summary_updated_in_place(fs: FileLevelFilesystem, monkeypatch):
+    fs.allocate_blocks(100)
+    fs.rebuild_free_space_summary()
+
+    def free_runs(self):
+        raise AssertionError("Bitmap scanned")
+
+    with monkeypatch.context() as m:
+        m.setattr(BitArray, "free_runs", free_runs)
+        fs.deallocate_blocks([10, 11, 50, 99])
+        fs.allocate_blocks(3, 40)
+        fs.mark_blocks([12], False)
+
+    runs = fs.free_space[0].runs
+    expected = FreeRuns(fs.read_superblock(0))
+    assert (runs.starts, runs.lengths, runs.free) == (expected.starts, expected.lengths, expected.free)
+
+
+def test_preallocate(fs: FileLevelFilesystem):
+    file_id = fs.create_new_file(0)
+    fs.write(file_id, b"abc")
+
+    fs.preallocate(file_id, 10 * fs.blockfs.LOGICAL_BLOCK_SIZE, keep_size=True)
+
+    assert fs.num_file_blocks(file_id) == 11
+    assert fs.get_file_header(file_id, 0)[1].size == 3
+    assert fs.get_file_header(file_id, 0)[1].block_ids == list(range(2, 12))
+    assert all(fs.blockfs.read_block(block_id) is None for block_id in range(2, 12))
+
+    fs.preallocate(file_id, 5 * fs.blockfs.LOGICAL_BLOCK_SIZE)
+
+    assert fs.num_file_blocks(file_id) == 11
+    assert fs.get_file_header(file_id, 0)[1].size == 5 * fs.blockfs.LOGICAL_BLOCK_SIZE
+    assert fs.read(file_id) == b"abc".ljust(5 * fs.blockfs.LOGICAL_BLOCK_SIZE, b"\0")
+
+    fs.write(file_id, b"def", 2 * fs.blockfs.LOGICAL_BLOCK_SIZE)
+
+    assert fs.num_file_blocks(file_id) == 11
+    assert fs.read(file_id, 3, 2 * fs.blockfs.LOGICAL_BLOCK_SIZE) == b"def"
+
+
+def test_sparse_write(fs: FileLevelFilesystem):
+    file_id = fs.create_new_file(0)
+    offset = fs.offset_from_block(fs.FILE_HEADER_INTERVAL * 3 + 5)
+
+    fs.write(file_id, b"abcdef", offset)
+
+    # Header, three continuation headers and the single data block
+    assert fs.read_superblock(0).count(1) == 1 + 4 + 1
+    assert fs.get_file_header(file_id, 0)[1].size == offset + 6
+    assert fs.get_file_header(file_id, 3)[1].block_ids == [0, 0, 0, 0, 5]
+    assert fs.read(file_id) == b"\0" * offset + b"abcdef"
+
+    fs.write(file_id, b"123", 10000)
+
+    assert fs.read_superblock(0).count(1) == 1 + 4 + 2
+    assert fs.get_file_header(file_id, 0)[1].block_ids == [0, 6]
+    assert fs.read(file_id, 9, 9997) == b"\0" * 3 + b"123" + b"\0" * 3
+
+
+def test_sparse_truncate(fs: FileLevelFilesystem):
+    file_id = fs.create_new_file(0)
+    fs.write(file_id, b"abcdef" * 1000)
+
+    fs.truncate_file_size(file_id, 3)
+    fs.truncate_file_size(file_id, 2 ** 20)
+
+    assert fs.num_file_blocks(file_id) == 1
+    assert fs.read(file_id) == b"abc" + b"\0" * (2 ** 20 - 3)
+
+
+def test_punch_hole(fs: FileLevelFilesystem):
+    file_id = fs.create_new_file(0)
+    size = fs.offset_from_block(5)
+    fs.write(file_id, b"a" * size)
+
+    start = fs.offset_from_block(1) + 10
+    fs.punch_hole(file_id, start, fs.offset_from_block(4) - start)
+
+    assert fs.get_file_header(file_id, 0)[1].block_ids == [2, 0, 0, 5]
+    end = fs.offset_from_block(4)
+    assert fs.read(file_id) == b"a" * start + b"\0" * (end - start) + b"a" * (size - end)
+    assert fs.read_superblock(0).count(1) == 4
+
+
+def test_seek_data_hole(fs: FileLevelFilesystem):
+    file_id = fs.create_new_file(0)
+    data_start = fs.offset_from_block(3)
+    fs.write(file_id, b"a" * 100, data_start)
+    fs.truncate_file_size(file_id, fs.offset_from_block(10))
+
+    assert fs.seek_data(file_id, 0) == 0
+    assert fs.seek_hole(file_id, 0) == fs.offset_from_block(1)
+    assert fs.seek_data(file_id, fs.offset_from_block(1)) == data_start
+    assert fs.seek_hole(file_id, data_start + 5) == fs.offset_from_block(4)
+    assert fs.seek_data(file_id, fs.offset_from_block(4)) is None
+    assert fs.seek_hole(file_id, fs.offset_from_block(10) - 1) == fs.offset_from_block(10) - 1
+    assert fs.seek_hole(file_id, fs.offset_from_block(10)) is None
+
+
+def test_offset_from_block(fs: FileLevelFilesystem):
+    for block_num in range(fs.FILE_HEADER_INTERVAL * 3):
+        offset = fs.offset_from_block(block_num)
+        assert fs.block_from_offset(offset) == (block_num, 0)
+        assert fs.block_from_offset(offset + fs.file_data_in_block(block_num) - 1)[0] == block_num
+
+
+def test_xattr_update_single_block(fs: FileLevelFilesystem):
+    file_id = fs.create_new_file(0)
+
+    fs.write_xattrs(file_id, {b"user.a": b"a" * 3000, b"user.b": b"b" * 3000, b"user.c": b"c"})
+    _, hdata = fs.get_file_header(file_id, 0)
+    first_block = hdata.xattr_block
+
+    assert fs.read_superblock(0).count(1) == 4
+    assert fs.load_xattrs(file_id).segments[0] == [[b"user.c", b"c"]]
+
+    reads_before = fs.blockfs.block_reads
+    writes_before = fs.blockfs.block_writes
+
+    assert fs.lookup_xattr(file_id, b"user.a") == b"a" * 3000
+    fs.set_xattr(file_id, b"user.b", b"x" * 10)
+
+    # Only the block holding user.b is rewritten, and nothing is read back
+    assert fs.blockfs.block_reads == reads_before
+    assert fs.blockfs.block_writes == writes_before + 1
+    assert fs.get_file_header(file_id, 0)[1].xattr_block == first_block
+
+    fs.xattr_cache.clear()
+
+    assert fs.read_xattrs(file_id) == {b"user.a": b"a" * 3000, b"user.b": b"x" * 10, b"user.c": b"c"}
+
+    fs.delete_xattr(file_id, b"user.a")
+
+    assert fs.read_xattrs(file_id) == {b"user.b": b"x" * 10, b"user.c": b"c"}
+    assert fs.read_superblock(0).count(1) == 3
+
+
+def test_clone_file(fs: FileLevelFilesystem):
+    fs.refcount_file_id = fs.create_new_file(0)
+    initial_free_blocks = fs.number_free_blocks(0)
+    file_id = fs.create_new_file(0)
+    data = os.urandom(fs.blockfs.LOGICAL_BLOCK_SIZE * 40 + 123)
+    fs.write(file_id, data, 0)
+    fs.set_xattr(file_id, b"user.a", b"b")
+    free_blocks = fs.number_free_blocks(0)
+
+    clone_id = fs.clone_file(file_id)
+    assert fs.read(clone_id) == data
+    assert fs.read_xattrs(clone_id) == {b"user.a": b"b"}
+    # Only the headers and the table block holding the counts are new, the data blocks are shared
+    assert free_blocks - fs.number_free_blocks(0) == 3
+    assert fs.file_block_id(clone_id, 5) == fs.file_block_id(file_id, 5)
+    assert fs.block_references(fs.file_block_id(file_id, 5)) == 1
+
+    fs.write(clone_id, b"x", fs.offset_from_block(5) + 10)
+    assert fs.file_block_id(clone_id, 5) != fs.file_block_id(file_id, 5)
+    assert fs.block_references(fs.file_block_id(file_id, 5)) == 0
+    assert fs.read(file_id) == data
+    expected = bytearray(data)
+    expected[fs.offset_from_block(5) + 10] = ord("x")
+    assert fs.read(clone_id) == expected
+
+    fs.delete_file(file_id)
+    assert fs.read(clone_id) == expected
+    fs.delete_file(clone_id)
+    # The table block is kept for the next time a block in its range is shared
+    assert fs.number_free_blocks(0) == initial_free_blocks - 1
+
+
+def test_refcount_table(fs: FileLevelFilesystem):
+    fs.refcount_file_id = fs.create_new_file(0)
+    file_id = fs.create_new_file(0)
+    fs.write(file_id, b"a" * fs.blockfs.LOGICAL_BLOCK_SIZE, fs.offset_from_block(1))
+
+    # Nothing has been shared, so writing doesn't look up any counts
+    reads_before = fs.blockfs.block_reads
+    fs.write(file_id, b"b" * fs.blockfs.LOGICAL_BLOCK_SIZE, fs.offset_from_block(1))
+    assert fs.blockfs.block_reads == reads_before
+
+    block_id = 5 * fs.SUPERBLOCK_INTERVAL + 7
+    fs.set_block_references(block_id, 2)
+
+    assert fs.block_references(block_id) == 2
+    assert fs.block_references(block_id + 1) == 0
+    assert fs.block_references(7) == 0
+    # A block id for each range of counts up to the shared block, rather than a count for every block before it
+    assert fs.get_file_header(fs.refcount_file_id, 0)[1].size == (
+        (block_id // fs.REFCOUNTS_PER_BLOCK + 1) * fs.blockfs.BLOCK_ID_SIZE)
+    assert fs.num_file_blocks(fs.refcount_file_id) == 1
+    [(first, table_block)] = fs.refcount_table_blocks()
+    assert first == block_id - block_id % fs.REFCOUNTS_PER_BLOCK
+    assert fs.unpack_refcounts(fs.blockfs.read_block(table_block))[block_id - first] == 2
+
+
+def test_clone_range(fs: FileLevelFilesystem):
+    fs.refcount_file_id = fs.create_new_file(0)
+    file_id = fs.create_new_file(0)
+    data = os.urandom(fs.blockfs.LOGICAL_BLOCK_SIZE * 10)
+    fs.write(file_id, data, 0)
+    other_id = fs.create_new_file(0)
+    fs.write(other_id, b"y" * 100, 0)
+
+    # Misaligned ranges are copied
+    assert fs.clone_range(file_id, 1000, other_id, 50, 10000) == 10000
+    assert fs.read(other_id) == b"y" * 50 + data[1000:11000]
+    assert all(not fs.block_references(block_id) for block_id in range(fs.blockfs.total_blocks()))
+
+    # Aligned ranges share the whole blocks in the middle
+    other_id = fs.create_new_file(0)
+    start = fs.offset_from_block(2) + 5
+    assert fs.clone_range(file_id, start, other_id, start, 5 * fs.blockfs.LOGICAL_BLOCK_SIZE) \
+        == 5 * fs.blockfs.LOGICAL_BLOCK_SIZE
+    assert fs.read(other_id) == b"\0" * start + data[start:start + 5 * fs.blockfs.LOGICAL_BLOCK_SIZE]
+    assert [fs.file_block_id(other_id, i) == fs.file_block_id(file_id, i) for i in range(1, 9)] \
+        == [False, False, True, True, True, True, False, False]
+    assert fs.clone_range(file_id, len(data), other_id, len(data), 10) == 0
+
+
+def test_write_encrypts_whole_blocks_unlocked(fs: FileLevelFilesystem, monkeypatch):
+    file_id = fs.create_new_file(0)
+    encrypt_block = BlockLevelFilesystem.encrypt_block
+    locked = []
+
+    def record(self, *args, **kwargs):
+        locked.append(self.rwlock.held())
+        return encrypt_block(self, *args, **kwargs)
+
+    monkeypatch.setattr(BlockLevelFilesystem, "encrypt_block", record)
+    offset = fs.FILE_HEADER_DATA_SIZE + 100
+    data = os.urandom(3 * fs.blockfs.LOGICAL_BLOCK_SIZE)
+    fs.write(file_id, data, offset)
+    fs.blockfs.flush_writes()
+    # Two whole blocks, and the partial blocks either side of them once flushed
+    assert locked.count(False) == 2
+    assert fs.read(file_id, len(data), offset) == data
+
+
+def test_header_cache_evicted_by_other_reader(fs: FileLevelFilesystem, monkeypatch):
+    file_id = fs.create_new_file(0)
+    fs.write(file_id, os.urandom(3 * fs.FILE_HEADER_INTERVAL * fs.blockfs.LOGICAL_BLOCK_SIZE))
+    fs.forget_file_headers(file_id)
+    fs.get_file_header(file_id, 1)
+
+    # Keys taken just before another reader evicts the entries
+    keys = fs.header_cache.keys()
+    fs.header_cache.clear()
+    monkeypatch.setattr(fs.header_cache, "keys", lambda: keys)
+    assert fs.get_file_header(file_id, 2)[1].block_ids
+    assert fs.get_last_file_header(file_id)[0] == 3
@@ -0,0 +1,173 @@
+import pytest
+import pathlib
+import getpass
+import bcrypt
+import os
+import types
+
+from plaraefs.blocklevelfilesystem import BlockLevelFilesystem
+from plaraefs.filelevelfilesystem import FileLevelFilesystem
+from plaraefs.pathlevelfilesystem import PathLevelFilesystem, DirectoryEntry
+from plaraefs.fusefilesystem import FUSEFilesystem
+from plaraefs.rekey import Rekeyer
+from plaraefs.accesscontroller.dummy import DummyAccessController
+
+
+@pytest.fixture()
+def fs(monkeypatch):
+    # Requests come from this process rather than through a mount
+    monkeypatch.setattr(getpass, "getpass", lambda *args: "")
+    monkeypatch.setattr(FUSEFilesystem, "process_info", lambda self: (os.getuid(), os.getgid(), os.getpid()))
+    key = os.urandom(32)
+    location = pathlib.Path("test_bfs.plaraefs")
+    if location.exists():
+        location.unlink()
+    BlockLevelFilesystem.initialise(location, key)
+    bfs = BlockLevelFilesystem(location, key)
+    FileLevelFilesystem.initialise(bfs)
+    ffs = FileLevelFilesystem(bfs)
+    PathLevelFilesystem.initialise(ffs)
+    fs = FUSEFilesystem(location, DummyAccessController())
+    fs.blockfs = bfs
+    fs.filefs = ffs
+    fs.pathfs = PathLevelFilesystem(ffs)
+    yield fs
+    bfs.close()
+    location.unlink()
+
+
+def test_readdir_one_entry_at_a_time(fs: FUSEFilesystem):
+    # Names sorting before "." and ".."
+    names = [b"-x", b"+", b"!a", b"b"]
+    for name in names:
+        fs.pathfs.add_directory_entry(fs.pathfs.ROOT_FILE_ID, DirectoryEntry(name, fs.filefs.create_new_file(0)))
+    info = types.SimpleNamespace(fh=fs.open_handle(fs.pathfs.ROOT_FILE_ID))
+
+    listed = []
+    offset = 0
+    while True:
+        filled = []
+
+        def filler(buf, name, stat, next_offset, flags):
+            # Room for one entry per call
+            if filled:
+                return 1
+            filled.append((next_offset, name))
+            return 0
+
+        assert fs.readdir(b"/", None, filler, offset, info, 0) == 0
+        if not filled:
+            break
+        listed.extend(filled)
+        offset = filled[-1][0]
+
+    assert [entry_offset for entry_offset, _ in listed] == list(range(1, 3 + len(names)))
+    assert sorted(name for _, name in listed) == sorted([b".", b".."] + names)
+
+
+def test_interrupted_rekey(monkeypatch, caplog):
+    monkeypatch.setattr(getpass, "getpass", lambda *args: "")
+    gensalt = bcrypt.gensalt
+    monkeypatch.setattr(bcrypt, "gensalt", lambda rounds: gensalt(4))
+    location = pathlib.Path("test_bfs.plaraefs")
+    if location.exists():
+        location.unlink()
+    fs = FUSEFilesystem(location, DummyAccessController())
+    fs.open_filesystem()
+    fs.blockfs.close()
+
+    def interrupt(self):
+        raise KeyboardInterrupt()
+    run = Rekeyer.run
+    monkeypatch.setattr(Rekeyer, "run", interrupt)
+    fs = FUSEFilesystem(location, DummyAccessController())
+    with pytest.raises(KeyboardInterrupt):
+        fs.rekey()
+    fs.blockfs.close()
+
+    # Told to finish the rekey rather than failing on the key
+    with pytest.raises(RuntimeError):
+        FUSEFilesystem(location, DummyAccessController()).open_filesystem()
+    assert "finish it by running rekey again" in caplog.text
+
+    monkeypatch.setattr(Rekeyer, "run", run)
+    fs = FUSEFilesystem(location, DummyAccessController())
+    fs.rekey()
+    fs.blockfs.close()
+    fs = FUSEFilesystem(location, DummyAccessController())
+    fs.open_filesystem()
+    fs.blockfs.close()
+    location.unlink()
+
+
+def test_rekey_while_mounted(monkeypatch):
+    monkeypatch.setattr(getpass, "getpass", lambda *args: "")
+    gensalt = bcrypt.gensalt
+    monkeypatch.setattr(bcrypt, "gensalt", lambda rounds: gensalt(4))
+    location = pathlib.Path("test_bfs.plaraefs")
+    if location.exists():
+        location.unlink()
+    fs = FUSEFilesystem(location, DummyAccessController())
+    fs.open_filesystem()
+    # A mount holds a shared claim for as long as it is mounted
+    assert fs.blockfs.claim(exclusive=False)
+
+    rekeying = FUSEFilesystem(location, DummyAccessController())
+    with pytest.raises(RuntimeError):
+        rekeying.rekey()
+    rekeying.blockfs.close()
+    fs.blockfs.close()
+
+    # Neither marked as rekeying nor using the new key
+    fs = FUSEFilesystem(location, DummyAccessController())
+    fs.open_filesystem()
+    fs.blockfs.close()
+    location.unlink()
+
+
+def test_dentries_changed_by_other_process(fs: FUSEFilesystem):
+    other = PathLevelFilesystem(FileLevelFilesystem(BlockLevelFilesystem(fs.blockfs.fname, fs.blockfs.key)))
+    root = fs.pathfs.ROOT_FILE_ID
+    assert fs.lookup_entry(root, b"x") is None
+    hits = fs.blockfs.stats["dentry_cache_hits"]
+    assert fs.lookup_entry(root, b"x") is None
+    assert fs.blockfs.stats["dentry_cache_hits"] == hits + 1
+
+    file_id = other.filefs.create_new_file(0)
+    other.add_directory_entry(root, DirectoryEntry(b"x", file_id))
+    other.filefs.blockfs.flush_writes()
+    assert fs.lookup_entry(root, b"x") == file_id
+
+    # Overwriting only changes the leaf
+    new_file_id = other.filefs.create_new_file(0)
+    other.add_directory_entry(root, DirectoryEntry(b"x", new_file_id), overwrite=True)
+    other.filefs.blockfs.flush_writes()
+    assert fs.lookup_entry(root, b"x") == new_file_id
+
+    other.remove_directory_entry(root, b"x")
+    other.filefs.blockfs.flush_writes()
+    assert fs.lookup_entry(root, b"x") is None
+    other.filefs.blockfs.close()
+
+
+def test_older_format(monkeypatch, caplog):
+    monkeypatch.setattr(getpass, "getpass", lambda *args: "")
+    gensalt = bcrypt.gensalt
+    monkeypatch.setattr(bcrypt, "gensalt", lambda rounds: gensalt(4))
+    location = pathlib.Path("test_bfs.plaraefs")
+    if location.exists():
+        location.unlink()
+    fs = FUSEFilesystem(location, DummyAccessController())
+    fs.open_filesystem()
+    fs.blockfs.close()
+
+    # Made before the format version was stored, when it was padding
+    with location.open("r+b") as f:
+        f.seek(30)
+        f.write(b"\0")
+    with pytest.raises(RuntimeError):
+        FUSEFilesystem(location, DummyAccessController()).open_filesystem()
+    assert "older plaraefs, with format version 0" in caplog.text
+    with pytest.raises(RuntimeError):
+        FUSEFilesystem(location, DummyAccessController()).rekey()
+    location.unlink()
@@ -0,0 +1,34 @@
+from plaraefs.metrics import Metrics, BOUNDS, write_atomically
+
+
+def test_histogram():
+    metrics = Metrics()
+    metrics.record("read", 0.0001)
+    metrics.record("read", 0.5, error=True)
+    metrics.record("write", 10 ** 6)
+    assert metrics.count("read") == 2
+    assert metrics.count("getattr") == 0
+
+    # Buckets are no more than a quarter apart
+    assert all(b / a < 1.25 + 1e-9 for a, b in zip(BOUNDS, BOUNDS[1:]))
+
+    lines = metrics.prometheus().splitlines()
+    assert 'plaraefs_fuse_requests_total{op="read"} 2' in lines
+    assert 'plaraefs_fuse_errors_total{op="read"} 1' in lines
+    assert 'plaraefs_fuse_errors_total{op="write"} 0' in lines
+    assert 'plaraefs_fuse_request_seconds_bucket{op="read",le="9.6e-05"} 0' in lines
+    assert 'plaraefs_fuse_request_seconds_bucket{op="read",le="0.000112"} 1' in lines
+    assert 'plaraefs_fuse_request_seconds_bucket{op="read",le="0.524288"} 2' in lines
+    assert 'plaraefs_fuse_request_seconds_bucket{op="read",le="+Inf"} 2' in lines
+    assert 'plaraefs_fuse_request_seconds_bucket{op="write",le="67.108864"} 0' in lines
+    assert 'plaraefs_fuse_request_seconds_bucket{op="write",le="+Inf"} 1' in lines
+    assert 'plaraefs_fuse_request_seconds_count{op="write"} 1' in lines
+
+
+def test_write(tmpdir):
+    metrics = Metrics()
+    metrics.record("open", 0.001)
+    path = tmpdir.join("plaraefs.prom")
+    write_atomically(str(path), metrics.prometheus())
+    assert path.read() == metrics.prometheus()
+    assert tmpdir.listdir() == [path]
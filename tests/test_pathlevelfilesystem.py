@@ -1,10 +1,11 @@
 import pytest
 import pathlib
 import os
+import random
 
 from plaraefs.blocklevelfilesystem import BlockLevelFilesystem
 from plaraefs.filelevelfilesystem import FileLevelFilesystem
-from plaraefs.pathlevelfilesystem import PathLevelFilesystem, DirectoryEntry
+from plaraefs.pathlevelfilesystem import PathLevelFilesystem, DirectoryEntry, DirectoryNode
 
 
 @pytest.fixture()
@@ -24,56 +25,56 @@ def fs():
 
 
 def test_directory_lookup_simple(fs: PathLevelFilesystem):
-    assert fs.search_directory(fs.ROOT_FILE_ID, b"a")[0] is None
-    assert fs.search_directory(fs.ROOT_FILE_ID, b"b")[0] is None
-    assert fs.search_directory(fs.ROOT_FILE_ID, b"c")[0] is None
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"a") is None
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"b") is None
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"c") is None
 
     de = DirectoryEntry(b"a", fs.ROOT_FILE_ID + 1)
     fs.add_directory_entry(fs.ROOT_FILE_ID, de)
 
-    assert fs.filefs.read(fs.ROOT_FILE_ID) == fs.pack_directory_entry(de)
+    assert list(fs.directory_entries(fs.ROOT_FILE_ID)) == [de]
 
-    assert fs.search_directory(fs.ROOT_FILE_ID, b"a")[0].file_id == fs.ROOT_FILE_ID + 1
-    assert fs.search_directory(fs.ROOT_FILE_ID, b"b")[0] is None
-    assert fs.search_directory(fs.ROOT_FILE_ID, b"c")[0] is None
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"a").file_id == fs.ROOT_FILE_ID + 1
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"b") is None
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"c") is None
 
     de2 = DirectoryEntry(b"b", fs.ROOT_FILE_ID + 2)
     fs.add_directory_entry(fs.ROOT_FILE_ID, de2)
 
-    assert fs.filefs.read(fs.ROOT_FILE_ID) == fs.pack_directory_entry(de) + fs.pack_directory_entry(de2)
+    assert list(fs.directory_entries(fs.ROOT_FILE_ID)) == [de, de2]
 
-    assert fs.search_directory(fs.ROOT_FILE_ID, b"a")[0].file_id == fs.ROOT_FILE_ID + 1
-    assert fs.search_directory(fs.ROOT_FILE_ID, b"b")[0].file_id == fs.ROOT_FILE_ID + 2
-    assert fs.search_directory(fs.ROOT_FILE_ID, b"c")[0] is None
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"a").file_id == fs.ROOT_FILE_ID + 1
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"b").file_id == fs.ROOT_FILE_ID + 2
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"c") is None
 
 
 def test_directory_lookup_overwrite(fs: PathLevelFilesystem):
     de = DirectoryEntry(b"a", fs.ROOT_FILE_ID + 1)
     fs.add_directory_entry(fs.ROOT_FILE_ID, de)
 
-    assert fs.search_directory(fs.ROOT_FILE_ID, b"a")[0].file_id == fs.ROOT_FILE_ID + 1
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"a").file_id == fs.ROOT_FILE_ID + 1
 
     de.file_id = fs.ROOT_FILE_ID + 2
 
     with pytest.raises(FileExistsError):
         fs.add_directory_entry(fs.ROOT_FILE_ID, de)
 
-    assert fs.search_directory(fs.ROOT_FILE_ID, b"a")[0].file_id == fs.ROOT_FILE_ID + 1
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"a").file_id == fs.ROOT_FILE_ID + 1
 
     fs.add_directory_entry(fs.ROOT_FILE_ID, de, overwrite=True)
 
-    assert fs.search_directory(fs.ROOT_FILE_ID, b"a")[0].file_id == fs.ROOT_FILE_ID + 2
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"a").file_id == fs.ROOT_FILE_ID + 2
 
 
 def test_directory_remove_simple(fs: PathLevelFilesystem):
     de = DirectoryEntry(b"a", fs.ROOT_FILE_ID + 1)
     fs.add_directory_entry(fs.ROOT_FILE_ID, de)
 
-    assert fs.search_directory(fs.ROOT_FILE_ID, b"a")[0].file_id == fs.ROOT_FILE_ID + 1
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"a").file_id == fs.ROOT_FILE_ID + 1
 
     fs.remove_directory_entry(fs.ROOT_FILE_ID, de.name)
 
-    assert fs.search_directory(fs.ROOT_FILE_ID, b"a")[0] is None
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"a") is None
     assert fs.filefs.read(fs.ROOT_FILE_ID) == b""
 
 
@@ -87,15 +88,15 @@ def test_directory_remove(fs: PathLevelFilesystem):
 
     fs.remove_directory_entry(fs.ROOT_FILE_ID, b"b")
 
-    assert fs.search_directory(fs.ROOT_FILE_ID, b"b")[0] is None
-    assert fs.filefs.read(fs.ROOT_FILE_ID) == fs.pack_directory_entry(de_a) + fs.pack_directory_entry(de_c)
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"b") is None
+    assert list(fs.directory_entries(fs.ROOT_FILE_ID)) == [de_a, de_c]
 
     with pytest.raises(FileNotFoundError):
         fs.remove_directory_entry(fs.ROOT_FILE_ID, b"b")
 
     fs.remove_directory_entry(fs.ROOT_FILE_ID, b"c")
 
-    assert fs.filefs.read(fs.ROOT_FILE_ID) == fs.pack_directory_entry(de_a)
+    assert list(fs.directory_entries(fs.ROOT_FILE_ID)) == [de_a]
 
 
 def test_list_directory(fs: PathLevelFilesystem):
@@ -107,3 +108,145 @@ def test_list_directory(fs: PathLevelFilesystem):
     fs.add_directory_entry(fs.ROOT_FILE_ID, de_c)
 
     assert list(fs.directory_entries(fs.ROOT_FILE_ID)) == [de_a, de_b, de_c]
+
+
+def test_directory_node(fs: PathLevelFilesystem):
+    node = DirectoryNode(True, 5, [DirectoryEntry(b"a", 7)] * fs.DIRECTORY_NODE_ENTRIES, 3, 4)
+    packed = fs.pack_directory_node(node)
+    assert len(packed) <= fs.filefs.FILE_HEADER_DATA_SIZE
+    assert fs.unpack_directory_node(packed) == node
+
+
+def test_large_directory(fs: PathLevelFilesystem):
+    names = [f"{i:05}".encode() for i in range(1000)]
+    random.Random(0).shuffle(names)
+    for i, name in enumerate(names):
+        fs.add_directory_entry(fs.ROOT_FILE_ID, DirectoryEntry(name, i))
+
+    assert [entry.name for entry in fs.directory_entries(fs.ROOT_FILE_ID)] == sorted(names)
+    for i, name in enumerate(names):
+        assert fs.search_directory(fs.ROOT_FILE_ID, name).file_id == i
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"x") is None
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"") is None
+
+    # Listing can carry on after any name, whether or not it is still there
+    assert [entry.name for entry in fs.directory_entries(fs.ROOT_FILE_ID, b"00499")] == sorted(names)[500:]
+    assert [entry.name for entry in fs.directory_entries(fs.ROOT_FILE_ID, b"00499a")] == sorted(names)[500:]
+    assert list(fs.directory_entries(fs.ROOT_FILE_ID, b"00999")) == []
+
+    # Inserts only touch the nodes on the path to the leaf
+    writes = fs.filefs.blockfs.block_writes
+    fs.add_directory_entry(fs.ROOT_FILE_ID, DirectoryEntry(b"00500a", 1))
+    fs.filefs.blockfs.flush_writes()
+    assert fs.filefs.blockfs.block_writes - writes <= 6
+
+    fs.remove_directory_entry(fs.ROOT_FILE_ID, b"00500a")
+    for name in names[::2]:
+        fs.remove_directory_entry(fs.ROOT_FILE_ID, name)
+    assert [entry.name for entry in fs.directory_entries(fs.ROOT_FILE_ID)] == sorted(names[1::2])
+    for name in names[1::2]:
+        fs.remove_directory_entry(fs.ROOT_FILE_ID, name)
+    assert list(fs.directory_entries(fs.ROOT_FILE_ID)) == []
+    assert fs.filefs.read(fs.ROOT_FILE_ID) == b""
+
+
+def test_add_directory_entries(fs: PathLevelFilesystem):
+    dir_id = fs.filefs.create_new_file(1)
+    # Three levels of nodes
+    size = fs.DIRECTORY_NODE_ENTRIES
+    names = [f"{i:06}".encode() for i in range((size + 1) ** 2 + 5)]
+    random.Random(0).shuffle(names)
+    fs.add_directory_entries(dir_id, [DirectoryEntry(name, i) for i, name in enumerate(names)])
+
+    root = fs.read_directory_node(dir_id, 0)
+    assert root.entry_count == len(names)
+    assert not root.leaf and not fs.read_directory_node(dir_id, root.link).leaf
+    assert [entry.name for entry in fs.directory_entries(dir_id)] == sorted(names)
+    for i, name in enumerate(names):
+        assert fs.search_directory(dir_id, name).file_id == i
+    assert list(fs.directory_entries(dir_id, after=sorted(names)[-2])) == [DirectoryEntry(max(names),
+                                                                                          names.index(max(names)))]
+
+    # Later changes work as usual, and entries are added one by one to a directory which isn't empty
+    fs.add_directory_entry(dir_id, DirectoryEntry(b"000000a", 1))
+    fs.remove_directory_entry(dir_id, b"000000")
+    fs.add_directory_entries(dir_id, [DirectoryEntry(b"x", 2), DirectoryEntry(b"y", 3)])
+    assert [entry.name for entry in fs.directory_entries(dir_id)] == sorted(set(names) - {b"000000"}
+                                                                            | {b"000000a", b"x", b"y"})
+    with pytest.raises(FileExistsError):
+        fs.add_directory_entries(dir_id, [DirectoryEntry(b"x", 4)])
+    with pytest.raises(FileExistsError):
+        fs.add_directory_entries(fs.filefs.create_new_file(1), [DirectoryEntry(b"x", 4), DirectoryEntry(b"x", 5)])
+
+
+def test_reclaim_orphans(fs: PathLevelFilesystem):
+    free_blocks = fs.filefs.number_free_blocks(0)
+    file_id = fs.filefs.create_new_file(0)
+    fs.filefs.write(file_id, b"a" * fs.filefs.blockfs.LOGICAL_BLOCK_SIZE * 100, 0)
+    fs.add_directory_entry(fs.ROOT_FILE_ID, DirectoryEntry(b"a", file_id))
+
+    fs.remove_directory_entry(fs.ROOT_FILE_ID, b"a")
+    fs.orphan_file(file_id)
+    orphans = fs.system_file(fs.ORPHANS)
+    assert [entry.file_id for entry in fs.directory_entries(orphans)] == [file_id]
+    assert list(fs.directory_entries(fs.ROOT_FILE_ID)) == []
+    used_blocks = free_blocks - fs.filefs.number_free_blocks(0)
+
+    # Files still in use aren't touched
+    assert fs.reclaim_orphans(40, keep={file_id}) == 0
+    assert fs.filefs.number_free_blocks(0) == free_blocks - used_blocks
+
+    freed = fs.reclaim_orphans(40)
+    assert 0 < freed <= 40
+    assert [entry.file_id for entry in fs.directory_entries(orphans)] == [file_id]
+
+    # Resumes from a fresh instance, as it would after a remount
+    fs2 = PathLevelFilesystem(fs.filefs)
+    while True:
+        n = fs2.reclaim_orphans(40)
+        if not n:
+            break
+        freed += n
+
+    assert list(fs.directory_entries(orphans)) == []
+    assert freed == used_blocks - 1
+    assert fs.filefs.number_free_blocks(0) == free_blocks - 1
+
+
+def test_directory_cache(fs: PathLevelFilesystem):
+    for i in range(100):
+        fs.add_directory_entry(fs.ROOT_FILE_ID, DirectoryEntry(f"{i:03}".encode(), i))
+    for i in range(100):
+        assert fs.search_directory(fs.ROOT_FILE_ID, f"{i:03}".encode()).file_id == i
+
+    reads = fs.filefs.blockfs.block_reads
+    for i in range(100):
+        assert fs.search_directory(fs.ROOT_FILE_ID, f"{i:03}".encode()).file_id == i
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"100") is None
+    assert fs.filefs.blockfs.block_reads == reads
+
+    # Reloaded after our own changes and anyone else's
+    fs.add_directory_entry(fs.ROOT_FILE_ID, DirectoryEntry(b"100", 100))
+    fs.remove_directory_entry(fs.ROOT_FILE_ID, b"000")
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"100").file_id == 100
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"000") is None
+
+    fs2 = PathLevelFilesystem(fs.filefs)
+    fs2.add_directory_entry(fs.ROOT_FILE_ID, DirectoryEntry(b"001", 5), overwrite=True)
+    fs2.remove_directory_entry(fs.ROOT_FILE_ID, b"002")
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"001").file_id == 5
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"002") is None
+
+
+def test_directory_node_cache_size(fs: PathLevelFilesystem):
+    fs.add_directory_entries(fs.ROOT_FILE_ID, [DirectoryEntry(f"{i:04}".encode(), i) for i in range(1000)])
+    fs.node_cache.clear()
+    # Only the root, the internal node and the leaf on the way to the entry are decoded
+    assert fs.search_directory(fs.ROOT_FILE_ID, b"0500").file_id == 500
+    assert len(fs.node_cache) == 3
+
+    fs.node_cache.maxsize = 4
+    for i in range(1000):
+        assert fs.search_directory(fs.ROOT_FILE_ID, f"{i:04}".encode()).file_id == i
+    assert len(fs.node_cache) == 4
+    assert [entry.file_id for entry in fs.directory_entries(fs.ROOT_FILE_ID)] == list(range(1000))
@@ -0,0 +1,109 @@
+import os
+import pathlib
+import pytest
+import sys
+
+from cryptography.exceptions import InvalidTag
+
+from plaraefs.blocklevelfilesystem import BlockLevelFilesystem
+from plaraefs.filelevelfilesystem import FileLevelFilesystem
+from plaraefs.pathlevelfilesystem import PathLevelFilesystem, DirectoryEntry
+from plaraefs.check import Checker
+from plaraefs.rekey import Rekeyer
+
+OLD_KEY = os.urandom(32)
+NEW_KEY = os.urandom(32)
+
+
+@pytest.fixture()
+def location():
+    location = pathlib.Path("test_bfs.plaraefs")
+    if location.exists():
+        location.unlink()
+    BlockLevelFilesystem.initialise(location, OLD_KEY)
+    bfs = BlockLevelFilesystem(location, OLD_KEY)
+    FileLevelFilesystem.initialise(bfs)
+    ffs = FileLevelFilesystem(bfs)
+    PathLevelFilesystem.initialise(ffs)
+    fs = PathLevelFilesystem(ffs)
+    for i in range(20):
+        file_id = fs.filefs.create_new_file(0)
+        fs.add_directory_entry(fs.ROOT_FILE_ID, DirectoryEntry(b"%d" % i, file_id))
+        fs.filefs.write(file_id, b"%d" % i * 10000)
+    bfs.flush_writes()
+    bfs.close()
+    yield location
+    location.unlink()
+
+
+def open_fs(location, key, old_key=None):
+    bfs = BlockLevelFilesystem(location, key, old_key=old_key)
+    return PathLevelFilesystem(FileLevelFilesystem(bfs))
+
+
+def rekeyer(fs, **kwargs):
+    rekeyer = Rekeyer(fs, **kwargs)
+    rekeyer.BATCH_BLOCKS = 8
+    rekeyer.CHECKPOINT_INTERVAL = 0
+    return rekeyer
+
+
+def check_contents(fs, capsys):
+    for i in range(20):
+        file_id = fs.search_directory(fs.ROOT_FILE_ID, b"%d" % i).file_id
+        assert fs.filefs.read(file_id) == b"%d" % i * 10000
+    capsys.readouterr()
+    assert Checker(fs, workers=2, progress=None, verify=True).run() == 0, capsys.readouterr().out
+    assert fs.search_directory(fs.SYSTEM_FILE_ID, Rekeyer.REKEY) is None
+
+
+def test_rekey(location, capsys):
+    fs = open_fs(location, NEW_KEY, OLD_KEY)
+    rekeyer(fs, workers=3, progress=None).run()
+    fs.filefs.blockfs.close()
+
+    fs = open_fs(location, NEW_KEY)
+    check_contents(fs, capsys)
+    assert not fs.filefs.blockfs.stats["old_key_decrypts"]
+    fs.filefs.blockfs.close()
+    with pytest.raises(InvalidTag):
+        open_fs(location, OLD_KEY)
+
+
+def test_rekey_resume(location, capsys):
+    fs = open_fs(location, NEW_KEY, OLD_KEY)
+    interrupted = rekeyer(fs, workers=1, progress=None)
+    calls = []
+
+    def reencrypt(data):
+        if len(calls) == 3:
+            raise KeyboardInterrupt()
+        calls.append(data)
+        return Rekeyer.reencrypt(interrupted, data)
+    interrupted.reencrypt = reencrypt
+    with pytest.raises(KeyboardInterrupt):
+        interrupted.run()
+    fs.filefs.blockfs.close()
+
+    # Half done, so both keys are needed
+    fs = open_fs(location, NEW_KEY, OLD_KEY)
+    rekeyer(fs, workers=2, progress=sys.stderr).run()
+    assert "Carrying on from block 24" in capsys.readouterr().err
+    fs.filefs.blockfs.close()
+
+    fs = open_fs(location, NEW_KEY)
+    check_contents(fs, capsys)
+    fs.filefs.blockfs.close()
+
+
+def test_reencrypt_block(location):
+    bfs = BlockLevelFilesystem(location, NEW_KEY, old_key=OLD_KEY)
+    data = bfs.read_at(bfs.block_start(1), bfs.PHYSICAL_BLOCK_SIZE)
+    reencrypted = bfs.reencrypt_block(data)
+    assert reencrypted[:bfs.IV_SIZE] == data[:bfs.IV_SIZE] and reencrypted != data
+    assert bfs.reencrypt_block(reencrypted) == reencrypted
+    assert bfs.decrypt_block(reencrypted) == bfs.decrypt_block(data)
+    assert bfs.stats["old_key_decrypts"] == 2
+    uninitialised = bytes(bfs.PHYSICAL_BLOCK_SIZE)
+    assert bfs.reencrypt_block(uninitialised) == uninitialised
+    bfs.close()
@@ -0,0 +1,132 @@
+import pytest
+import pathlib
+import os
+
+from plaraefs.blocklevelfilesystem import BlockLevelFilesystem
+from plaraefs.filelevelfilesystem import FileLevelFilesystem
+from plaraefs.pathlevelfilesystem import PathLevelFilesystem, DirectoryEntry
+from plaraefs.check import Checker
+from plaraefs.snapshot import Snapshots
+
+
+@pytest.fixture()
+def fs():
+    key = os.urandom(32)
+    location = pathlib.Path("test_bfs.plaraefs")
+    if location.exists():
+        location.unlink()
+    BlockLevelFilesystem.initialise(location, key)
+    bfs = BlockLevelFilesystem(location, key)
+    FileLevelFilesystem.initialise(bfs)
+    ffs = FileLevelFilesystem(bfs)
+    PathLevelFilesystem.initialise(ffs)
+    fs = PathLevelFilesystem(ffs)
+    yield fs
+    bfs.close()
+    location.unlink()
+
+
+def add_file(fs, parent, name, data):
+    file_id = fs.filefs.create_new_file(0)
+    fs.add_directory_entry(parent, DirectoryEntry(name, file_id))
+    fs.filefs.write(file_id, data, 0)
+    return file_id
+
+
+def view(snapshots, name):
+    return PathLevelFilesystem(FileLevelFilesystem(snapshots.view(name)))
+
+
+def check(fs, capsys):
+    problems = Checker(fs, workers=2, progress=None, verify=True).run()
+    return problems, capsys.readouterr().out
+
+
+def test_snapshot(fs: PathLevelFilesystem, capsys):
+    dir_id = fs.filefs.create_new_file(1)
+    fs.add_directory_entry(fs.ROOT_FILE_ID, DirectoryEntry(b"dir", dir_id))
+    file_id = add_file(fs, dir_id, b"file", b"a" * 10000)
+    other_data = os.urandom(20 * fs.filefs.blockfs.LOGICAL_BLOCK_SIZE)
+    other_id = add_file(fs, fs.ROOT_FILE_ID, b"other", other_data)
+
+    snapshots = Snapshots(fs)
+    snapshots.create(b"backup")
+    assert snapshots.names() == [b"backup"]
+    with pytest.raises(FileExistsError):
+        snapshots.create(b"backup")
+
+    # Changed, deleted and the freed blocks reused
+    fs.filefs.write(file_id, b"b" * 10, 5000)
+    fs.remove_directory_entry(fs.ROOT_FILE_ID, b"other")
+    fs.filefs.delete_file(other_id)
+    add_file(fs, fs.ROOT_FILE_ID, b"new", os.urandom(len(other_data)))
+
+    snapshot = view(snapshots, b"backup")
+    assert [entry.name for entry in snapshot.directory_entries(fs.ROOT_FILE_ID)] == [b"dir", b"other"]
+    assert snapshot.search_directory(dir_id, b"file").file_id == file_id
+    assert snapshot.filefs.read(file_id) == b"a" * 10000
+    assert snapshot.filefs.read(other_id) == other_data
+    assert fs.filefs.read(file_id) == b"a" * 5000 + b"b" * 10 + b"a" * 4990
+    with pytest.raises(OSError):
+        snapshot.filefs.write(file_id, b"c", 0)
+
+    assert check(fs, capsys)[0] == 0
+
+    snapshots.delete(b"backup")
+    assert snapshots.names() == []
+    with pytest.raises(OSError):
+        snapshot.filefs.read(file_id)
+    with pytest.raises(FileNotFoundError):
+        snapshots.delete(b"backup")
+    # Copies are freed
+    assert check(fs, capsys)[0] == 0
+
+
+def test_snapshot_taken_in_constant_time(fs: PathLevelFilesystem):
+    for i in range(10):
+        add_file(fs, fs.ROOT_FILE_ID, str(i).encode(), os.urandom(10000))
+    fs.filefs.blockfs.flush_writes()
+    writes = fs.filefs.blockfs.stats["block_writes"]
+    Snapshots(fs).create(b"backup")
+    # Only the snapshots directory, the record and the superblock, whatever the size of the filesystem
+    assert fs.filefs.blockfs.stats["block_writes"] - writes < 10
+
+
+def test_several_snapshots(fs: PathLevelFilesystem, capsys):
+    file_id = add_file(fs, fs.ROOT_FILE_ID, b"file", b"a" * 10000)
+    snapshots = Snapshots(fs)
+    snapshots.create(b"first")
+    fs.filefs.write(file_id, b"b" * 10000, 0)
+    snapshots.create(b"second")
+    fs.filefs.write(file_id, b"c" * 10000, 0)
+    snapshots.create(b"third")
+
+    assert view(snapshots, b"first").filefs.read(file_id) == b"a" * 10000
+    assert view(snapshots, b"second").filefs.read(file_id) == b"b" * 10000
+    assert view(snapshots, b"third").filefs.read(file_id) == b"c" * 10000
+    assert check(fs, capsys)[0] == 0
+
+    snapshots.delete(b"second")
+    assert view(snapshots, b"first").filefs.read(file_id) == b"a" * 10000
+    assert check(fs, capsys)[0] == 0
+    snapshots.delete(b"first")
+    snapshots.delete(b"third")
+    assert check(fs, capsys)[0] == 0
+
+
+def test_snapshot_written_by_other_process(fs: PathLevelFilesystem, capsys):
+    file_id = add_file(fs, fs.ROOT_FILE_ID, b"file", b"a" * 10000)
+    blockfs = fs.filefs.blockfs
+    other_blockfs = BlockLevelFilesystem(blockfs.fname, blockfs.key)
+    other = PathLevelFilesystem(FileLevelFilesystem(other_blockfs))
+    Snapshots(other)
+
+    snapshots = Snapshots(fs)
+    snapshots.create(b"backup")
+    other.filefs.write(file_id, b"b" * 10000, 0)
+    other_blockfs.flush_writes()
+
+    assert fs.filefs.read(file_id) == b"b" * 10000
+    assert view(snapshots, b"backup").filefs.read(file_id) == b"a" * 10000
+    other_blockfs.close()
+    assert check(fs, capsys)[0] == 0
@@ -0,0 +1,78 @@
+import pytest
+import pathlib
+import os
+import sys
+import threading
+
+from plaraefs.blocklevelfilesystem import BlockLevelFilesystem
+from plaraefs.stats import Stats, LayerSampler, frame_layer, parse_prometheus, diff
+
+
+@pytest.fixture()
+def fs():
+    key = os.urandom(32)
+    location = pathlib.Path("test_bfs.plaraefs")
+    if location.exists():
+        location.unlink()
+    BlockLevelFilesystem.initialise(location, key)
+    fs = BlockLevelFilesystem(location, key)
+    yield fs
+    fs.close()
+    location.unlink()
+
+
+def test_snapshot_diff():
+    stats = Stats()
+    stats.add("block_reads", 3)
+    stats.cache("header_cache", True)
+    stats.cache("header_cache", False)
+    before = parse_prometheus(stats.prometheus())
+    assert before == {"plaraefs_block_reads_total": 3,
+                      "plaraefs_header_cache_hits_total": 1,
+                      "plaraefs_header_cache_misses_total": 1}
+
+    stats.add("block_reads")
+    stats.add("iv_reads", 2)
+    assert diff(before, parse_prometheus(stats.prometheus())) == {"plaraefs_block_reads_total": 1,
+                                                                  "plaraefs_iv_reads_total": 2}
+
+
+def test_threads():
+    stats = Stats()
+    barrier = threading.Barrier(4, timeout=5)
+
+    def count():
+        for _ in range(1000):
+            stats.add("block_reads")
+        stats.cache("header_cache", True)
+        barrier.wait()
+
+    threads = [threading.Thread(target=count) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    stats.add("block_reads")
+    barrier.wait()
+    assert stats["block_reads"] == 3001
+    for thread in threads:
+        thread.join()
+    # Kept once the threads are gone
+    assert stats.snapshot() == {"block_reads": 3001, "header_cache_hits": 3}
+
+
+def test_layer_sampler(fs: BlockLevelFilesystem):
+    assert frame_layer(sys._getframe()) is None
+
+    fs.new_blocks(1)
+    sampler = LayerSampler(fs.stats, 0.01)
+    with fs.lock_file(write=True):
+        # Waiting for the lock inside the block layer
+        reader = threading.Thread(target=fs.read_block, args=(0,))
+        reader.start()
+        while not any(frame_layer(frame) == "block" for thread_id, frame in sys._current_frames().items()
+                      if thread_id == reader.ident):
+            pass
+        sampler.sample()
+    reader.join()
+
+    assert fs.stats["profile_block_samples"] == 1
+    assert fs.stats["profile_file_samples"] == 0
@@ -0,0 +1,167 @@
+import io
+import os
+import pathlib
+import pytest
+import sys
+import tarfile
+
+from plaraefs.blocklevelfilesystem import BlockLevelFilesystem
+from plaraefs.filelevelfilesystem import FileLevelFilesystem
+from plaraefs.pathlevelfilesystem import PathLevelFilesystem, DirectoryEntry
+from plaraefs.check import Checker
+from plaraefs.transfer import Importer, Exporter
+from plaraefs import transfer
+
+
+@pytest.fixture()
+def fs():
+    key = os.urandom(32)
+    location = pathlib.Path("test_bfs.plaraefs")
+    if location.exists():
+        location.unlink()
+    BlockLevelFilesystem.initialise(location, key)
+    bfs = BlockLevelFilesystem(location, key)
+    FileLevelFilesystem.initialise(bfs)
+    ffs = FileLevelFilesystem(bfs)
+    PathLevelFilesystem.initialise(ffs)
+    yield PathLevelFilesystem(ffs)
+    bfs.close()
+    location.unlink()
+
+
+@pytest.fixture()
+def tree(tmp_path):
+    source = tmp_path / "source"
+    (source / "a" / "b").mkdir(parents=True)
+    (source / "empty").mkdir()
+    (source / "a" / "big").write_bytes(os.urandom(3 * 2 ** 20 + 5))
+    (source / "a" / "b" / "small").write_bytes(b"small")
+    (source / "a" / "b" / "nothing").write_bytes(b"")
+    for i in range(300):
+        (source / "a" / f"{i:03}").write_bytes(os.urandom(i * 100))
+    (source / "link").symlink_to("a")
+    return source
+
+
+def contents(path):
+    return {str(p.relative_to(path)): None if p.is_dir() else p.read_bytes()
+            for p in path.rglob("*") if not p.is_symlink()}
+
+
+def check(fs, capsys):
+    capsys.readouterr()
+    assert Checker(fs, workers=2, progress=None).run() == 0, capsys.readouterr().out
+    capsys.readouterr()
+
+
+def test_import_export(fs: PathLevelFilesystem, tree, tmp_path, capsys):
+    Importer(fs, workers=3, progress=sys.stderr).import_tree(tree)
+    err = capsys.readouterr().err
+    assert "Skipping /link: not a regular file or directory" in err
+    assert "Imported 303 files and 3 directories" in err
+    check(fs, capsys)
+
+    Exporter(fs, workers=3, progress=None).export_tree(tmp_path / "destination")
+    assert contents(tmp_path / "destination") == contents(tree)
+
+    # Importing again leaves what's there alone, but fills in what's missing
+    (tree / "a" / "new").write_bytes(b"new")
+    (tree / "a" / "b" / "small").write_bytes(b"changed")
+    Importer(fs, workers=3, progress=sys.stderr).import_tree(tree)
+    err = capsys.readouterr().err
+    assert "Skipping /a/b/small: already exists" in err
+    assert "Imported 1 files and 0 directories" in err
+    check(fs, capsys)
+    a = fs.search_directory(fs.ROOT_FILE_ID, b"a").file_id
+    assert fs.filefs.read(fs.search_directory(a, b"new").file_id) == b"new"
+    b = fs.search_directory(a, b"b").file_id
+    assert fs.filefs.read(fs.search_directory(b, b"small").file_id) == b"small"
+
+
+def test_tar(fs: PathLevelFilesystem, tree, tmp_path, capsys):
+    Importer(fs, workers=2, progress=None).import_tree(tree)
+    stream = io.BytesIO()
+    Exporter(fs, workers=2, progress=None).export_tar(stream)
+
+    stream.seek(0)
+    with tarfile.open(fileobj=stream) as tar:
+        names = tar.getnames()
+        assert "a/big" in names and "empty" in names
+        assert tar.extractfile("a/b/small").read() == b"small"
+
+    # Into another filesystem, which already has an entry of the same name
+    location = pathlib.Path("test_bfs2.plaraefs")
+    key = os.urandom(32)
+    BlockLevelFilesystem.initialise(location, key)
+    bfs = BlockLevelFilesystem(location, key)
+    try:
+        FileLevelFilesystem.initialise(bfs)
+        ffs = FileLevelFilesystem(bfs)
+        PathLevelFilesystem.initialise(ffs)
+        other = PathLevelFilesystem(ffs)
+        other.add_directory_entry(other.ROOT_FILE_ID, DirectoryEntry(b"empty", other.filefs.create_new_file(0)))
+
+        stream.seek(0)
+        Importer(other, workers=2, progress=sys.stderr).import_tar(stream)
+        assert "Skipping /empty: already exists" in capsys.readouterr().err
+        check(other, capsys)
+        Exporter(other, workers=2, progress=None).export_tree(tmp_path / "destination")
+        expected = contents(tree)
+        del expected["empty"]
+        expected["empty"] = b""
+        assert contents(tmp_path / "destination") == expected
+    finally:
+        bfs.close()
+        location.unlink()
+
+
+def test_import_unreadable_file(fs: PathLevelFilesystem, tree, capsys, monkeypatch):
+    def unreadable(path, *args):
+        if pathlib.Path(path).name == "big":
+            raise PermissionError(13, "Permission denied")
+        return open(path, *args)
+    monkeypatch.setattr(transfer, "open", unreadable, raising=False)
+
+    # Only that file is skipped, and its blocks freed
+    Importer(fs, workers=3, progress=sys.stderr).import_tree(tree)
+    err = capsys.readouterr().err
+    assert "Skipping /a/big: Permission denied" in err
+    assert "Imported 302 files and 3 directories" in err
+    check(fs, capsys)
+    a = fs.search_directory(fs.ROOT_FILE_ID, b"a").file_id
+    assert fs.search_directory(a, b"big") is None
+    assert fs.filefs.read(fs.search_directory(a, b"299").file_id) == (tree / "a" / "299").read_bytes()
+
+
+def test_import_stopped(fs: PathLevelFilesystem, tree, capsys, monkeypatch):
+    encrypt_segment = Importer.encrypt_segment
+    segments = []
+
+    def stop(self, data, block_num):
+        segments.append(block_num)
+        if len(segments) == 50:
+            raise KeyboardInterrupt()
+        return encrypt_segment(self, data, block_num)
+    monkeypatch.setattr(Importer, "encrypt_segment", stop)
+
+    # Files finished before it stopped are added, the rest freed
+    with pytest.raises(KeyboardInterrupt):
+        Importer(fs, workers=1, progress=None).import_tree(tree)
+    check(fs, capsys)
+    a = fs.search_directory(fs.ROOT_FILE_ID, b"a").file_id
+    names = [entry.name for entry in fs.directory_entries(a)]
+    assert b"000" in names and len(names) < 302
+    for name in names:
+        if name != b"b":
+            assert fs.filefs.read(fs.search_directory(a, name).file_id) == (tree / "a" / os.fsdecode(name)).read_bytes()
+
+
+def test_import_mounted(fs: PathLevelFilesystem, tree, capsys):
+    blockfs = fs.filefs.blockfs
+    mount = BlockLevelFilesystem(blockfs.fname, blockfs.key)
+    assert mount.claim(exclusive=False)
+    with pytest.raises(RuntimeError):
+        Importer(fs, workers=2, progress=None).import_tree(tree)
+    assert capsys.readouterr().out == "The filesystem is mounted, unmount it before importing!\n"
+    assert not list(fs.directory_entries(fs.ROOT_FILE_ID))
+    mount.close()
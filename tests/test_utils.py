@@ -0,0 +1,94 @@
+import pytest
+import threading
+
+from plaraefs.utils import RWLock
+
+
+def test_rwlock_readers_share():
+    lock = RWLock()
+    barrier = threading.Barrier(2, timeout=5)
+
+    def reader():
+        with lock.read():
+            barrier.wait()
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    reader()
+    thread.join()
+
+
+def test_rwlock_writer_excludes():
+    lock = RWLock()
+    events = []
+    locked = threading.Event()
+
+    def reader():
+        locked.wait(5)
+        with lock.read():
+            events.append("read")
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    with lock.write():
+        locked.set()
+        thread.join(0.1)
+        events.append("write")
+    thread.join()
+
+    assert events == ["write", "read"]
+
+
+def test_rwlock_reentrant():
+    calls = []
+    lock = RWLock(lambda write: calls.append(("acquire", write)), lambda write: calls.append(("release", write)))
+
+    with lock.write():
+        with lock.read():
+            with lock.write():
+                assert lock.held(write=True)
+    assert not lock.held()
+
+    with lock.read():
+        with lock.read():
+            assert lock.held() and not lock.held(write=True)
+        with pytest.raises(RuntimeError):
+            with lock.write():
+                pass
+
+    assert calls == [("acquire", True), ("release", True), ("acquire", False), ("release", False)]
+
+
+def test_rwlock_acquire_outside_condition():
+    lock = None
+    free = []
+    blocked = threading.Event()
+    release = threading.Event()
+
+    def on_acquire(write):
+        # Others can still get at the lock's state while this waits, for example on another process
+        free.append(lock.condition.acquire(blocking=False))
+        lock.condition.release()
+        blocked.set()
+        release.wait(5)
+
+    lock = RWLock(on_acquire)
+    events = []
+
+    def reader():
+        with lock.read():
+            events.append("read")
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    blocked.wait(5)
+    second = threading.Thread(target=reader)
+    second.start()
+    second.join(0.1)
+    # The second reader waits until the lock is actually held
+    assert events == []
+    release.set()
+    thread.join()
+    second.join()
+    assert free and all(free)
+    assert events == ["read", "read"]